@@ -0,0 +1,154 @@
+"""Dyson Pure Link Device Logic on asyncio"""
+
+import asyncio, json, time
+from paho.mqtt.asyncio_helper import AsyncioHelper
+import plugin_log as log
+
+from dyson_pure_link_device import DysonPureLinkDevice
+from value_types import ConnectionError
+
+class AsyncDysonPureLinkDevice(DysonPureLinkDevice):
+    """Dyson Pure Link device driven by an asyncio event loop, without network thread.
+
+    All methods must be called from the event loop. Many devices can be polled
+    and commanded concurrently, e.g. with asyncio.gather()."""
+
+    def __init__(self, password, serialNumber, deviceType, ipAdress, portNum, loop=None):
+        super(AsyncDysonPureLinkDevice, self).__init__(password, serialNumber, deviceType, ipAdress, portNum)
+        self._event_loop = loop
+        self._helper = None
+        self._connected_future = None
+        self._state_waiters = []
+        self._sensor_waiters = []
+        self.set_update_callback(self._on_update)
+
+    def on_connect(self, client, userdata, flags, return_code):
+        """Static callback to handle on_connect event"""
+        log.debug("async_dyson_pure_link_device: on_connect called")
+        future = self._connected_future
+        if return_code:
+            self.connection_statistics.connect_refused(return_code)
+            if future is not None and not future.done():
+                future.set_exception(ConnectionError(return_code))
+            return
+
+        client.subscribe(self.device_status)
+        self.connection_statistics.connected()
+        if future is not None and not future.done():
+            future.set_result(True)
+
+    def on_disconnect(self, client, userdata, return_code):
+        """Static callback to handle on_disconnect event"""
+        log.debug("async_dyson_pure_link_device: on_disconnect called")
+        self._is_connected = False
+        self.connection_statistics.disconnected(return_code)
+
+    def _on_update(self, state_data, sensor_data):
+        """Hands state and sensor messages to the coroutines waiting for them"""
+        if state_data is not None:
+            self.state_data = state_data
+            self._state_waiters = self._resolve(self._state_waiters, state_data)
+        if sensor_data is not None:
+            self.sensor_data = sensor_data
+            self._sensor_waiters = self._resolve(self._sensor_waiters, sensor_data)
+
+    @staticmethod
+    def _resolve(waiters, value):
+        for future in waiters:
+            if not future.done():
+                future.set_result(value)
+        return []
+
+    async def connect(self, timeout=10):
+        """Connects to device, returns True/False depending on the result of connection"""
+        log.debug("async_dyson_pure_link_device: connect called")
+        loop = self._event_loop or asyncio.get_event_loop()
+
+        self._helper = AsyncioHelper(self._get_client(), loop)
+        self._connected_future = loop.create_future()
+
+        try:
+            # socket.create_connection() blocks, keep it off the event loop
+            await loop.run_in_executor(None, self.client.connect, self.ip_address, self.port_number)
+            self._is_connected = await asyncio.wait_for(self._connected_future, timeout)
+        except (ConnectionRefusedError, OSError, ConnectionError, asyncio.TimeoutError):
+            log.debug("async_dyson_pure_link_device: connect failed")
+            self._is_connected = False
+        finally:
+            self._connected_future = None
+
+        if not self._is_connected:
+            self._helper.detach()
+            self._helper = None
+        return self._is_connected
+
+    async def request_state(self, timeout=5):
+        """Requests current state, returns (state_data, sensor_data)"""
+        if not self._is_connected:
+            return None
+        loop = asyncio.get_event_loop()
+        state = loop.create_future()
+        sensor = loop.create_future()
+        self._state_waiters.append(state)
+        self._sensor_waiters.append(sensor)
+        self._request_state()
+        try:
+            return tuple(await asyncio.wait_for(asyncio.gather(state, sensor), timeout))
+        finally:
+            self._forget(state, sensor)
+
+    def _forget(self, state, sensor):
+        if state in self._state_waiters:
+            self._state_waiters.remove(state)
+        if sensor in self._sensor_waiters:
+            self._sensor_waiters.remove(sensor)
+
+    async def change_state(self, data, timeout=5):
+        """Publishes a STATE-SET for data and waits until the device confirms it,
+        returns the confirming state data"""
+        loop = asyncio.get_event_loop()
+        confirmed = loop.create_future()
+
+        def on_ack(command):
+            if not confirmed.done():
+                confirmed.set_result(command)
+
+        command = self.send_command(data, on_ack=on_ack, timeout=timeout)
+        if command is None:
+            return None
+        try:
+            await asyncio.wait_for(confirmed, timeout)
+        except asyncio.TimeoutError:
+            self.check_command_timeouts()
+            raise
+        return self.state_data
+
+    async def set_fan_mode(self, mode, timeout=5):
+        """Changes fan mode: ON|OFF|AUTO"""
+        return await self.change_state({'fmod': mode}, timeout)
+
+    async def set_fan_speed(self, speed, timeout=5):
+        """Changes fan speed: 0001..0010|AUTO"""
+        return await self.change_state({'fnsp': speed}, timeout)
+
+    async def set_standby_monitoring(self, mode, timeout=5):
+        """Changes standby monitoring: ON|OFF"""
+        return await self.change_state({'rhtm': mode}, timeout)
+
+    async def set_night_mode(self, mode, timeout=5):
+        """Changes night mode: ON|OFF"""
+        return await self.change_state({'nmod': mode}, timeout)
+
+    async def set_oscilation(self, mode, timeout=5):
+        """Changes oscilation mode: ON|OFF"""
+        return await self.change_state({'oson': mode}, timeout)
+
+    async def disconnect(self):
+        """Disconnects device"""
+        log.debug("async_dyson_pure_link_device: disconnect called")
+        if self._helper is not None:
+            self.client.disconnect()
+            self._helper.detach()
+            self._helper = None
+        self._is_connected = False
+        return self._is_connected
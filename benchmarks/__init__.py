@@ -0,0 +1,4 @@
+"""Micro benchmarks for the plugin hot paths, run from the plugin folder with
+
+    python -m benchmarks.<name>
+"""
@@ -0,0 +1,41 @@
+"""Per message cost of decoding Dyson state and sensor messages
+
+    python -m benchmarks.decode [count]
+"""
+
+import json, sys, timeit
+
+from value_types import decode_message
+
+STATE = json.dumps({
+    'msg': 'CURRENT-STATE', 'time': '2019-01-01T12:00:00.000Z', 'mode-reason': 'LAPP', 'state-reason': 'MODE',
+    'dial': 'OFF', 'rssi': '-38',
+    'product-state': {'fmod': 'FAN', 'fnst': 'FAN', 'fnsp': '0004', 'qtar': '0003', 'oson': 'ON', 'rhtm': 'ON',
+                      'filf': '3171', 'ercd': 'NONE', 'nmod': 'OFF', 'wacd': 'NONE'},
+    'scheduler': {'srsc': 'a58d', 'dstv': '0001', 'tzid': '0001'}}).encode('utf-8')
+
+STATE_CHANGE = json.dumps({
+    'msg': 'STATE-CHANGE', 'time': '2019-01-01T12:00:00.000Z', 'mode-reason': 'LAPP', 'state-reason': 'MODE',
+    'product-state': {'fmod': ['AUTO', 'FAN'], 'fnst': ['FAN', 'FAN'], 'fnsp': ['AUTO', '0004'], 'qtar': ['0003', '0003'],
+                      'oson': ['ON', 'ON'], 'rhtm': ['ON', 'ON'], 'filf': ['3171', '3171'], 'ercd': ['NONE', 'NONE'],
+                      'nmod': ['OFF', 'OFF'], 'wacd': ['NONE', 'NONE']},
+    'scheduler': {'srsc': 'a58d', 'dstv': '0001', 'tzid': '0001'}}).encode('utf-8')
+
+SENSORS = json.dumps({
+    'msg': 'ENVIRONMENTAL-CURRENT-SENSOR-DATA', 'time': '2019-01-01T12:00:00.000Z',
+    'data': {'tact': '2950', 'hact': '0045', 'pact': '0004', 'vact': '0002', 'sltm': 'OFF'}}).encode('utf-8')
+
+def measure(label, payload, count):
+    parsed = json.loads(payload)
+    parse = min(timeit.repeat(lambda: json.loads(payload), number=count, repeat=5))
+    decode = min(timeit.repeat(lambda: decode_message(parsed), number=count, repeat=5))
+    print('{0:<14} json.loads {1:6.2f} us  decode {2:6.2f} us  total {3:6.2f} us per message'.format(
+        label, parse / count * 1e6, decode / count * 1e6, (parse + decode) / count * 1e6))
+
+def main(count=20000):
+    measure('CURRENT-STATE', STATE, count)
+    measure('STATE-CHANGE', STATE_CHANGE, count)
+    measure('SENSOR-DATA', SENSORS, count)
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,173 @@
+"""Run plugin.py headless, the way Domoticz runs it
+
+DomoticzRuntime injects Parameters and Devices into the plugin module, calls
+its onStart, onHeartbeat, onCommand and onStop, and advances a controllable
+clock by the heartbeat interval the plugin asked for. The plugin modules use
+the clock instead of the time module, so timeouts and poll counters can be
+run through without waiting. Calls into Domoticz are counted in
+fake_domoticz.calls.
+
+    runtime = DomoticzRuntime({'Address': '127.0.0.1', 'Port': '1883', ...})
+    runtime.start()
+    seconds, calls = runtime.profile(runtime.heartbeat)
+    runtime.stop()
+
+Run against simulated devices with python -m benchmarks.domoticz_runtime --help
+"""
+
+import argparse, collections, importlib, shutil, sys, tempfile, time
+
+from benchmarks import fake_domoticz
+fake_domoticz.install()
+
+# modules of the plugin that get the runtime's clock as their 'time'
+PLUGIN_MODULES = ('plugin', 'run_plugin', 'dyson_pure_link_device', 'device_loop', 'plugin_log')
+
+DEFAULT_PARAMETERS = {
+    'Key': 'DysonPureLink', 'Name': 'Dyson', 'Author': 'jan-jaap kostelijk', 'Version': '1.3.2',
+    'HardwareID': 1, 'HomeFolder': None, 'StartupFolder': './', 'Database': '',
+    'Address': '127.0.0.1', 'Port': '1883', 'Username': '', 'Password': '', 'SerialPort': '',
+    'Mode1': '475', 'Mode2': '', 'Mode3': 'Push', 'Mode4': 'Normal', 'Mode5': '3', 'Mode6': ''}
+
+class Clock(object):
+    """Stand-in for the time module that only moves on advance() or sleep()"""
+
+    def __init__(self):
+        self._monotonic = time.monotonic()
+        self._time = time.time()
+        self.offset = 0.0
+
+    def monotonic(self):
+        return self._monotonic + self.offset
+
+    def time(self):
+        return self._time + self.offset
+
+    def gmtime(self, seconds=None):
+        return time.gmtime(self.time() if seconds is None else seconds)
+
+    def localtime(self, seconds=None):
+        return time.localtime(self.time() if seconds is None else seconds)
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        self.offset += seconds
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+class DomoticzRuntime(object):
+    """Hosts the plugin module like Domoticz, see the module documentation"""
+
+    def __init__(self, parameters=None, clock=None, module='plugin'):
+        fake_domoticz.reset()
+        self.parameters = dict(DEFAULT_PARAMETERS)
+        self.parameters.update(parameters or {})
+        # the plugin writes its files, e.g. the sensor history, to a folder removed again by stop()
+        self._home = None
+        if self.parameters['HomeFolder'] is None:
+            self._home = tempfile.mkdtemp(prefix='domoticz-runtime-')
+            self.parameters['HomeFolder'] = self._home + '/'
+        self.clock = clock if clock is not None else Clock()
+        self.devices = fake_domoticz.Devices
+        self.calls = fake_domoticz.calls
+        self.heartbeats = 0
+        self._patched = []
+        if module in sys.modules:
+            # a fresh plugin object for every runtime
+            self.plugin = importlib.reload(sys.modules[module])
+        else:
+            self.plugin = importlib.import_module(module)
+        self.plugin.Parameters = self.parameters
+        self.plugin.Devices = self.devices
+        self._use_clock()
+
+    def _use_clock(self):
+        for name in PLUGIN_MODULES:
+            module = sys.modules.get(name)
+            if module is not None and getattr(module, 'time', None) is time:
+                module.time = self.clock
+                self._patched.append(module)
+
+    def _restore_clock(self):
+        for module in self._patched:
+            module.time = time
+        self._patched = []
+
+    def start(self):
+        self.plugin.onStart()
+
+    def stop(self):
+        try:
+            self.plugin.onStop()
+        finally:
+            self._restore_clock()
+            if self._home is not None:
+                shutil.rmtree(self._home, ignore_errors=True)
+
+    def heartbeat(self, count=1):
+        """Advance the clock by the heartbeat interval and call onHeartbeat, count times"""
+        for _ in range(count):
+            self.clock.advance(fake_domoticz.heartbeat_interval)
+            self.heartbeats += 1
+            self.plugin.onHeartbeat()
+
+    def run(self, seconds):
+        """Heartbeats for seconds of plugin time"""
+        self.heartbeat(max(int(seconds // fake_domoticz.heartbeat_interval), 1))
+
+    def command(self, unit, command, level=0, hue=0):
+        self.plugin.onCommand(unit, command, level, hue)
+
+    def profile(self, function, *args):
+        """Run function(*args), returns (seconds, Counter of the Domoticz calls it made)"""
+        before = collections.Counter(self.calls)
+        start = time.perf_counter()
+        function(*args)
+        seconds = time.perf_counter() - start
+        made = collections.Counter(self.calls)
+        made.subtract(before)
+        return seconds, +made
+
+def main(argv=None):
+    from benchmarks.simulator import DysonSimulator
+
+    parser = argparse.ArgumentParser(description='Run the plugin headless against simulated devices')
+    parser.add_argument('--devices', type=int, default=4)
+    parser.add_argument('--heartbeats', type=int, default=30)
+    parser.add_argument('--mode', choices=('Push', 'Poll'), default='Push')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--push-interval', type=float, default=None)
+    args = parser.parse_args(argv)
+
+    simulator = DysonSimulator(latency=args.latency, push_interval=args.push_interval)
+    serials = ['SIM-%05d' % n for n in range(args.devices)]
+    for serial in serials:
+        simulator.add_device(serial, 'password')
+    simulator.start()
+    host, port = simulator.address
+
+    runtime = DomoticzRuntime({
+        'Address': host, 'Port': str(port), 'Mode2': serials[0], 'Password': 'password', 'Mode3': args.mode,
+        'Mode6': ';'.join('{0},{1},password,475,{2}'.format(serial, host, port) for serial in serials[1:])})
+    try:
+        seconds, calls = runtime.profile(runtime.start)
+        print('onStart: {0:.3f} s, {1} Domoticz calls'.format(seconds, sum(calls.values())))
+
+        seconds, calls = runtime.profile(runtime.heartbeat, args.heartbeats)
+        print('onHeartbeat: {0:.3f} ms and {1:.1f} Domoticz calls per heartbeat'.format(
+            seconds * 1000 / args.heartbeats, sum(calls.values()) / float(args.heartbeats)))
+        for name, count in sorted(calls.items()):
+            print('  {0:<22} {1:>8.2f} per heartbeat'.format(name, count / float(args.heartbeats)))
+
+        seconds, calls = runtime.profile(runtime.command, 3, 'Set Level', 70)
+        print('onCommand: {0:.3f} ms, {1} Domoticz calls'.format(seconds * 1000, sum(calls.values())))
+    finally:
+        runtime.stop()
+        simulator.stop()
+    print(simulator.statistics)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""Stand-in for the Domoticz module, to run the plugin code outside Domoticz
+
+    from benchmarks import fake_domoticz
+    fake_domoticz.install()
+    import plugin
+    plugin.Devices = fake_domoticz.Devices
+    plugin.Parameters = {...}
+
+Every call a plugin makes into Domoticz is counted in calls, reading a device
+attribute or looking up Devices included, as each of these goes through the
+Domoticz C API. See benchmarks.domoticz_runtime to drive a plugin like
+Domoticz does.
+"""
+
+import collections, sys
+
+calls = collections.Counter()
+Debugging_level = 0
+heartbeat_interval = 10
+messages = []
+keep_messages = False
+
+class DeviceDict(dict):
+    """The Devices dictionary, counting lookups"""
+
+    def __getitem__(self, unit):
+        calls['Devices[]'] += 1
+        return dict.__getitem__(self, unit)
+
+    def __contains__(self, unit):
+        calls['Devices in'] += 1
+        return dict.__contains__(self, unit)
+
+    def get(self, unit, default=None):
+        calls['Devices[]'] += 1
+        return dict.get(self, unit, default)
+
+Devices = DeviceDict()
+
+class Device(object):
+    """Domoticz device, Create() adds it to Devices"""
+
+    def __init__(self, Name=None, Unit=None, TypeName=None, Type=0, Subtype=0, Switchtype=0, Image=0, Options=None, Used=0, DeviceID=None):
+        calls['Device()'] += 1
+        self.Name = Name
+        self.Unit = Unit
+        self.ID = Unit
+        self.DeviceID = DeviceID if DeviceID is not None else str(Unit)
+        self.TypeName = TypeName
+        self.Type = Type
+        self.SubType = Subtype
+        self.SwitchType = Switchtype
+        self.Image = Image
+        self.Options = Options or {}
+        self.Used = Used
+        self._nValue = 0
+        self._sValue = ''
+        self._BatteryLevel = 255
+        self.LastLevel = 0
+        self.updates = 0
+
+    def __repr__(self):
+        return 'Device: {0} ({1}) nValue: {2}, sValue: {3}'.format(self.Unit, self.Name, self._nValue, self._sValue)
+
+    @property
+    def nValue(self):
+        calls['Device.nValue'] += 1
+        return self._nValue
+
+    @property
+    def sValue(self):
+        calls['Device.sValue'] += 1
+        return self._sValue
+
+    @property
+    def BatteryLevel(self):
+        calls['Device.BatteryLevel'] += 1
+        return self._BatteryLevel
+
+    def Create(self):
+        calls['Device.Create'] += 1
+        dict.__setitem__(Devices, self.Unit, self)
+
+    def Update(self, nValue, sValue, BatteryLevel=255, **kwargs):
+        calls['Device.Update'] += 1
+        self.updates += 1
+        self._nValue = nValue
+        self._sValue = sValue
+        self._BatteryLevel = BatteryLevel
+
+    def Delete(self):
+        calls['Device.Delete'] += 1
+        dict.pop(Devices, self.Unit, None)
+
+def _message(level, text):
+    calls[level] += 1
+    if keep_messages:
+        messages.append((level, text))
+
+def Debug(text):
+    # a call into Domoticz even when debugging is off
+    calls['Debug'] += 1
+    if Debugging_level and keep_messages:
+        messages.append(('Debug', text))
+
+def Log(text):
+    _message('Log', text)
+
+def Status(text):
+    _message('Status', text)
+
+def Error(text):
+    _message('Error', text)
+
+def Debugging(level):
+    global Debugging_level
+    calls['Debugging'] += 1
+    Debugging_level = level
+
+def Heartbeat(seconds):
+    global heartbeat_interval
+    calls['Heartbeat'] += 1
+    heartbeat_interval = seconds
+
+def reset():
+    """Forget all devices, messages and counted calls"""
+    global Debugging_level, heartbeat_interval
+    dict.clear(Devices)
+    calls.clear()
+    del messages[:]
+    Debugging_level = 0
+    heartbeat_interval = 10
+
+def install():
+    """Make 'import Domoticz' import this module, returns it"""
+    module = sys.modules[__name__]
+    sys.modules['Domoticz'] = module
+    return module
@@ -0,0 +1,151 @@
+"""Measuring, reporting and comparing benchmark results
+
+Every operation is timed on its own, giving throughput and the p50/p99
+latency of a single operation. Memory is measured in a second, shorter run with
+tracemalloc: CPython has no allocation counter, so what is reported is the
+peak of short-lived memory while handling a message and the number of memory
+blocks still allocated per message afterwards (retained, should be 0).
+System calls are counted on sockets wrapped in CountingSocket.
+"""
+
+import gc, json, platform, sys, time, tracemalloc
+
+class CountingSocket(object):
+    """Socket wrapper counting the calls that end up as system calls"""
+
+    def __init__(self, sock):
+        self._sock = sock
+        self.syscalls = 0
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+    def recv(self, *args):
+        self.syscalls += 1
+        return self._sock.recv(*args)
+
+    def recv_into(self, *args):
+        self.syscalls += 1
+        return self._sock.recv_into(*args)
+
+    def send(self, *args):
+        self.syscalls += 1
+        return self._sock.send(*args)
+
+    def sendall(self, *args):
+        self.syscalls += 1
+        return self._sock.sendall(*args)
+
+    def sendmsg(self, *args):
+        self.syscalls += 1
+        return self._sock.sendmsg(*args)
+
+class Result(object):
+    """Measurements of one benchmark"""
+
+    FIELDS = ('count', 'per_second', 'p50_us', 'p99_us', 'peak_bytes', 'retained_blocks', 'syscalls')
+
+    def __init__(self, name, **values):
+        self.name = name
+        for field in self.FIELDS:
+            setattr(self, field, values.get(field))
+
+    def as_dict(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+    def __repr__(self):
+        return '{0:<36} {1:>10.0f} msg/s  p50 {2:>8.2f} us  p99 {3:>8.2f} us  peak {4:>7} B  retained {5:>6.2f}  syscalls {6:>5.2f} /msg'.format(
+            self.name, self.per_second, self.p50_us, self.p99_us, self.peak_bytes, self.retained_blocks, self.syscalls)
+
+def _percentile(ordered, fraction):
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+def measure(name, operation, count=20000, warmup=1000, before=None, after=None, sockets=(), batch=1):
+    """Run operation() count times and return its Result.
+
+    before() and after() run around every operation without being timed,
+    e.g. to feed or drain the other end of a socket pair. Calls on the
+    CountingSockets in sockets are reported as syscalls per message.
+    batch is the number of messages one operation handles, latencies are
+    per operation, the other figures per message."""
+    def run(times, timings=None):
+        clock = time.perf_counter_ns
+        for _ in range(times):
+            if before is not None:
+                before()
+            if timings is None:
+                operation()
+            else:
+                start = clock()
+                operation()
+                timings.append(clock() - start)
+            if after is not None:
+                after()
+
+    run(warmup)
+
+    timings = []
+    for sock in sockets:
+        sock.syscalls = 0
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        run(count, timings)
+    finally:
+        if enabled:
+            gc.enable()
+    syscalls = sum(sock.syscalls for sock in sockets) / float(count * batch)
+
+    memory_count = max(count // 10, 100)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run(10)
+        gc.collect()
+        blocks = sys.getallocatedblocks()
+        start, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        run(memory_count)
+        _, peak = tracemalloc.get_traced_memory()
+        gc.collect()
+        retained = (sys.getallocatedblocks() - blocks) / float(memory_count * batch)
+    finally:
+        tracemalloc.stop()
+
+    timings.sort()
+    return Result(name, count=count * batch, per_second=count * batch / (sum(timings) / 1e9),
+                  p50_us=_percentile(timings, 0.5) / 1000.0, p99_us=_percentile(timings, 0.99) / 1000.0,
+                  peak_bytes=peak - start, retained_blocks=max(retained, 0.0), syscalls=syscalls)
+
+def save(results, path):
+    """Store results as baseline"""
+    data = {
+        'python': platform.python_version(),
+        'machine': platform.platform(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'results': dict((result.name, result.as_dict()) for result in results)}
+    with open(path, 'w') as baseline:
+        json.dump(data, baseline, indent=2, sort_keys=True)
+
+def compare(results, path, threshold=0.10):
+    """Compare results against the baseline in path, returns the list of regressions found"""
+    with open(path) as baseline:
+        data = json.load(baseline)
+    base = data['results']
+    regressions = []
+    for result in results:
+        if result.name not in base:
+            continue
+        old = Result(result.name, **base[result.name])
+        if result.per_second < old.per_second * (1 - threshold):
+            regressions.append('{0}: throughput {1:.0f} msg/s, was {2:.0f}'.format(result.name, result.per_second, old.per_second))
+        # p99 is reported, but too noisy on a shared machine to compare
+        if result.p50_us > old.p50_us * (1 + threshold) + 0.5:
+            regressions.append('{0}: p50 {1:.2f} us, was {2:.2f}'.format(result.name, result.p50_us, old.p50_us))
+        if result.peak_bytes > old.peak_bytes * (1 + threshold) + 256:
+            regressions.append('{0}: peak memory {1} B, was {2}'.format(result.name, result.peak_bytes, old.peak_bytes))
+        if result.retained_blocks > old.retained_blocks + 0.5:
+            regressions.append('{0}: retains {1:.2f} blocks/msg, was {2:.2f}'.format(result.name, result.retained_blocks, old.retained_blocks))
+        if result.syscalls > old.syscalls + 0.01:
+            regressions.append('{0}: {1:.2f} syscalls/msg, was {2:.2f}'.format(result.name, result.syscalls, old.syscalls))
+    return regressions
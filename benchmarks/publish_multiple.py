@@ -0,0 +1,51 @@
+"""Time paho.mqtt.publish.multiple() pushing a batch of decoded device states
+
+The simulator answers every QoS 1 publish after --rtt seconds, so with a
+window of 1 the batch takes about one round trip per message and with a
+larger window about one round trip in all.
+
+    python -m benchmarks.publish_multiple --messages 200 --rtt 0.005 --windows 1,20,200
+"""
+
+import argparse, json, time
+
+from paho.mqtt import publish
+
+from benchmarks.simulator import DysonSimulator, SimulatedDevice, hashed_password
+from value_types import decode_message
+
+SERIAL = 'SIM-00000'
+
+def messages(count, qos):
+    """count state messages as a plugin pushing decoded device states to a broker would send them"""
+    device = SimulatedDevice(SERIAL, 'password')
+    state = decode_message(json.loads(device.current_state()))
+    payload = json.dumps(dict((name, str(getattr(state, name))) for name in state.__slots__))
+    return [{'topic': 'dyson/{0}/state/{1}'.format(SERIAL, n), 'payload': payload, 'qos': qos} for n in range(count)]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time publish.multiple() with different windows')
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--rtt', type=float, default=0.005, help='seconds before the broker acknowledges a publish')
+    parser.add_argument('--qos', type=int, choices=(1, 2), default=1)
+    parser.add_argument('--windows', default='1,20,200', help='comma separated windows to try')
+    args = parser.parse_args(argv)
+
+    simulator = DysonSimulator(ack_latency=args.rtt)
+    simulator.add_device(SERIAL, 'password')
+    simulator.start()
+    host, port = simulator.address
+    auth = {'username': SERIAL, 'password': hashed_password('password')}
+    batch = messages(args.messages, args.qos)
+    try:
+        for window in [int(window) for window in args.windows.split(',')]:
+            start = time.perf_counter()
+            publish.multiple(batch, host, port, auth=auth, window=window)
+            seconds = time.perf_counter() - start
+            print('window {0:>5}: {1} messages in {2:.3f} s, {3:.1f} round trips'.format(
+                window, args.messages, seconds, seconds / args.rtt if args.rtt else 0.0))
+    finally:
+        simulator.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,486 @@
+"""Simulated Dyson Pure Link devices for load testing without hardware
+
+A Dyson device runs its own MQTT broker, the plugin connects to it with the
+serial as user name and the hashed password, subscribes to
+<type>/<serial>/status/current and publishes requests on
+<type>/<serial>/command. DysonSimulator is such a broker for any number of
+devices at once, the device is picked by the user name of the connection.
+It runs in a single thread on a selector and can delay (latency, jitter) or
+drop (loss) the device answers.
+
+    simulator = DysonSimulator(latency=0.05, jitter=0.02, loss=0.01)
+    for n in range(1000):
+        simulator.add_device('SIM-%04d' % n, 'password')
+    simulator.start()
+    ... connect DysonPureLinkDevice('password', 'SIM-0000', '475', *simulator.address) ...
+    simulator.stop()
+
+Every simulated device connection is a socket, for thousands of devices raise
+the open files limit (ulimit -n) of the process running the simulator and the
+one running the clients.
+
+Run standalone with python -m benchmarks.simulator --help
+"""
+
+import argparse, base64, hashlib, heapq, itertools, json, random, selectors, socket, struct, threading, time
+
+DEFAULT_STATE = {
+    'fmod': 'FAN', 'fnst': 'FAN', 'fnsp': '0004', 'qtar': '0003', 'oson': 'ON', 'rhtm': 'ON',
+    'filf': '3171', 'ercd': 'NONE', 'nmod': 'OFF', 'wacd': 'NONE'}
+
+DEFAULT_SENSORS = {'tact': '2950', 'hact': '0045', 'pact': '0004', 'vact': '0002', 'sltm': 'OFF'}
+
+CONNACK_ACCEPTED = 0
+CONNACK_REFUSED_BAD_USERNAME_PASSWORD = 4
+
+def hashed_password(password):
+    """The password as the plugin sends it, see DysonPureLinkDevice._hashed_password"""
+    return base64.b64encode(hashlib.sha512(password.encode('utf-8')).digest()).decode('utf-8')
+
+def _timestamp():
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+
+class SimulatedDevice(object):
+    """State of one simulated purifier and the messages it sends"""
+
+    def __init__(self, serial, password, device_type='475', seed=None):
+        self.serial = serial
+        self.device_type = device_type
+        self.password_hash = hashed_password(password)
+        self.state = dict(DEFAULT_STATE)
+        self.sensors = dict(DEFAULT_SENSORS)
+        self._random = random.Random(seed if seed is not None else serial)
+
+    @property
+    def command_topic(self):
+        return '{0}/{1}/command'.format(self.device_type, self.serial)
+
+    @property
+    def status_topic(self):
+        return '{0}/{1}/status/current'.format(self.device_type, self.serial)
+
+    def current_state(self):
+        return json.dumps({
+            'msg': 'CURRENT-STATE', 'time': _timestamp(), 'mode-reason': 'LAPP', 'state-reason': 'MODE',
+            'dial': 'OFF', 'rssi': '-%d' % self._random.randint(30, 70),
+            'product-state': self.state,
+            'scheduler': {'srsc': 'a58d', 'dstv': '0001', 'tzid': '0001'}})
+
+    def sensor_data(self):
+        """Environmental sensor message, the readings drift a little every time"""
+        sensors = self.sensors
+        sensors['tact'] = '%04d' % min(max(int(sensors['tact']) + self._random.randint(-2, 2), 2800), 3100)
+        sensors['hact'] = '%04d' % min(max(int(sensors['hact']) + self._random.randint(-1, 1), 20), 80)
+        sensors['pact'] = '%04d' % min(max(int(sensors['pact']) + self._random.randint(-1, 1), 0), 9)
+        sensors['vact'] = '%04d' % min(max(int(sensors['vact']) + self._random.randint(-1, 1), 0), 9)
+        return json.dumps({'msg': 'ENVIRONMENTAL-CURRENT-SENSOR-DATA', 'time': _timestamp(), 'data': sensors})
+
+    def state_set(self, data):
+        """Apply a STATE-SET, returns the STATE-CHANGE with [old, new] values of all fields"""
+        old = dict(self.state)
+        for key, value in data.items():
+            if key in self.state:
+                # fan mode ON is reported as FAN
+                self.state[key] = 'FAN' if key == 'fmod' and value == 'ON' else value
+        return json.dumps({
+            'msg': 'STATE-CHANGE', 'time': _timestamp(), 'mode-reason': 'LAPP', 'state-reason': 'MODE',
+            'product-state': {key: [old[key], value] for key, value in self.state.items()},
+            'scheduler': {'srsc': 'a58d', 'dstv': '0001', 'tzid': '0001'}})
+
+    def handle(self, payload):
+        """Answer a command payload, returns the list of messages to publish on status_topic"""
+        message = json.loads(payload)
+        if message.get('msg') == 'REQUEST-CURRENT-STATE':
+            return [self.current_state(), self.sensor_data()]
+        if message.get('msg') == 'STATE-SET':
+            return [self.state_set(message.get('data', {}))]
+        return []
+
+class SimulatorStatistics(object):
+    """Message counters of a DysonSimulator"""
+
+    def __init__(self):
+        self.connections = 0
+        self.refused = 0
+        self.requests = 0
+        self.responses = 0
+        self.dropped = 0
+        self.pushed = 0
+
+    def __repr__(self):
+        return 'SimulatorStatistics: connections: {0}, refused: {1}, requests: {2}, responses: {3}, dropped: {4}, pushed: {5}'.format(
+            self.connections, self.refused, self.requests, self.responses, self.dropped, self.pushed)
+
+class _Connection(object):
+
+    __slots__ = 'sock', 'inbuf', 'outbuf', 'device', 'writing', 'closed'
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.device = None
+        self.writing = False
+        self.closed = False
+
+class DysonSimulator(object):
+    """MQTT broker acting as any number of Dyson devices, see the module documentation.
+
+    latency: seconds before a device answers a request
+    jitter: the latency varies up to this many seconds either way
+    loss: probability (0..1) that an answer is never sent
+    ack_latency: seconds before a PUBACK or PUBREC goes out, the round trip of
+        a broker further away
+    push_interval: seconds between unsolicited sensor messages of every
+        connected device, None to only answer requests
+    check_password: refuse connections with a wrong password, like the devices do"""
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, loss=0.0, push_interval=None,
+                 check_password=True, seed=None, ack_latency=0.0):
+        self.latency = latency
+        self.ack_latency = ack_latency
+        self.jitter = jitter
+        self.loss = loss
+        self.push_interval = push_interval
+        self.check_password = check_password
+        self.statistics = SimulatorStatistics()
+        self.devices = {}
+        self._random = random.Random(seed)
+        self._selector = selectors.DefaultSelector()
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((host, port))
+        self._listener.listen(1024)
+        self._listener.setblocking(False)
+        self._selector.register(self._listener, selectors.EVENT_READ, None)
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, self._wake_r)
+        self._connections = set()
+        self._scheduled = []
+        self._sequence = itertools.count()
+        self._next_push = None
+        self._thread = None
+        self._running = False
+
+    @property
+    def address(self):
+        """(host, port) to connect the devices to"""
+        return self._listener.getsockname()[:2]
+
+    def add_device(self, serial, password, device_type='475'):
+        """Simulate one more device, returns its SimulatedDevice"""
+        device = SimulatedDevice(serial, password, device_type, seed=self._random.random())
+        self.devices[serial] = device
+        return device
+
+    def start(self):
+        """Run the simulator in a background thread"""
+        self._running = True
+        self._thread = threading.Thread(target=self.serve_forever, name='dyson-simulator')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread and close all connections"""
+        self._running = False
+        try:
+            self._wake_w.send(b'x')
+        except socket.error:
+            pass
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for connection in list(self._connections):
+            self._close(connection)
+        self._selector.close()
+        self._listener.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+    def drop_connections(self):
+        """Close all device connections, from the simulator thread, like a Wi-Fi outage would"""
+        self._call_soon(lambda: [self._close(connection) for connection in list(self._connections)])
+
+    def serve_forever(self):
+        self._running = True
+        if self.push_interval:
+            self._next_push = time.monotonic() + self.push_interval
+        while self._running:
+            for key, mask in self._selector.select(self._timeout()):
+                if key.data is None:
+                    self._accept()
+                elif key.data is self._wake_r:
+                    try:
+                        self._wake_r.recv(4096)
+                    except socket.error:
+                        pass
+                else:
+                    if mask & selectors.EVENT_READ:
+                        self._read(key.data)
+                    if mask & selectors.EVENT_WRITE:
+                        self._flush(key.data)
+            self._run_scheduled()
+            self._push()
+
+    def _timeout(self):
+        now = time.monotonic()
+        due = []
+        if self._scheduled:
+            due.append(self._scheduled[0][0])
+        if self._next_push is not None:
+            due.append(self._next_push)
+        if not due:
+            return 1.0
+        return min(max(min(due) - now, 0.0), 1.0)
+
+    def _call_soon(self, func):
+        heapq.heappush(self._scheduled, (0.0, next(self._sequence), None, func))
+        try:
+            self._wake_w.send(b'x')
+        except socket.error:
+            pass
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self._listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = _Connection(sock)
+            self._connections.add(connection)
+            self._selector.register(sock, selectors.EVENT_READ, connection)
+
+    def _close(self, connection):
+        if connection.closed:
+            return
+        connection.closed = True
+        self._connections.discard(connection)
+        try:
+            self._selector.unregister(connection.sock)
+        except (KeyError, ValueError):
+            pass
+        connection.sock.close()
+
+    def _read(self, connection):
+        try:
+            data = connection.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            data = b''
+        if not data:
+            self._close(connection)
+            return
+
+        buf = connection.inbuf
+        buf += data
+        pos = 0
+        while not connection.closed:
+            header = _header(buf, pos)
+            if header is None:
+                if len(buf) - pos > 5:
+                    # more than 4 remaining length bytes
+                    self._close(connection)
+                break
+            remaining, size = header
+            end = pos + size + remaining
+            if len(buf) < end:
+                break
+            self._packet(connection, buf[pos], bytes(buf[pos + size:end]))
+            pos = end
+        del buf[:pos]
+
+    def _packet(self, connection, header, body):
+        command = header & 0xF0
+        if command == 0x10:
+            self._connect(connection, body)
+        elif connection.device is None:
+            self._close(connection)
+        elif command == 0x30:
+            self._publish(connection, header, body)
+        elif command == 0x60:
+            # PUBREL of a QoS 2 publish
+            self._send(connection, b'\x70\x02' + body[:2])
+        elif command == 0x80:
+            topics = []
+            pos = 2
+            while pos < len(body):
+                length = struct.unpack_from('!H', body, pos)[0]
+                topics.append(min(body[pos + 2 + length], 1))
+                pos += 3 + length
+            self._send(connection, b'\x90' + _length(2 + len(topics)) + body[:2] + bytes(topics))
+        elif command == 0xA0:
+            self._send(connection, b'\xb0\x02' + body[:2])
+        elif command == 0xC0:
+            self._send(connection, b'\xd0\x00')
+        elif command == 0xE0:
+            self._close(connection)
+
+    def _connect(self, connection, body):
+        pos = 2 + struct.unpack_from('!H', body, 0)[0]
+        flags = body[pos + 1]
+        pos += 4
+        fields = []
+        while pos < len(body):
+            length = struct.unpack_from('!H', body, pos)[0]
+            fields.append(body[pos + 2:pos + 2 + length].decode('utf-8'))
+            pos += 2 + length
+        # client id, [will topic, will message], [user name], [password]
+        fields = fields[3:] if flags & 0x04 else fields[1:]
+        username = fields[0] if flags & 0x80 and fields else None
+        password = fields[1] if flags & 0x40 and len(fields) > 1 else None
+
+        device = self.devices.get(username)
+        if device is None or (self.check_password and password != device.password_hash):
+            self.statistics.refused += 1
+            self._send(connection, bytes([0x20, 2, 0, CONNACK_REFUSED_BAD_USERNAME_PASSWORD]))
+            self._flush(connection)
+            self._close(connection)
+            return
+        self.statistics.connections += 1
+        connection.device = device
+        self._send(connection, bytes([0x20, 2, 0, CONNACK_ACCEPTED]))
+
+    def _publish(self, connection, header, body):
+        qos = (header >> 1) & 3
+        length = struct.unpack_from('!H', body, 0)[0]
+        topic = body[2:2 + length].decode('utf-8')
+        pos = 2 + length
+        if qos:
+            mid = body[pos:pos + 2]
+            pos += 2
+            ack = (b'\x40\x02' if qos == 1 else b'\x50\x02') + mid
+            if self.ack_latency > 0:
+                heapq.heappush(self._scheduled, (time.monotonic() + self.ack_latency, next(self._sequence), None,
+                                                 lambda: self._send(connection, ack)))
+            else:
+                self._send(connection, ack)
+        device = connection.device
+        if topic != device.command_topic:
+            return
+        self.statistics.requests += 1
+        for message in device.handle(body[pos:]):
+            self._answer(connection, device, message)
+
+    def _answer(self, connection, device, message):
+        if self.loss and self._random.random() < self.loss:
+            self.statistics.dropped += 1
+            return
+        packet = _publish_packet(device.status_topic, message)
+        delay = self.latency
+        if self.jitter:
+            delay = max(delay + self._random.uniform(-self.jitter, self.jitter), 0.0)
+        if delay <= 0:
+            self.statistics.responses += 1
+            self._send(connection, packet)
+        else:
+            heapq.heappush(self._scheduled, (time.monotonic() + delay, next(self._sequence), connection, packet))
+
+    def _run_scheduled(self):
+        now = time.monotonic()
+        scheduled = self._scheduled
+        while scheduled and scheduled[0][0] <= now:
+            due, sequence, connection, packet = heapq.heappop(scheduled)
+            if connection is None:
+                packet()
+            elif not connection.closed:
+                self.statistics.responses += 1
+                self._send(connection, packet)
+
+    def _push(self):
+        if self._next_push is None or time.monotonic() < self._next_push:
+            return
+        self._next_push += self.push_interval
+        for connection in list(self._connections):
+            device = connection.device
+            if device is not None:
+                self.statistics.pushed += 1
+                self._send(connection, _publish_packet(device.status_topic, device.sensor_data()))
+
+    def _send(self, connection, packet):
+        if connection.closed:
+            return
+        connection.outbuf += packet
+        if not connection.writing:
+            self._flush(connection)
+
+    def _flush(self, connection):
+        if connection.closed:
+            return
+        try:
+            sent = connection.sock.send(connection.outbuf)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except socket.error:
+            self._close(connection)
+            return
+        del connection.outbuf[:sent]
+        writing = len(connection.outbuf) > 0
+        if writing != connection.writing:
+            connection.writing = writing
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE if writing else selectors.EVENT_READ
+            self._selector.modify(connection.sock, events, connection)
+
+def _header(buf, pos):
+    """(remaining length, fixed header size) of the packet at pos, None while incomplete"""
+    remaining, multiplier = 0, 1
+    for index in range(pos + 1, min(pos + 5, len(buf))):
+        byte = buf[index]
+        remaining += (byte & 127) * multiplier
+        if not byte & 128:
+            return remaining, index + 1 - pos
+        multiplier *= 128
+    return None
+
+def _length(remaining):
+    out = bytearray()
+    while True:
+        byte = remaining % 128
+        remaining //= 128
+        if remaining:
+            byte |= 0x80
+        out.append(byte)
+        if not remaining:
+            return bytes(out)
+
+def _publish_packet(topic, message):
+    topic = topic.encode('utf-8')
+    payload = message.encode('utf-8')
+    return b'\x30' + _length(2 + len(topic) + len(payload)) + struct.pack('!H', len(topic)) + topic + payload
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulate Dyson Pure Link devices on one MQTT port')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--devices', type=int, default=1)
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--type', default='475')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--push-interval', type=float, default=None)
+    parser.add_argument('--ack-latency', type=float, default=0.0)
+    args = parser.parse_args(argv)
+
+    simulator = DysonSimulator(args.host, args.port, args.latency, args.jitter, args.loss, args.push_interval,
+                               ack_latency=args.ack_latency)
+    for n in range(args.devices):
+        simulator.add_device('SIM-%05d' % n, args.password, args.type)
+    host, port = simulator.address
+    print('Simulating {0} devices SIM-00000.. on {1}:{2}, plugin "More devices" entries look like: SIM-00001,{1},{3},{4},{2}'.format(
+        args.devices, host, port, args.password, args.type))
+    simulator.start()
+    try:
+        while True:
+            time.sleep(10)
+            print(simulator.statistics)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.stop()
+
+if __name__ == '__main__':
+    main()
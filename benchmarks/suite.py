@@ -0,0 +1,364 @@
+"""Benchmarks of the MQTT client hot paths and the plugin update cycle
+
+    python -m benchmarks.suite                      run all and print the results
+    python -m benchmarks.suite --save base.json     also store them as baseline
+    python -m benchmarks.suite --compare base.json  flag regressions, exit code 1 if any
+    python -m benchmarks.suite --only matcher       only the benchmarks whose name contains 'matcher'
+
+The client benchmarks run over a local socket pair, no broker needed.
+"""
+
+import argparse, base64, hashlib, json, os, shutil, socket, ssl, struct, subprocess, sys, tempfile, threading
+
+from benchmarks import fake_domoticz
+fake_domoticz.install()
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.matcher import MQTTMatcher
+from paho.mqtt.timers import TimerHeap
+from paho.mqtt import tls_sessions
+
+import plugin
+from benchmarks import harness
+from benchmarks.simulator import SimulatedDevice, _publish_packet
+from value_types import decode_message
+
+SERIAL = 'NN2-EU-KCA0000A'
+STATUS_TOPIC = '475/' + SERIAL + '/status/current'
+COMMAND_TOPIC = '475/' + SERIAL + '/command'
+
+def loopback_client():
+    """Client 'connected' to one end of a socket pair, returns (client, counting socket, peer socket)"""
+    ours, peer = socket.socketpair()
+    ours.setblocking(False)
+    peer.setblocking(False)
+    counting = harness.CountingSocket(ours)
+    client = mqtt.Client(client_id='benchmark')
+    client._sock = counting
+    client._sock_sendmsg_ok = hasattr(ours, 'sendmsg')
+    client._state = mqtt.mqtt_cs_connected
+    return client, counting, peer
+
+def _accept_websocket(peer):
+    """Answer the WebSocket upgrade request arriving on peer"""
+    request = b''
+    while not request.endswith(b'\r\n\r\n'):
+        request += peer.recv(1)
+    key = [line.split(b': ', 1)[1] for line in request.split(b'\r\n') if line.lower().startswith(b'sec-websocket-key')][0]
+    accept = base64.b64encode(hashlib.sha1(key + b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11').digest())
+    peer.sendall(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                 b'Sec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+
+def websocket_client():
+    """Like loopback_client(), with the client talking WebSocket to the peer"""
+    ours, peer = socket.socketpair()
+    counting = harness.CountingSocket(ours)
+    server = threading.Thread(target=_accept_websocket, args=(peer,))
+    server.start()
+    wrapper = mqtt.WebsocketWrapper(counting, 'localhost', 80, False, '/mqtt', None)
+    server.join()
+    ours.setblocking(False)
+    peer.setblocking(False)
+    client = mqtt.Client(client_id='benchmark', transport='websockets')
+    client._sock = wrapper
+    client._state = mqtt.mqtt_cs_connected
+    return client, counting, peer
+
+_drain_buffer = bytearray(1 << 16)
+
+def drain(sock):
+    try:
+        while sock.recv_into(_drain_buffer):
+            pass
+    except (BlockingIOError, InterruptedError):
+        pass
+
+def bench_publish(count):
+    client, counting, peer = loopback_client()
+    payload = SimulatedDevice(SERIAL, 'pw').current_state()
+
+    def publish():
+        client.publish(COMMAND_TOPIC, payload)
+
+    return [harness.measure('client.publish qos0', publish, count, after=lambda: drain(peer), sockets=[counting])]
+
+def bench_read(count):
+    client, counting, peer = loopback_client()
+    received = [0]
+    client.on_message = lambda client, userdata, message: received.__setitem__(0, received[0] + 1)
+    device = SimulatedDevice(SERIAL, 'pw')
+    state = _publish_packet(STATUS_TOPIC, device.current_state())
+    sensors = _publish_packet(STATUS_TOPIC, device.sensor_data())
+    batch = (state + sensors) * 8
+
+    def feed():
+        peer.sendall(state)
+
+    def feed_batch():
+        peer.sendall(batch)
+
+    return [
+        harness.measure('client.loop_read publish', client.loop_read, count, before=feed, sockets=[counting]),
+        harness.measure('client.loop_read 16 publishes', client.loop_read, count // 16, before=feed_batch, batch=16, sockets=[counting]),
+    ]
+
+def bench_inflight(count):
+    """PUBACKs arriving while far more QoS 1 messages are queued than the inflight window holds"""
+    # every queued message needs its own packet id, 1..65535
+    count = min(count, 40000)
+    results = []
+    for window in (20, 1000):
+        client, counting, peer = loopback_client()
+        client.max_inflight_messages_set(window)
+        # the acks of warm up, timed and memory runs all release a queued message
+        total = count + max(count // 10, 100) + 1010 + window
+        for _ in range(max(total, 10000)):
+            client.publish(COMMAND_TOPIC, b'{"msg": "STATE-SET"}', qos=1)
+        drain(peer)
+        mids = iter(range(1, total + 1))
+
+        def ack():
+            peer.sendall(struct.pack('!BBH', 0x40, 2, next(mids)))
+
+        results.append(harness.measure('client.inflight puback, window {0}, {1} queued'.format(window, len(client._out_messages)),
+                                       client.loop_read, count, before=ack, after=lambda: drain(peer), sockets=[counting]))
+    return results
+
+def bench_housekeeping(count):
+    """Keepalive and retry bookkeeping of 200 connections with 50 unacknowledged messages each:
+    the loop_misc() sweep a loop used to make every second, against a look at the shared timers"""
+    count = min(count, 2000)
+    clients, peers = [], []
+    timers = TimerHeap()
+    for _ in range(200):
+        client, counting, peer = loopback_client()
+        client.max_inflight_messages_set(0)
+        for _ in range(50):
+            client.publish(COMMAND_TOPIC, b'{"msg": "STATE-SET"}', qos=1)
+        drain(peer)
+        clients.append(client)
+        peers.append(peer)
+
+    def sweep():
+        for client in clients:
+            client.loop_misc()
+
+    def look():
+        timers.run_due(mqtt.time_func())
+        timers.next_deadline()
+
+    results = [harness.measure('housekeeping loop_misc, 200 clients', sweep, count, warmup=10)]
+    for client in clients:
+        client._timers_set(timers)
+    results.append(harness.measure('housekeeping timers, 200 clients', look, count, warmup=10))
+    for client in clients:
+        client._timers_set(None)
+    for peer in peers:
+        peer.close()
+    return results
+
+def bench_websocket(count):
+    """Publishing and receiving multi-KB messages over WebSocket, next to the same over plain TCP"""
+    count = min(count, 5000)
+    results = []
+    for size in (4096, 65536):
+        payload = 'x' * size
+        packet = _publish_packet(STATUS_TOPIC, payload)
+        for transport, connect in (('tcp', loopback_client), ('websockets', websocket_client)):
+            client, counting, peer = connect()
+            client.on_message = lambda client, userdata, message: None
+            if transport == 'websockets':
+                # frames from a broker are not masked, these are to measure the unmasking
+                incoming = client._sock._create_frame(mqtt.WebsocketWrapper.OPCODE_BINARY, bytearray(packet))
+            else:
+                incoming = packet
+
+            def publish():
+                client.publish(COMMAND_TOPIC, payload)
+
+            def feed():
+                peer.sendall(incoming)
+
+            results.append(harness.measure('{0} publish {1} KB'.format(transport, size // 1024), publish, count,
+                                           warmup=100, after=lambda: drain(peer), sockets=[counting]))
+            results.append(harness.measure('{0} loop_read {1} KB'.format(transport, size // 1024), client.loop_read, count,
+                                           warmup=100, before=feed, sockets=[counting]))
+            peer.close()
+    return results
+
+def _serve_tls(listener, context, stop):
+    """Minimal TLS broker: handshake, CONNECT, CONNACK, one connection after the other until stop is set"""
+    previous = None
+    listener.settimeout(0.1)
+    while not stop.is_set():
+        try:
+            conn, _ = listener.accept()
+        except socket.timeout:
+            continue
+        conn.settimeout(None)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if previous is not None:
+            previous.close()
+        try:
+            conn = context.wrap_socket(conn, server_side=True)
+            header = conn.recv(2)
+            conn.recv(header[1])
+            conn.sendall(b'\x20\x02\x00\x00')
+        except (OSError, IndexError):
+            conn.close()
+            conn = None
+        previous = conn
+    if previous is not None:
+        previous.close()
+
+def bench_tls_reconnect(count):
+    """Reconnecting over TLS with a full handshake every time, against resuming the last session"""
+    if shutil.which('openssl') is None:
+        print('tls.reconnect skipped, needs the openssl command to make a certificate')
+        return []
+    count = min(count, 500)
+    folder = tempfile.mkdtemp(prefix='benchmark-tls-')
+    cert, key = os.path.join(folder, 'cert.pem'), os.path.join(folder, 'key.pem')
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                           '-subj', '/CN=127.0.0.1', '-addext', 'subjectAltName=IP:127.0.0.1',
+                           '-keyout', key, '-out', cert], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    server_context.load_cert_chain(cert, key)
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(8)
+    stop = threading.Event()
+    server = threading.Thread(target=_serve_tls, args=(listener, server_context, stop))
+    server.start()
+
+    results = []
+    try:
+        for resume in (False, True):
+            client = mqtt.Client(client_id='benchmark')
+            client.tls_set(ca_certs=cert, shared_context=True)
+            client.connect('127.0.0.1', listener.getsockname()[1])
+            sessions = client._tls_sessions
+
+            def reconnect():
+                if not resume:
+                    sessions.forget('127.0.0.1', listener.getsockname()[1])
+                client.reconnect()
+                while client._state != mqtt.mqtt_cs_connected:
+                    client.loop(1.0)
+
+            before = client.tls_session_statistics()
+            results.append(harness.measure('tls.reconnect ' + ('resumed' if resume else 'full handshake'),
+                                           reconnect, count, warmup=10))
+            after = client.tls_session_statistics()
+            print('  {0} full, {1} resumed handshakes'.format(after['full'] - before['full'], after['resumed'] - before['resumed']))
+            client.disconnect()
+    finally:
+        stop.set()
+        server.join()
+        listener.close()
+        tls_sessions.registry.clear()
+        shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+def bench_matcher(count):
+    exact = MQTTMatcher()
+    for n in range(20):
+        exact['475/NN2-EU-KCA%04dA/status/current' % n] = n
+    wildcard = MQTTMatcher()
+    for n in range(20):
+        wildcard['475/NN2-EU-KCA%04dA/status/current' % n] = n
+    wildcard['475/+/status/#'] = 'all'
+    topic = '475/NN2-EU-KCA0007A/status/current'
+
+    def match(matcher):
+        def operation():
+            for value in matcher.iter_match(topic):
+                pass
+        return operation
+
+    return [
+        harness.measure('matcher.iter_match exact', match(exact), count),
+        harness.measure('matcher.iter_match wildcard', match(wildcard), count),
+    ]
+
+def bench_decode(count):
+    device = SimulatedDevice(SERIAL, 'pw')
+    state = device.current_state().encode('utf-8')
+    change = device.state_set({'fnsp': '0007'}).encode('utf-8')
+    sensors = device.sensor_data().encode('utf-8')
+    return [
+        harness.measure('decode CURRENT-STATE', lambda: decode_message(json.loads(state)), count),
+        harness.measure('decode STATE-CHANGE', lambda: decode_message(json.loads(change)), count),
+        harness.measure('decode SENSOR-DATA', lambda: decode_message(json.loads(sensors)), count),
+    ]
+
+def bench_update_all_devices(count):
+    plugin.Devices = fake_domoticz.Devices
+    plugin.Parameters = {'Mode5': '3'}
+    dyson = plugin.DysonPureLink()
+    member = plugin.FleetMember(0, 'pw', SERIAL, '475', '127.0.0.1', 1883, None)
+    dyson.createDevices(member)
+
+    device = SimulatedDevice(SERIAL, 'pw')
+    state, sensors = device.current_state(), device.sensor_data()
+    # same values in new records, as every poll of an idle device brings
+    quiet = [(decode_message(json.loads(state)), decode_message(json.loads(sensors))) for _ in range(2)]
+    busy = []
+    for speed in ('0003', '0008'):
+        device.state_set({'fnsp': speed})
+        busy.append((decode_message(json.loads(device.current_state())), decode_message(json.loads(device.sensor_data()))))
+
+    def update(records):
+        position = [0]
+        def operation():
+            position[0] ^= 1
+            member.state_data, member.sensor_data = records[position[0]]
+            dyson.updateAllDevices(member)
+        return operation
+
+    return [
+        harness.measure('plugin.updateAllDevices changed', update(busy), count),
+        harness.measure('plugin.updateAllDevices unchanged', update(quiet), count),
+    ]
+
+BENCHMARKS = [
+    ('client.publish', bench_publish),
+    ('client.loop_read', bench_read),
+    ('client.inflight', bench_inflight),
+    ('housekeeping', bench_housekeeping),
+    ('websocket', bench_websocket),
+    ('tls.reconnect', bench_tls_reconnect),
+    ('matcher.iter_match', bench_matcher),
+    ('decode', bench_decode),
+    ('plugin.updateAllDevices', bench_update_all_devices),
+]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the MQTT client and plugin hot paths')
+    parser.add_argument('--count', type=int, default=20000, help='operations per benchmark')
+    parser.add_argument('--only', default='', help='only run the benchmarks whose name contains this')
+    parser.add_argument('--save', metavar='FILE', help='store the results as baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare against a stored baseline')
+    parser.add_argument('--threshold', type=float, default=0.10, help='allowed slow down before flagging, default 0.10')
+    args = parser.parse_args(argv)
+
+    results = []
+    for name, benchmark in BENCHMARKS:
+        if args.only not in name:
+            continue
+        for result in benchmark(args.count):
+            print(result)
+            results.append(result)
+
+    if args.save:
+        harness.save(results, args.save)
+    if args.compare:
+        regressions = harness.compare(results, args.compare, args.threshold)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
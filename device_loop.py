@@ -0,0 +1,124 @@
+"""Shared network loop for many Dyson devices"""
+
+import random, socket, threading
+import paho.mqtt.client as mqtt
+from paho.mqtt.multiplexer import Multiplexer
+
+class DeviceLoop(Multiplexer):
+    """Drives the MQTT traffic of any number of paho clients from one thread,
+    instead of the thread per client that Client.loop_start() creates.
+    Clients that lose their connection are reconnected using their reconnect delays
+    (see Client.reconnect_delay_set), randomised so devices that dropped off together
+    don't all come back at the same moment. Reconnect attempts are timers on the
+    shared TimerHeap, like keepalives and message retries, so clients that are
+    connected cost nothing per loop. The attempt itself, which waits for the TCP
+    connection, runs in a thread of its own: a device that is switched off must
+    not hold up the traffic of the others."""
+
+    def __init__(self, timeout=1.0):
+        super(DeviceLoop, self).__init__()
+        self._timeout = timeout
+        self._reconnect = {}
+
+    def add(self, client):
+        """Start driving client, it must have been connected with connect() or connect_async()"""
+        state = _ReconnectState(client)
+        self._reconnect[client] = state
+        self.register(client)
+        self._schedule_check(state, mqtt.time_func())
+
+    def remove(self, client):
+        """Stop driving client"""
+        self.unregister(client)
+        state = self._reconnect.pop(client, None)
+        if state is not None and state.timer is not None:
+            state.timer.cancel()
+
+    def start(self):
+        self.loop_start()
+
+    def stop(self):
+        self.loop_stop()
+
+    def loop_forever(self, timeout=None):
+        super(DeviceLoop, self).loop_forever(self._timeout if timeout is None else timeout)
+
+    def _on_socket_close(self, client, userdata, sock):
+        super(DeviceLoop, self)._on_socket_close(client, userdata, sock)
+        state = self._reconnect.get(client)
+        if state is not None:
+            self._schedule_check(state, max(state.next_attempt, mqtt.time_func()))
+
+    def _schedule_check(self, state, deadline):
+        # one check per client at a time, a closed socket brings the next one forward
+        if state.timer is not None:
+            state.timer.cancel()
+        state.timer = self.timers.schedule(deadline, self._check, state)
+
+    def _check(self, state):
+        """Reconnect a client without connection, forget the back off once it is connected"""
+        state.timer = None
+        client = state.client
+        if self._reconnect.get(client) is not state:
+            return
+        if client.socket() is None:
+            if client._state == mqtt.mqtt_cs_disconnecting:
+                # disconnected on purpose
+                return
+            if state.connecting:
+                # the attempt under way schedules the next check
+                return
+            if state.delay is not None and mqtt.time_func() < state.next_attempt:
+                self._schedule_check(state, state.next_attempt)
+                return
+            state.connecting = True
+            threading.Thread(target=self._reconnect_client, args=(state,),
+                             name='dyson-reconnect', daemon=True).start()
+        elif client._state == mqtt.mqtt_cs_connected:
+            # only a CONNACK proves the device accepts us, a TCP connection alone doesn't
+            state.delay = None
+        else:
+            # waiting for the CONNACK
+            self._schedule_check(state, mqtt.time_func() + CONNACK_CHECK_INTERVAL)
+
+    def _reconnect_client(self, state):
+        """Reconnect attempt, in its own thread; the socket is registered through on_socket_open"""
+        try:
+            state.try_reconnect()
+        finally:
+            state.connecting = False
+        if self._reconnect.get(state.client) is not state:
+            # removed while connecting
+            if state.client not in self._reconnect:
+                state.client._sock_close()
+            return
+        # a connection now waits for its CONNACK, otherwise for the next attempt
+        self._schedule_check(state, state.next_attempt if state.client.socket() is None else mqtt.time_func())
+        self.wake()
+
+# Seconds between looks at a client that has a connection but no CONNACK yet
+CONNACK_CHECK_INTERVAL = 1.0
+
+class _ReconnectState(object):
+    """Reconnect bookkeeping for a client that lost its connection"""
+
+    __slots__ = 'client', 'delay', 'next_attempt', 'timer', 'connecting'
+
+    def __init__(self, client):
+        self.client = client
+        self.delay = None
+        self.next_attempt = 0
+        self.timer = None
+        self.connecting = False
+
+    def try_reconnect(self):
+        client = self.client
+        now = mqtt.time_func()
+        if self.delay is not None and now < self.next_attempt:
+            return
+        self.delay = client._reconnect_min_delay if self.delay is None else min(self.delay * 2, client._reconnect_max_delay)
+        self.next_attempt = now + random.uniform(self.delay / 2, self.delay)
+        try:
+            client.reconnect()
+        except (socket.error, OSError, mqtt.WebsocketConnectionError):
+            return
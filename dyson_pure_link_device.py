@@ -1,26 +1,211 @@
 """Dyson Pure Link Device Logic"""
 
-import base64, json, hashlib, os, time
+import base64, json, hashlib, os, time, threading
 import paho.mqtt.client as mqtt
-import Domoticz
+import plugin_log as log
 from queue import Queue, Empty
 
-from value_types import CONNECTION_STATE, DISCONNECTION_STATE, FanMode, StandbyMonitoring, ConnectionError, DisconnectionError, SensorsData, StateData
+from instrumentation import profiler, STAGE_PUBLISH, STAGE_ROUND_TRIP, STAGE_DECODE, STAGE_QUEUE_WAIT
+from value_types import CONNECTION_STATE, DISCONNECTION_STATE, FanMode, StandbyMonitoring, ConnectionError, DisconnectionError, SensorsData, StateData, decode_message
+
+# Seconds between reconnection attempts, doubled after each failed attempt up to the maximum
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 300
+# Seconds a TCP connect may take, a device on the local network answers far quicker than this
+CONNECT_TIMEOUT = 3
+
+# Seconds queue_command waits for more changes to send along in the same STATE-SET
+COMMAND_BATCH_WINDOW = 0.1
+
+def _chain(first, second):
+    """Callback calling both first and second, either may be None"""
+    if first is None or first == second:
+        return second
+    if second is None:
+        return first
+    def both(command):
+        first(command)
+        second(command)
+    return both
+
+class PendingCommand(object):
+    """STATE-SET command waiting for the STATE-CHANGE that confirms it"""
+
+    __slots__ = 'data', 'timeout', 'sent', 'deadline', 'latency', 'state', 'on_ack', 'on_timeout'
+
+    def __init__(self, data, timeout, on_ack=None, on_timeout=None):
+        self.data = data
+        self.timeout = timeout
+        self.sent = time.monotonic()
+        self.deadline = self.sent + timeout
+        self.latency = None
+        # StateData of the message that confirmed the command
+        self.state = None
+        self.on_ack = on_ack
+        self.on_timeout = on_timeout
+
+    def __repr__(self):
+        return 'PendingCommand: {0}, latency: {1}'.format(self.data, self.latency)
+
+    def merge(self, data, on_ack=None, on_timeout=None, timeout=None):
+        """Add the changes in data, later values win, and the callbacks of another caller"""
+        self.data.update(data)
+        self.on_ack = _chain(self.on_ack, on_ack)
+        self.on_timeout = _chain(self.on_timeout, on_timeout)
+        if timeout is not None and timeout > self.timeout:
+            self.timeout = timeout
+
+    def start(self):
+        """Start the timeout, when the command is published"""
+        self.sent = time.monotonic()
+        self.deadline = self.sent + self.timeout
+
+    def is_confirmed_by(self, product_state):
+        """True when product_state (of a state message) reports all values this command asked for"""
+        for key, value in self.data.items():
+            if key not in product_state:
+                return False
+            if self.normalise(StateData._get_field_value(product_state[key])) != self.normalise(value):
+                return False
+        return True
+
+    @staticmethod
+    def normalise(value):
+        """Device reports fan mode ON as FAN"""
+        value = str(value).upper()
+        return 'ON' if value == 'FAN' else value
+
+class Mailbox(object):
+    """Holds only the newest record received, with its receive time (time.monotonic()) and
+    sequence number. Readers wait for a record newer than the one they know of, older
+    records are replaced instead of queued up."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self.value = None
+        self.time = None
+        self.sequence = 0
+
+    def __repr__(self):
+        return 'Mailbox: {0}, received: {1}, sequence: {2}'.format(self.value, self.time, self.sequence)
+
+    def put(self, value):
+        with self._condition:
+            self.value = value
+            self.time = time.monotonic()
+            self.sequence += 1
+            self._condition.notify_all()
+
+    def get(self, timeout=None, after=None, newer_than=None):
+        """The newest record, once there is one with a sequence number above after and received after
+        newer_than (a time.monotonic() value). Waits at most timeout seconds, raises queue.Empty if none arrived"""
+        after = 0 if after is None else after
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.sequence > after and (newer_than is None or self.time > newer_than), timeout):
+                raise Empty
+            return self.value
+
+class CommandStatistics(object):
+    """Latency metric of acknowledged commands"""
+
+    def __init__(self):
+        self.acknowledged = 0
+        self.timed_out = 0
+        self.last_latency = None
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    def __repr__(self):
+        return 'CommandStatistics: acknowledged: {0}, timed out: {1}, latency last: {2}, mean: {3}, max: {4}'.format(
+            self.acknowledged, self.timed_out, self.last_latency, self.mean_latency, self.max_latency)
+
+    @property
+    def mean_latency(self):
+        return self.total_latency / self.acknowledged if self.acknowledged else None
+
+    def add(self, latency):
+        self.acknowledged += 1
+        self.last_latency = latency
+        self.total_latency += latency
+        if latency > self.max_latency:
+            self.max_latency = latency
+
+class ConnectionStatistics(object):
+    """Connection state metrics of a device"""
+
+    def __init__(self):
+        self.connects = 0
+        self.connections_lost = 0
+        self.refused = 0
+        self.last_return_code = None
+        self.connected_since = None
+        self.disconnected_since = None
+        self.downtime = 0.0
+
+    def __repr__(self):
+        return 'ConnectionStatistics: connects: {0}, lost: {1}, refused: {2}, last return code: {3}, up for: {4}, down time: {5}'.format(
+            self.connects, self.connections_lost, self.refused, self.last_return_code, self.uptime, self.total_downtime)
+
+    @property
+    def uptime(self):
+        """Seconds since the current connection was made, 0 when not connected"""
+        return time.monotonic() - self.connected_since if self.connected_since is not None else 0.0
+
+    @property
+    def total_downtime(self):
+        """Seconds spent disconnected between connections, including the current outage"""
+        if self.disconnected_since is None:
+            return self.downtime
+        return self.downtime + time.monotonic() - self.disconnected_since
+
+    def connected(self):
+        now = time.monotonic()
+        self.connects += 1
+        self.last_return_code = 0
+        if self.disconnected_since is not None:
+            self.downtime += now - self.disconnected_since
+            self.disconnected_since = None
+        self.connected_since = now
+
+    def connect_refused(self, return_code):
+        self.refused += 1
+        self.last_return_code = return_code
+
+    def disconnected(self, return_code):
+        if self.connected_since is None:
+            return
+        if return_code:
+            self.connections_lost += 1
+        self.connected_since = None
+        self.disconnected_since = time.monotonic()
 
 class DysonPureLinkDevice(object):
     """Plugin to connect to Dyson Pure Link device and get its sensors readings"""
 
-    def __init__(self, password, serialNumber, deviceType, ipAdress, portNum):
+    def __init__(self, password, serialNumber, deviceType, ipAdress, portNum, loop=None):
         self.client = None
+        self.loop = loop
         self.config = None
         self.connected = Queue()
         self.disconnected = Queue()
-        self.state_data_available = Queue()
-        self.sensor_data_available = Queue()
+        # newest records only: in push mode nobody reads the unsolicited messages
+        self.state_data_available = Mailbox()
+        self.sensor_data_available = Mailbox()
         self.sensor_data = None
         self.state_data = None
+        self.last_message_time = None
+        self.command_statistics = CommandStatistics()
+        self.connection_statistics = ConnectionStatistics()
+        self._update_callback = None
+        self._pending_commands = []
+        self._command_lock = threading.Lock()
+        self._batch = None
+        self._batch_timer = None
         self._is_connected = False
+        self._reconnecting = False
+        self._request_time = None
         self._password = password
+        self._password_hash = None
         self._serial_number = serialNumber
         self._device_type = deviceType
         self._ip_address = ipAdress
@@ -65,160 +250,370 @@ class DysonPureLinkDevice(object):
     #@staticmethod
     def on_connect(self, client, userdata, flags, return_code):
         """Static callback to handle on_connect event"""
-        Domoticz.Debug("dyson_pure_link_device: on_connect called")
+        log.debug("dyson_pure_link_device: on_connect called")
         # Connection is successful with return_code: 0
         if return_code:
+            userdata.connection_statistics.connect_refused(return_code)
             userdata.connected.put_nowait(False)
             raise ConnectionError(return_code)
 
-        # We subscribe to the status message
+        # We subscribe to the status message, also after every reconnect as the session is clean
         client.subscribe(userdata.device_status)
+        userdata.connection_statistics.connected()
+        userdata._is_connected = True
+        userdata._reconnecting = False
         userdata.connected.put_nowait(True)
 
     #@staticmethod
     def on_disconnect(self, client, userdata, return_code):
         """Static callback to handle on_disconnect event"""
-        Domoticz.Debug("dyson_pure_link_device: on_disconnect called")
-        self._is_connected = false
+        log.debug("dyson_pure_link_device: on_disconnect called")
+        self._is_connected = False
+        self.connection_statistics.disconnected(return_code)
         if return_code:
-            raise DisconnectionError(return_code)
+            # connection lost, the device loop reconnects the client
+            log.debug("dyson_pure_link_device: %s", DisconnectionError(return_code).message)
+            return
 
         userdata.disconnected.put_nowait(True)
 
     #@staticmethod
     def on_message(self, client, userdata, message):
         """Static callback to handle incoming messages"""
-        Domoticz.Debug("dyson_pure_link_device: onMessage called")
-        payload = message.payload.decode("utf-8")
-        json_message = json.loads(payload)
-        
-        if StateData.is_state_data(json_message):
-            userdata.state_data_available.put_nowait(StateData(json_message))
+        log.debug("dyson_pure_link_device: onMessage called")
+        start = time.monotonic() if profiler.enabled else 0.0
+        json_message = json.loads(message.payload)
+        data = decode_message(json_message)
+        state_data = None
+        sensor_data = None
+
+        if start:
+            end = time.monotonic()
+            profiler.record(STAGE_DECODE, start, end)
+            if userdata._request_time is not None and json_message.get('msg') == 'CURRENT-STATE':
+                profiler.record(STAGE_ROUND_TRIP, userdata._request_time, end)
+                userdata._request_time = None
+
+        if data is None:
+            return
+
+        if isinstance(data, StateData):
+            state_data = data
+            userdata.state_data_available.put(state_data)
+            userdata._acknowledge_commands(json_message['product-state'], state_data)
+        else:
+            sensor_data = data
+            # kept as last known reading, commands return it instead of asking the device again
+            userdata.sensor_data = sensor_data
+            userdata.sensor_data_available.put(sensor_data)
+
+        userdata.last_message_time = time.monotonic()
+        if userdata._update_callback is not None:
+            userdata._update_callback(state_data, sensor_data)
 
-        if SensorsData.is_sensors_data(json_message):
-            userdata.sensor_data_available.put_nowait(SensorsData(json_message))
+    def set_update_callback(self, callback):
+        """Register callback(state_data, sensor_data) called for every state or sensor message received.
+        One of both arguments is None when the message only carried the other. Runs on the MQTT thread."""
+        self._update_callback = callback
 
     def _request_state(self):
         """Publishes request for current state message"""
-        Domoticz.Debug("dyson_pure_link_device: _request_state called")
+        log.debug("dyson_pure_link_device: _request_state called")
         if self.client:
             command = json.dumps({
                     'msg': 'REQUEST-CURRENT-STATE',
                     'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())})
             
-            Domoticz.Debug("_request_state command built")
+            log.debug("_request_state command built")
+            start = time.monotonic() if profiler.enabled else 0.0
             self.client.publish(self.device_command, command);
+            if start:
+                profiler.record(STAGE_PUBLISH, start, time.monotonic())
+                self._request_time = start
 
-    def _change_state(self, data):
-        """Publishes request for change state message"""
-        Domoticz.Debug("dyson_pure_link_device: _change_state called")
-        if self.client:
-            
-            command = json.dumps({
-                'msg': 'STATE-SET',
-                'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
-                'mode-reason': 'LAPP',
-                'data': data
-            })
-            
-            Domoticz.Debug("we're gonna send command: " + command)
+    def poll_state(self):
+        """Request current state without waiting, the reply is delivered through the update callback"""
+        if self._is_connected:
+            self._request_state()
 
+    @staticmethod
+    def _state_set_command(data):
+        """Builds the STATE-SET message for data"""
+        return json.dumps({
+            'msg': 'STATE-SET',
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'mode-reason': 'LAPP',
+            'data': data
+        })
+
+    def _change_state(self, data, timeout=5):
+        """Publishes a STATE-SET for data and waits until the device confirms it.
+
+        Returns (state_data, sensor_data): the state from the confirming message and the last
+        sensor reading received, the device is not asked for its state again. None when not
+        connected or not confirmed within timeout seconds"""
+        log.debug("dyson_pure_link_device: _change_state called")
+        confirmed = threading.Event()
+        command = self.send_command(data, lambda command: confirmed.set(), timeout=timeout)
+        if command is None or not confirmed.wait(timeout):
+            return None
+        self.state_data = command.state
+        return (self.state_data, self.sensor_data)
+
+    def send_command(self, data, on_ack=None, on_timeout=None, timeout=5):
+        """Publishes a STATE-SET for data without waiting for the device.
+
+        on_ack(command) is called from the MQTT thread when a state message confirms the new values,
+        command.latency then holds the round-trip time. on_timeout(command) is called from
+        check_command_timeouts() when no confirmation arrived within timeout seconds.
+        Changes still waiting in queue_command are sent along.
+
+        Returns the PendingCommand, or None when not connected"""
+        log.debug("dyson_pure_link_device: send_command called")
+        return self.queue_command(data, on_ack, on_timeout, timeout, window=0)
+
+    def queue_command(self, data, on_ack=None, on_timeout=None, timeout=5, window=COMMAND_BATCH_WINDOW):
+        """Like send_command, but waits window seconds for more changes, e.g. the other commands
+        of a Domoticz scene, and sends all of them as one STATE-SET confirmed by one state message.
+
+        Returns the PendingCommand shared by the merged changes, or None when not connected"""
+        if not (self._is_connected and self.client):
+            return None
+        with self._command_lock:
+            if self._batch is None:
+                self._batch = PendingCommand({}, timeout)
+            pending = self._batch
+            pending.merge(data, on_ack, on_timeout, timeout)
+            if window > 0 and self._batch_timer is None:
+                if self.loop is not None:
+                    # the shared network thread publishes the batch, no thread per batch
+                    self._batch_timer = self.loop.timers.schedule(mqtt.time_func() + window, self.flush_commands)
+                    self.loop.wake()
+                else:
+                    self._batch_timer = threading.Timer(window, self.flush_commands)
+                    self._batch_timer.daemon = True
+                    self._batch_timer.start()
+        if window <= 0:
+            self.flush_commands()
+        return pending
+
+    def flush_commands(self):
+        """Publishes the changes queued by queue_command now"""
+        with self._command_lock:
+            pending, self._batch = self._batch, None
+            timer, self._batch_timer = self._batch_timer, None
+            if timer is not None:
+                timer.cancel()
+            if pending is None or self.client is None:
+                return
+            pending.start()
+            self._pending_commands.append(pending)
+            command = self._state_set_command(pending.data)
+            log.debug("we're gonna send command: %s", command)
+            # under the lock, so batches reach the device in the order they were made
             self.client.publish(self.device_command, command, 1)
 
-            self.state_data = self.state_data_available.get(timeout=5)
+    def _discard_batch(self):
+        with self._command_lock:
+            self._batch = None
+            if self._batch_timer is not None:
+                self._batch_timer.cancel()
+                self._batch_timer = None
+
+    def transaction(self):
+        """StateTransaction to collect changes and send them as one command"""
+        return StateTransaction(self)
+
+    def _acknowledge_commands(self, product_state, state_data=None):
+        """Completes pending commands confirmed by product_state, decoded as state_data, runs on the MQTT thread"""
+        if not self._pending_commands:
+            return
+        now = time.monotonic()
+        with self._command_lock:
+            acknowledged = [command for command in self._pending_commands if command.is_confirmed_by(product_state)]
+            if not acknowledged:
+                return
+            self._pending_commands = [command for command in self._pending_commands if command not in acknowledged]
+        for command in acknowledged:
+            command.latency = now - command.sent
+            command.state = state_data
+            self.command_statistics.add(command.latency)
+            if command.on_ack is not None:
+                command.on_ack(command)
+
+    def check_command_timeouts(self):
+        """Expires commands that were not confirmed in time, calling their on_timeout"""
+        if not self._pending_commands:
+            return
+        now = time.monotonic()
+        with self._command_lock:
+            expired = [command for command in self._pending_commands if command.deadline <= now]
+            if not expired:
+                return
+            self._pending_commands = [command for command in self._pending_commands if command.deadline > now]
+        for command in expired:
+            self.command_statistics.timed_out += 1
+            if command.on_timeout is not None:
+                command.on_timeout(command)
+
+    @property
+    def pending_command_count(self):
+        return len(self._pending_commands)
 
     def _hashed_password(self):
         """Hash password (found in manual) to a base64 encoded of its shad512 value"""
-        hash = hashlib.sha512()
-        hash.update(self.password.encode('utf-8'))
-        return base64.b64encode(hash.digest()).decode('utf-8')
-        
+        if self._password_hash is None:
+            hash = hashlib.sha512()
+            hash.update(self.password.encode('utf-8'))
+            self._password_hash = base64.b64encode(hash.digest()).decode('utf-8')
+        return self._password_hash
+
+    def _get_client(self):
+        """The MQTT client of this device, created once and reused for every (re)connection"""
+        if self.client is None:
+            self.client = mqtt.Client(clean_session=True, protocol=mqtt.MQTTv311, userdata=self)
+            self.client.username_pw_set(self.serial_number, self._hashed_password())
+            self.client.on_connect = self.on_connect
+            self.client.on_disconnect = self.on_disconnect
+            self.client.on_message = self.on_message
+            self.client.reconnect_delay_set(RECONNECT_MIN_DELAY, RECONNECT_MAX_DELAY)
+            self.client.connect_timeout_set(CONNECT_TIMEOUT)
+        return self.client
+
+    def _start_network(self, client):
+        if self.loop is not None:
+            self.loop.add(client)
+        else:
+            client.loop_start()
+
     def connect_device(self):
         """
         Connects to device using provided connection arguments
 
         Returns: True/False depending on the result of connection
         """
-        Domoticz.Debug("dyson_pure_link_device: connect_device called")
+        log.debug("dyson_pure_link_device: connect_device called")
 
-        self.client = mqtt.Client(clean_session=True, protocol=mqtt.MQTTv311, userdata=self)
-        self.client.username_pw_set(self.serial_number, self._hashed_password())
-        self.client.on_connect = self.on_connect
-        self.client.on_disconnect = self.on_disconnect
-        self.client.on_message = self.on_message
+        client = self._get_client()
+        self._drain(self.connected)
         try:
-            self.client.connect(self.ip_address, port=self.port_number)
-        except ConnectionRefusedError as e:
+            client.connect(self.ip_address, port=self.port_number)
+        except (ConnectionRefusedError, OSError) as e:
             self._is_connected = False
-            Domoticz.Debug("Connect device: Connection Refused")
+            log.limited(log.debug, ('connect', self.serial_number), "Connect device %s: %s", self.serial_number, e, interval=60)
             return False
 
-        self.client.loop_start()
+        self._start_network(client)
 
-        self._is_connected = self.connected.get(timeout=10)
-        Domoticz.Debug("dyson_pure_link_device: are we connected? " + str(self._is_connected))
+        try:
+            self._is_connected = self.connected.get(timeout=10)
+        except Empty:
+            self._is_connected = False
+        log.debug("dyson_pure_link_device: are we connected? %s", self._is_connected)
 
         if self._is_connected:
-            self._request_state()
-
-            self.state_data = self.state_data_available.get(timeout=5)
-            self.sensor_data = self.sensor_data_available.get(timeout=5)
+            try:
+                self._fetch_data()
+            except Empty:
+                # connected, but the device does not answer; the connection stays up and
+                # the heartbeat picks the device up once isConnected() reports it
+                log.limited(log.debug, ('no answer', self.serial_number), "Device %s connected but sent no state", self.serial_number, interval=60)
+                return False
 
             # Return True in case of successful connect and data retrieval
             return True
 
-        # If any issue occurred return False
-        self.client = None
+        # If any issue occurred return False, the client is kept for start_reconnect()
+        if self.loop is not None:
+            self.loop.remove(client)
+        else:
+            client.loop_stop()
+        client.disconnect()
         return False
 
+    def start_reconnect(self):
+        """Have the network loop (re)connect the device in the background, with exponential
+        back off between attempts. Returns immediately, on_connect reports the result."""
+        if self._is_connected or self._reconnecting:
+            return
+        log.debug("dyson_pure_link_device: start_reconnect called")
+        self._reconnecting = True
+        client = self._get_client()
+        client.connect_async(self.ip_address, port=self.port_number)
+        self._start_network(client)
+
+    @staticmethod
+    def _drain(queue):
+        while True:
+            try:
+                queue.get_nowait()
+            except Empty:
+                return
+
     def set_fan_mode(self, mode):
         """Changes fan mode: ON|OFF|AUTO"""
         if self._is_connected:
-            self._change_state({'fmod': mode})
+            return self._change_state({'fmod': mode})
 
     def set_fan_speed(self, speed):
         """Changes fan speed: 0001..0010|AUTO"""
         if self._is_connected:
-            self._change_state({'fnsp': speed})
+            return self._change_state({'fnsp': speed})
 
     def set_standby_monitoring(self, mode):
         """Changes standby monitoring: ON|OFF"""
         if self._is_connected:
-            self._change_state({'rhtm': mode})
+            return self._change_state({'rhtm': mode})
 
     def set_night_mode(self, mode):
         """Changes night mode: ON|OFF"""
         if self._is_connected:
-            self._change_state({'nmod': mode})
+            return self._change_state({'nmod': mode})
 
     def set_oscilation(self, mode):
         """Changes oscilation mode: ON|OFF"""
         if self._is_connected:
-            self._change_state({'oson': mode})
+            return self._change_state({'oson': mode})
 
     def get_data(self):
-        Domoticz.Debug("dyson_pure_link_device: get_data called")
+        log.debug("dyson_pure_link_device: get_data called")
         if self._is_connected:
-            self._request_state()
-
-            self.state_data = self.state_data_available.get(timeout=5)
-            self.sensor_data = self.sensor_data_available.get(timeout=5)
+            try:
+                self._fetch_data()
+            except Empty:
+                log.limited(log.debug, ('no answer', self.serial_number), "Device %s sent no state, using the last one", self.serial_number, interval=60)
+                return (self.state_data, self.sensor_data)
 
             # Return True in case of successful connect and data retrieval
-            #Domoticz.Debug("dyson_pure_link_device: get_data, state_data: " + str(self.state_data))
+            #log.debug("dyson_pure_link_device: get_data, state_data: %s", self.state_data)
             return (self.state_data, self.sensor_data) if self.has_valid_data else tuple()
 
-        # If any issue occurred return False
-        self.client = None
+        # Not connected: the client stays, the network loop reconnects it
         return False
 
+    def _fetch_data(self, timeout=5):
+        """Request the current state and wait for the answers, records received before the request don't count"""
+        state_after = self.state_data_available.sequence
+        sensor_after = self.sensor_data_available.sequence
+        self._request_state()
+
+        start = time.monotonic() if profiler.enabled else 0.0
+        self.state_data = self.state_data_available.get(timeout, after=state_after)
+        self.sensor_data = self.sensor_data_available.get(timeout, after=sensor_after)
+        if start:
+            profiler.record(STAGE_QUEUE_WAIT, start, time.monotonic())
+
+    def latest_data(self, newer_than=None, timeout=0):
+        """(state_data, sensor_data) last received, without asking the device. With newer_than
+        (a time.monotonic() value) waits up to timeout seconds for records received after it,
+        raises queue.Empty when they don't arrive"""
+        return (self.state_data_available.get(timeout, newer_than=newer_than),
+                self.sensor_data_available.get(timeout, newer_than=newer_than))
+
     def request_data(self):
         """send requets for new data to device"""
         if self._is_connected:
-            self._request_state()
-
-            self.state_data = self.state_data_available.get(timeout=5)
-            self.sensor_data = self.sensor_data_available.get(timeout=5)
+            self._fetch_data()
 
             # Return data in case of successful connect and data retrieval
             return (self.state_data, self.sensor_data) if self.has_valid_data else ('noValidData','noValidData')
@@ -227,12 +622,64 @@ class DysonPureLinkDevice(object):
         
     def disconnect_device(self):
         """Disconnects device and return the boolean result"""
-        Domoticz.Debug("pure link device class: disconnect_device")
+        log.debug("pure link device class: disconnect_device")
+        self._discard_batch()
         if self.client:
-            self.client.loop_stop()
-            self.client.disconnect()
+            if self.loop is not None:
+                self.client.disconnect()
+                self.loop.remove(self.client)
+            else:
+                self.client.loop_stop()
+                self.client.disconnect()
             
             # Wait until we get on disconnect message
             #self._is_connected = not(self.disconnected.get(timeout=10))
             self._is_connected = False
+            self._reconnecting = False
             return self._is_connected
+
+class StateTransaction(object):
+    """Changes collected to be sent as one STATE-SET:
+
+        device.transaction().fan_mode('ON').fan_speed('0004').oscillation('ON').send()
+    """
+
+    def __init__(self, device):
+        self._device = device
+        self.data = {}
+
+    def __repr__(self):
+        return 'StateTransaction: {0}'.format(self.data)
+
+    def set(self, field, value):
+        """Change a field by its code, e.g. set('fnsp', '0004')"""
+        self.data[field] = value
+        return self
+
+    def fan_mode(self, mode):
+        """ON|OFF|AUTO"""
+        return self.set('fmod', mode)
+
+    def fan_speed(self, speed):
+        """0001..0010|AUTO"""
+        return self.set('fnsp', speed)
+
+    def night_mode(self, mode):
+        """ON|OFF"""
+        return self.set('nmod', mode)
+
+    def oscillation(self, mode):
+        """ON|OFF"""
+        return self.set('oson', mode)
+
+    def standby_monitoring(self, mode):
+        """ON|OFF"""
+        return self.set('rhtm', mode)
+
+    def send(self, on_ack=None, on_timeout=None, timeout=5):
+        """Queue the changes without waiting for the device, see DysonPureLinkDevice.queue_command"""
+        return self._device.queue_command(dict(self.data), on_ack, on_timeout, timeout)
+
+    def commit(self, timeout=5):
+        """Send the changes and wait for the device to confirm them, see DysonPureLinkDevice._change_state"""
+        return self._device._change_state(dict(self.data), timeout)
@@ -0,0 +1,130 @@
+"""Opt-in timing of the request/response cycle
+
+Instrumented code checks profiler.enabled before taking any timestamp, so
+while profiling is off it costs a single attribute lookup:
+
+    start = time.monotonic() if profiler.enabled else 0.0
+    ... work ...
+    if start:
+        profiler.record(STAGE_DECODE, start, time.monotonic())
+
+The last spans are kept in a fixed-size ring buffer, every stage also adds
+to a histogram with power-of-two buckets from 1 us up.
+"""
+
+import threading, time
+from array import array
+
+STAGE_PUBLISH = 0       # publishing a state request
+STAGE_ROUND_TRIP = 1    # state request until the device's state message arrived
+STAGE_DECODE = 2        # parsing and decoding an incoming message
+STAGE_QUEUE_WAIT = 3    # waiting in get_data() for the state and sensor messages
+STAGE_GET_UPDATE = 4    # DysonWrapper.getUpdate() as a whole
+STAGE_UPDATE_DEVICE = 5 # UpdateDevice(), one Domoticz device
+
+STAGE_NAMES = ('publish', 'round trip', 'decode', 'queue wait', 'get update', 'update device')
+
+BUCKETS = 26 # 1 us .. 2^25 us (33 s) and longer
+
+class Histogram(object):
+    """Durations of one stage in power-of-two microsecond buckets"""
+
+    __slots__ = 'counts', 'count', 'total', 'maximum'
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, seconds):
+        self.counts[min(int(seconds * 1e6).bit_length(), BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.maximum:
+            self.maximum = seconds
+
+    def percentile(self, fraction):
+        """Upper bound in seconds of the bucket holding the fraction (0..1) of the durations"""
+        if not self.count:
+            return 0.0
+        wanted = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= wanted:
+                return min((1 << bucket) / 1e6, self.maximum)
+        return self.maximum
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+class Profiler(object):
+    """Records (stage, start, end) spans of monotonic timestamps, see the module documentation"""
+
+    def __init__(self, size=4096):
+        self.enabled = False
+        self._size = size
+        self._stages = array('b', [0]) * size
+        self._starts = array('d', [0.0]) * size
+        self._ends = array('d', [0.0]) * size
+        self._next = 0
+        self._recorded = 0
+        self._lock = threading.Lock()
+        self.histograms = [Histogram() for _ in STAGE_NAMES]
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def reset(self):
+        with self._lock:
+            self._next = 0
+            self._recorded = 0
+            self.histograms = [Histogram() for _ in STAGE_NAMES]
+
+    def record(self, stage, start, end):
+        with self._lock:
+            index = self._next
+            self._stages[index] = stage
+            self._starts[index] = start
+            self._ends[index] = end
+            self._next = (index + 1) % self._size
+            self._recorded += 1
+            self.histograms[stage].add(end - start)
+
+    def spans(self):
+        """The spans in the ring buffer as (stage name, start, seconds), oldest first"""
+        with self._lock:
+            count = min(self._recorded, self._size)
+            first = (self._next - count) % self._size
+            indexes = [(first + offset) % self._size for offset in range(count)]
+            return [(STAGE_NAMES[self._stages[index]], self._starts[index], self._ends[index] - self._starts[index])
+                    for index in indexes]
+
+    def summary(self):
+        """One line per stage that recorded anything: count, mean, p50, p99 and max in ms"""
+        lines = []
+        for name, histogram in zip(STAGE_NAMES, self.histograms):
+            if histogram.count:
+                lines.append('{0}: n={1} mean={2:.1f} p50<={3:.1f} p99<={4:.1f} max={5:.1f} ms'.format(
+                    name, histogram.count, histogram.mean * 1000, histogram.percentile(0.5) * 1000,
+                    histogram.percentile(0.99) * 1000, histogram.maximum * 1000))
+        return lines
+
+    def dump(self, path):
+        """Write the summary, the histograms and the spans in the ring buffer to path"""
+        with open(path, 'w') as out:
+            out.write('Profile written {0}\n\n'.format(time.strftime('%Y-%m-%d %H:%M:%S')))
+            for line in self.summary():
+                out.write(line + '\n')
+            out.write('\nHistograms, bucket upper bound in us: count\n')
+            for name, histogram in zip(STAGE_NAMES, self.histograms):
+                if histogram.count:
+                    buckets = ['{0}: {1}'.format(1 << bucket, count) for bucket, count in enumerate(histogram.counts) if count]
+                    out.write('{0}: {1}\n'.format(name, ', '.join(buckets)))
+            out.write('\nLast spans: stage, start (monotonic s), duration ms\n')
+            for name, start, seconds in self.spans():
+                out.write('{0}, {1:.6f}, {2:.3f}\n'.format(name, start, seconds * 1000))
+
+profiler = Profiler()
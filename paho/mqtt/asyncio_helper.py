@@ -0,0 +1,102 @@
+"""
+This module provides an adapter to run a Client on an asyncio event loop.
+The client socket is handed to the event loop with add_reader()/add_writer()
+as it is opened, and loop_misc() is called from a task, so no network thread
+is needed.
+"""
+from __future__ import absolute_import
+
+import asyncio
+import threading
+
+from . import client as paho
+
+
+class AsyncioHelper(object):
+    """Drives the network traffic of client from an asyncio event loop.
+
+    Create the helper before calling connect() or connect_async(), and do not
+    use loop(), loop_forever() or loop_start() on the client. The helper
+    takes over the client's on_socket_open, on_socket_close,
+    on_socket_register_write and on_socket_unregister_write callbacks.
+    """
+
+    def __init__(self, client, loop=None, misc_interval=1.0):
+        self.client = client
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self._misc_interval = misc_interval
+        self._misc_task = None
+        self._loop_thread = None
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+
+    def detach(self):
+        """Stop driving the client, e.g. after it was disconnected."""
+        sock = self.client.socket()
+        if sock is not None:
+            self._call(self._remove, sock)
+        self.client.on_socket_open = None
+        self.client.on_socket_close = None
+        self.client.on_socket_register_write = None
+        self.client.on_socket_unregister_write = None
+
+    def _call(self, func, *args):
+        # Socket callbacks come from whichever thread uses the client, the
+        # event loop may only be touched from its own thread.
+        if self._in_loop_thread():
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def _in_loop_thread(self):
+        if self._loop_thread is None:
+            try:
+                running = asyncio.get_running_loop()
+            except RuntimeError:
+                return False
+            if running is not self.loop:
+                return False
+            self._loop_thread = threading.current_thread()
+        return threading.current_thread() is self._loop_thread
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._call(self._add, sock)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._call(self._remove, sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._call(self.loop.add_writer, sock, self._write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._call(self.loop.remove_writer, sock)
+
+    def _add(self, sock):
+        self.loop.add_reader(sock, self._read)
+        if self.client.want_write():
+            self.loop.add_writer(sock, self._write)
+        if self._misc_task is None:
+            self._misc_task = self.loop.create_task(self._misc_loop())
+
+    def _remove(self, sock):
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+
+    def _read(self):
+        self.client.loop_read()
+        sock = self.client.socket()
+        # SSL sockets may hold decrypted data the event loop does not see.
+        if sock is not None and hasattr(sock, 'pending') and sock.pending() > 0:
+            self.loop.call_soon(self._read)
+
+    def _write(self):
+        self.client.loop_write()
+
+    async def _misc_loop(self):
+        try:
+            while self.client.loop_misc() == paho.MQTT_ERR_SUCCESS:
+                await asyncio.sleep(self._misc_interval)
+        finally:
+            self._misc_task = None
@@ -53,6 +53,7 @@ else:
     HAVE_DNS = True
 
 from .matcher import MQTTMatcher
+from . import tls_sessions
 
 if platform.system() == 'Windows':
     EAGAIN = errno.WSAEWOULDBLOCK
@@ -123,6 +124,9 @@ mqtt_ms_wait_for_pubcomp = 7
 mqtt_ms_send_pubrec = 8
 mqtt_ms_queued = 9
 
+# states of messages waiting for an answer from the broker, see Client._schedule_retry
+_retry_states = frozenset((mqtt_ms_wait_for_puback, mqtt_ms_wait_for_pubrec, mqtt_ms_wait_for_pubrel, mqtt_ms_wait_for_pubcomp))
+
 # Error values
 MQTT_ERR_AGAIN = -1
 MQTT_ERR_SUCCESS = 0
@@ -147,6 +151,21 @@ MQTT_BRIDGE = 1
 
 sockpair_data = b"0"
 
+# Initial size of the receive buffer. It grows to hold larger packets and is
+# shrunk back once empty if it grew beyond _IN_BUFFER_MAX_IDLE.
+_IN_BUFFER_SIZE = 16384
+_IN_BUFFER_MAX_IDLE = 262144
+
+# Limits for coalescing queued packets into a single socket write
+_OUT_BATCH_PACKETS = 64
+_OUT_BATCH_BYTES = 65536
+
+# WebSocket frames are read through a buffer of this size, one recv_into()
+# fills it with as many frames as have arrived
+_WS_READ_SIZE = 65536
+# WebSocket payloads are masked in chunks of this many bytes, a multiple of 4
+_WS_MASK_CHUNK = 4096
+
 class WebsocketConnectionError(ValueError):
     pass
 
@@ -516,10 +535,17 @@ class Client(object):
         self._protocol = protocol
         self._userdata = userdata
         self._sock = None
-        self._sockpairR, self._sockpairW = _socketpair_compat()
+        # Created on first use by loop(), clients driven by an external event
+        # loop never need it.
+        self._sockpairR, self._sockpairW = None, None
         self._keepalive = 60
         self._message_retry = 20
         self._last_retry_check = 0
+        # TimerHeap shared with other clients (see Multiplexer), None when loop_misc() does the housekeeping
+        self._timers = None
+        self._keepalive_timer = None
+        # (outgoing, mid): Timer of the retry of that message
+        self._retry_timers = {}
         self._clean_session = clean_session
         self._client_mode = MQTT_CLIENT
         # [MQTT-3.1.3-4] Client Id must be UTF-8 encoded string.
@@ -535,15 +561,16 @@ class Client(object):
 
         self._username = None
         self._password = None
+        # Packet currently being handled, the fields are replaced for every
+        # packet parsed out of the input buffer.
         self._in_packet = {
             "command": 0,
-            "have_remaining": 0,
-            "remaining_count": [],
-            "remaining_mult": 1,
             "remaining_length": 0,
-            "packet": b"",
-            "to_process": 0,
-            "pos": 0}
+            "packet": b""}
+        self._in_buffer = bytearray(_IN_BUFFER_SIZE)
+        self._in_view = memoryview(self._in_buffer)
+        self._in_start = 0
+        self._in_end = 0
         self._out_packet = collections.deque()
         self._current_out_packet = None
         self._last_msg_in = time_func()
@@ -551,10 +578,14 @@ class Client(object):
         self._reconnect_min_delay = 1
         self._reconnect_max_delay = 120
         self._reconnect_delay = None
+        self._connect_timeout = 5.0
         self._ping_t = 0
         self._last_mid = 0
         self._state = mqtt_cs_new
         self._out_messages = collections.OrderedDict()
+        # messages in state mqtt_ms_queued, oldest first, so acks refill the inflight window
+        # without scanning _out_messages. Entries that left that state are skipped on the way out.
+        self._out_queued = collections.deque()
         self._in_messages = collections.OrderedDict()
         self._max_inflight_messages = 20
         self._inflight_messages = 0
@@ -582,8 +613,12 @@ class Client(object):
         self._ssl = False
         self._ssl_context = None
         self._tls_insecure = False  # Only used when SSL context does not have check_hostname attribute
+        self._tls_sessions = None
+        self._tls_sock = None
         self._logger = None
         self._registered_write = False
+        self._sock_sendmsg_ok = False
+        self._loop_waiting = False
         # No default callbacks
         self._on_log = None
         self._on_connect = None
@@ -615,6 +650,19 @@ class Client(object):
                 raise WouldBlockError()
             raise
 
+    def _sock_recv_into(self, buf):
+        try:
+            return self._sock.recv_into(buf)
+        except socket.error as err:
+            if self._ssl and err.errno == ssl.SSL_ERROR_WANT_READ:
+                raise WouldBlockError()
+            if self._ssl and err.errno == ssl.SSL_ERROR_WANT_WRITE:
+                self._call_socket_register_write()
+                raise WouldBlockError()
+            if err.errno == EAGAIN:
+                raise WouldBlockError()
+            raise
+
     def _sock_send(self, buf):
         try:
             return self._sock.send(buf)
@@ -629,6 +677,15 @@ class Client(object):
                 raise WouldBlockError()
             raise
 
+    def _sock_sendmsg(self, buffers):
+        try:
+            return self._sock.sendmsg(buffers)
+        except socket.error as err:
+            if err.errno == EAGAIN:
+                self._call_socket_register_write()
+                raise WouldBlockError()
+            raise
+
     def _sock_close(self):
         """Close the connection to the server."""
         if not self._sock:
@@ -637,6 +694,7 @@ class Client(object):
         try:
             sock = self._sock
             self._sock = None
+            self._tls_sock = None
             self._call_socket_unregister_write(sock)
             self._call_socket_close(sock)
         finally:
@@ -698,12 +756,15 @@ class Client(object):
 
         self._ssl = True
         self._ssl_context = context
+        # Sessions are shared by all clients using this context
+        self._tls_sessions = tls_sessions.registry.sessions(context)
 
         # Ensure _tls_insecure is consistent with check_hostname attribute
         if hasattr(context, 'check_hostname'):
             self._tls_insecure = not context.check_hostname
 
-    def tls_set(self, ca_certs=None, certfile=None, keyfile=None, cert_reqs=None, tls_version=None, ciphers=None):
+    def tls_set(self, ca_certs=None, certfile=None, keyfile=None, cert_reqs=None, tls_version=None, ciphers=None,
+                shared_context=False):
         """Configure network encryption and authentication options. Enables SSL/TLS support.
 
         ca_certs : a string path to the Certificate Authority certificate files
@@ -740,6 +801,11 @@ class Client(object):
         for this connection, or None to use the defaults. See the ssl pydoc for
         more information.
 
+        If shared_context is True, the SSLContext is taken from
+        tls_sessions.registry, so all clients configured with the same
+        options use one context and resume each other's TLS sessions. Note
+        that tls_insecure_set() then changes the context of all of them.
+
         Must be called before connect() or connect_async()."""
         if ssl is None:
             raise ValueError('This platform has no SSL/TLS.')
@@ -752,29 +818,10 @@ class Client(object):
             raise ValueError('ca_certs must not be None.')
 
         # Create SSLContext object
-        if tls_version is None:
-            tls_version = ssl.PROTOCOL_TLSv1
-            # If the python version supports it, use highest TLS version automatically
-            if hasattr(ssl, "PROTOCOL_TLS"):
-                tls_version = ssl.PROTOCOL_TLS
-        context = ssl.SSLContext(tls_version)
-
-        # Configure context
-        if certfile is not None:
-            context.load_cert_chain(certfile, keyfile)
-
-        if cert_reqs == ssl.CERT_NONE and hasattr(context, 'check_hostname'):
-            context.check_hostname = False
-
-        context.verify_mode = ssl.CERT_REQUIRED if cert_reqs is None else cert_reqs
-
-        if ca_certs is not None:
-            context.load_verify_locations(ca_certs)
+        if shared_context:
+            context = tls_sessions.registry.context(ca_certs, certfile, keyfile, cert_reqs, tls_version, ciphers)
         else:
-            context.load_default_certs()
-
-        if ciphers is not None:
-            context.set_ciphers(ciphers)
+            context = tls_sessions.create_context(ca_certs, certfile, keyfile, cert_reqs, tls_version, ciphers)
 
         self.tls_set_context(context)
 
@@ -786,6 +833,14 @@ class Client(object):
             # But with ssl.CERT_NONE, we can not check_hostname
             self.tls_insecure_set(True)
 
+    def tls_session_statistics(self):
+        """The number of full and resumed TLS handshakes made with the SSL
+        context of this client, by this and other clients sharing it, as a
+        dict with keys 'full' and 'resumed'. None if TLS is not configured."""
+        if self._tls_sessions is None:
+            return None
+        return {'full': self._tls_sessions.full, 'resumed': self._tls_sessions.resumed}
+
     def tls_insecure_set(self, value):
         """Configure verification of the server hostname in the server certificate.
 
@@ -919,6 +974,12 @@ class Client(object):
             self._reconnect_max_delay = max_delay
             self._reconnect_delay = None
 
+    def connect_timeout_set(self, timeout):
+        """Configure the longest time in seconds connect() and reconnect() wait
+        for the TCP connection to the broker to be established. Defaults to 5
+        seconds. None waits as long as the operating system does."""
+        self._connect_timeout = timeout
+
     def reconnect(self):
         """Reconnect the client after a disconnect. Can only be called after
         connect()/connect_async()."""
@@ -927,15 +988,9 @@ class Client(object):
         if self._port <= 0:
             raise ValueError('Invalid port number.')
 
-        self._in_packet = {
-            "command": 0,
-            "have_remaining": 0,
-            "remaining_count": [],
-            "remaining_mult": 1,
-            "remaining_length": 0,
-            "packet": b"",
-            "to_process": 0,
-            "pos": 0}
+        self._in_packet['packet'] = b""
+        self._in_start = 0
+        self._in_end = 0
 
         with self._out_packet_mutex:
             self._out_packet = collections.deque()
@@ -957,9 +1012,10 @@ class Client(object):
 
         try:
             if sys.version_info < (2, 7) or (3, 0) < sys.version_info < (3, 2):
-                sock = socket.create_connection((self._host, self._port))
+                sock = socket.create_connection((self._host, self._port), timeout=self._connect_timeout)
             else:
-                sock = socket.create_connection((self._host, self._port), source_address=(self._bind_address, 0))
+                sock = socket.create_connection((self._host, self._port), timeout=self._connect_timeout,
+                                                source_address=(self._bind_address, 0))
         except socket.error as err:
             if err.errno != errno.EINPROGRESS and err.errno != errno.EWOULDBLOCK and err.errno != EAGAIN:
                 raise
@@ -968,12 +1024,17 @@ class Client(object):
             # SSL is only supported when SSLContext is available (implies Python >= 2.7.9 or >= 3.2)
 
             verify_host = not self._tls_insecure
+            # Offer the session of the last connection to this broker, so the
+            # handshake can resume it instead of starting over
+            session = self._tls_sessions.get(self._host, self._port)
+            session_options = {'session': session} if session is not None else {}
             try:
                 # Try with server_hostname, even it's not supported in certain scenarios
                 sock = self._ssl_context.wrap_socket(
                     sock,
                     server_hostname=self._host,
                     do_handshake_on_connect=False,
+                    **session_options
                 )
             except ssl.CertificateError:
                 # CertificateError is derived from ValueError
@@ -983,6 +1044,7 @@ class Client(object):
                 sock = self._ssl_context.wrap_socket(
                     sock,
                     do_handshake_on_connect=False,
+                    **session_options
                 )
             else:
                 # If SSL context has already checked hostname, then don't need to do it again
@@ -991,11 +1053,21 @@ class Client(object):
                     verify_host = False
 
             sock.settimeout(self._keepalive)
-            sock.do_handshake()
+            try:
+                sock.do_handshake()
+            except ssl.SSLError:
+                # Don't offer the session again, in case it is the problem
+                self._tls_sessions.forget(self._host, self._port)
+                raise
+            self._tls_sessions.handshake_done(sock)
 
             if verify_host:
                 ssl.match_hostname(sock.getpeercert(), self._host)
 
+            # The session is stored once the CONNACK arrived: with TLS 1.3
+            # the server sends it after the handshake
+            self._tls_sock = sock
+
         if self._transport == "websockets":
             sock.settimeout(self._keepalive)
             sock = WebsocketWrapper(sock, self._host, self._port, self._ssl,
@@ -1003,8 +1075,11 @@ class Client(object):
 
         self._sock = sock
         self._sock.setblocking(0)
+        self._sock_sendmsg_ok = (not self._ssl and self._transport == "tcp"
+                                 and hasattr(sock, 'sendmsg'))
         self._registered_write = False
         self._call_socket_open()
+        self._schedule_keepalive()
 
         return self._send_connect(self._keepalive, self._clean_session)
 
@@ -1031,6 +1106,9 @@ class Client(object):
         if timeout < 0.0:
             raise ValueError('Invalid timeout.')
 
+        if self._sockpairR is None:
+            self._sockpairR, self._sockpairW = _socketpair_compat()
+
         with self._current_out_packet_mutex:
             with self._out_packet_mutex:
                 if self._current_out_packet is None and len(self._out_packet) > 0:
@@ -1040,6 +1118,11 @@ class Client(object):
                     wlist = [self._sock]
                 else:
                     wlist = []
+                # Only while nothing is waiting to be written select() may
+                # sleep for the whole timeout, _packet_queue() then needs to
+                # wake us up. Set under _out_packet_mutex so no packet queued
+                # after the check above can miss it.
+                self._loop_waiting = not wlist
 
         # used to check if there are any bytes left in the (SSL) socket
         pending_bytes = 0
@@ -1067,6 +1150,8 @@ class Client(object):
             raise
         except:
             return MQTT_ERR_UNKNOWN
+        finally:
+            self._loop_waiting = False
 
         if self._sock in socklist[0] or pending_bytes > 0:
             rc = self.loop_read(max_packets)
@@ -1077,9 +1162,10 @@ class Client(object):
             # Stimulate output write even though we didn't ask for it, because
             # at that point the publish or other command wasn't present.
             socklist[1].insert(0, self._sock)
-            # Clear sockpairR - only ever a single byte written.
+            # Clear sockpairR - a single byte is written per wait, but a wake
+            # up racing with select() returning may leave more than one.
             try:
-                self._sockpairR.recv(1)
+                self._sockpairR.recv(4096)
             except socket.error as err:
                 if err.errno != EAGAIN:
                     raise
@@ -1189,11 +1275,14 @@ class Client(object):
                     if rc is MQTT_ERR_NO_CONN:
                         self._inflight_messages -= 1
                         message.state = mqtt_ms_publish
+                    else:
+                        self._schedule_retry(message, True)
 
                     message.info.rc = rc
                     return message.info
                 else:
                     message.state = mqtt_ms_queued
+                    self._out_queued.append(message)
                     message.info.rc = MQTT_ERR_SUCCESS
                     return message.info
 
@@ -1433,6 +1522,9 @@ class Client(object):
             self._message_retry_check()
             self._last_retry_check = now
 
+        return self._check_pingresp(now)
+
+    def _check_pingresp(self, now):
         if self._ping_t > 0 and now - self._ping_t >= self._keepalive:
             # client->ping_t != 0 means we are waiting for a pingresp.
             # This hasn't happened in the keepalive time so we should disconnect.
@@ -1994,105 +2086,124 @@ class Client(object):
         return rc
 
     def _packet_read(self):
-        # This gets called if pselect() indicates that there is network data
-        # available - ie. at least one byte.  What we do depends on what data we
-        # already have.
-        # If we've not got a command, attempt to read one and save it. This should
-        # always work because it's only a single byte.
-        # Then try to read the remaining length. This may fail because it is may
-        # be more than one byte - will need to save data pending next read if it
-        # does fail.
-        # Then try to read the remaining payload, where 'payload' here means the
-        # combined variable header and actual payload. This is the most likely to
-        # fail due to longer length, so save current data and current position.
-        # After all data is read, send to _mqtt_handle_packet() to deal with.
-        # Finally, free the memory and reset everything to starting conditions.
-        if self._in_packet['command'] == 0:
-            try:
-                command = self._sock_recv(1)
-            except WouldBlockError:
-                return MQTT_ERR_AGAIN
-            except socket.error as err:
-                self._easy_log(MQTT_LOG_ERR, 'failed to receive on socket: %s', err)
-                return 1
-            else:
-                if len(command) == 0:
-                    return 1
-                command, = struct.unpack("!B", command)
-                self._in_packet['command'] = command
-
-        if self._in_packet['have_remaining'] == 0:
-            # Read remaining
-            # Algorithm for decoding taken from pseudo code at
-            # http://publib.boulder.ibm.com/infocenter/wmbhelp/v6r0m0/topic/com.ibm.etools.mft.doc/ac10870_.htm
-            while True:
-                try:
-                    byte = self._sock_recv(1)
-                except WouldBlockError:
-                    return MQTT_ERR_AGAIN
-                except socket.error as err:
-                    self._easy_log(MQTT_LOG_ERR, 'failed to receive on socket: %s', err)
-                    return 1
-                else:
-                    if len(byte) == 0:
-                        return 1
-                    byte, = struct.unpack("!B", byte)
-                    self._in_packet['remaining_count'].append(byte)
-                    # Max 4 bytes length for remaining length as defined by protocol.
-                    # Anything more likely means a broken/malicious client.
-                    if len(self._in_packet['remaining_count']) > 4:
-                        return MQTT_ERR_PROTOCOL
-
-                    self._in_packet['remaining_length'] += (byte & 127) * self._in_packet['remaining_mult']
-                    self._in_packet['remaining_mult'] = self._in_packet['remaining_mult'] * 128
+        # This gets called if select() indicates that there is network data
+        # available - ie. at least one byte.
+        # Receive as much as is available into the input buffer with a single
+        # recv_into(), then handle every complete packet found in the buffer.
+        # An incomplete packet at the end stays in the buffer until the rest
+        # of it arrives. Packets are handed to _packet_handle() as memoryview
+        # slices of the buffer, which are only valid during that call.
+        if self._in_start == self._in_end:
+            self._in_start = self._in_end = 0
+            if len(self._in_buffer) > _IN_BUFFER_MAX_IDLE:
+                # Don't hold on to the memory of an occasional large packet
+                self._in_buffer_resize(_IN_BUFFER_SIZE)
+        elif self._in_end == len(self._in_buffer):
+            self._in_buffer_reserve(self._in_end - self._in_start + 1)
+
+        space = len(self._in_buffer) - self._in_end
+        try:
+            nbytes = self._sock_recv_into(self._in_view[self._in_end:])
+        except WouldBlockError:
+            return MQTT_ERR_AGAIN
+        except socket.error as err:
+            self._easy_log(MQTT_LOG_ERR, 'failed to receive on socket: %s', err)
+            return 1
+
+        if nbytes == 0:
+            return 1
+        self._in_end += nbytes
+
+        rc = self._packet_parse()
+        if rc:
+            return rc
+
+        with self._msgtime_mutex:
+            self._last_msg_in = time_func()
 
+        if nbytes < space:
+            # The socket had no more data for us, no need to try again until
+            # select() says otherwise.
+            return MQTT_ERR_AGAIN
+        return MQTT_ERR_SUCCESS
+
+    def _packet_parse(self):
+        buf = self._in_buffer
+        view = self._in_view
+        sock = self._sock
+        in_packet = self._in_packet
+
+        while self._in_end - self._in_start >= 2:
+            start = self._in_start
+
+            # Decode remaining length, at most 4 bytes as defined by the
+            # protocol. Anything more likely means a broken/malicious client.
+            remaining_length = 0
+            mult = 1
+            pos = start + 1
+            while True:
+                if pos == self._in_end:
+                    return MQTT_ERR_SUCCESS
+                byte = buf[pos]
+                pos += 1
+                remaining_length += (byte & 127) * mult
+                mult *= 128
                 if (byte & 128) == 0:
                     break
+                if pos - start > 4:
+                    return MQTT_ERR_PROTOCOL
 
-            self._in_packet['have_remaining'] = 1
-            self._in_packet['to_process'] = self._in_packet['remaining_length']
+            end = pos + remaining_length
+            if end > self._in_end:
+                # Make sure the whole packet will fit, then wait for the rest
+                self._in_buffer_reserve(end - start)
+                return MQTT_ERR_SUCCESS
 
-        while self._in_packet['to_process'] > 0:
-            try:
-                data = self._sock_recv(self._in_packet['to_process'])
-            except WouldBlockError:
-                return MQTT_ERR_AGAIN
-            except socket.error as err:
-                self._easy_log(MQTT_LOG_ERR, 'failed to receive on socket: %s', err)
-                return 1
-            else:
-                if len(data) == 0:
-                    return 1
-                self._in_packet['to_process'] -= len(data)
-                self._in_packet['packet'] += data
+            in_packet['command'] = buf[start]
+            in_packet['remaining_length'] = remaining_length
+            in_packet['packet'] = view[pos:end]
+            self._in_start = end
 
-        # All data for this packet is read.
-        self._in_packet['pos'] = 0
-        rc = self._packet_handle()
+            rc = self._packet_handle()
+            in_packet['packet'] = b""
+            if rc:
+                return rc
+            if self._sock is not sock:
+                # Handler reconnected or closed the connection, the buffer
+                # has been reset.
+                return MQTT_ERR_SUCCESS
 
-        # Free data and reset values
-        self._in_packet = {
-            'command': 0,
-            'have_remaining': 0,
-            'remaining_count': [],
-            'remaining_mult': 1,
-            'remaining_length': 0,
-            'packet': b"",
-            'to_process': 0,
-            'pos': 0}
+        return MQTT_ERR_SUCCESS
 
-        with self._msgtime_mutex:
-            self._last_msg_in = time_func()
-        return rc
+    def _in_buffer_reserve(self, size):
+        # Make room for size bytes from the start of the pending data
+        if len(self._in_buffer) - self._in_start >= size:
+            return
+        pending = self._in_end - self._in_start
+        if size <= len(self._in_buffer):
+            self._in_buffer[0:pending] = self._in_buffer[self._in_start:self._in_end]
+            self._in_start = 0
+            self._in_end = pending
+        else:
+            self._in_buffer_resize(max(size, 2 * len(self._in_buffer)))
+
+    def _in_buffer_resize(self, size):
+        buf = bytearray(size)
+        pending = self._in_end - self._in_start
+        buf[0:pending] = self._in_view[self._in_start:self._in_end]
+        self._in_buffer = buf
+        self._in_view = memoryview(buf)
+        self._in_start = 0
+        self._in_end = pending
 
     def _packet_write(self):
         self._current_out_packet_mutex.acquire()
 
         while self._current_out_packet:
-            packet = self._current_out_packet
+            packets = self._packet_write_batch()
 
             try:
-                write_length = self._sock_send(packet['packet'][packet['pos']:])
+                write_length = self._sock_send_packets(packets)
             except (AttributeError, ValueError):
                 self._current_out_packet_mutex.release()
                 return MQTT_ERR_SUCCESS
@@ -2104,47 +2215,55 @@ class Client(object):
                 self._easy_log(MQTT_LOG_ERR, 'failed to receive on socket: %s', err)
                 return 1
 
-            if write_length > 0:
-                packet['to_process'] -= write_length
-                packet['pos'] += write_length
-
-                if packet['to_process'] == 0:
-                    if (packet['command'] & 0xF0) == PUBLISH and packet['qos'] == 0:
-                        with self._callback_mutex:
-                            if self.on_publish:
-                                with self._in_callback_mutex:
-                                    try:
-                                        self.on_publish(self, self._userdata, packet['mid'])
-                                    except Exception as err:
-                                        self._easy_log(MQTT_LOG_ERR, 'Caught exception in on_publish: %s', err)
-
-                        packet['info']._set_as_published()
-
-                    if (packet['command'] & 0xF0) == DISCONNECT:
-                        self._current_out_packet_mutex.release()
-
-                        with self._msgtime_mutex:
-                            self._last_msg_out = time_func()
-
-                        with self._callback_mutex:
-                            if self.on_disconnect:
-                                with self._in_callback_mutex:
-                                    try:
-                                        self.on_disconnect(self, self._userdata, 0)
-                                    except Exception as err:
-                                        self._easy_log(MQTT_LOG_ERR, 'Caught exception in on_disconnect: %s', err)
-
-                        self._sock_close()
-                        return MQTT_ERR_SUCCESS
-
-                    with self._out_packet_mutex:
-                        if len(self._out_packet) > 0:
-                            self._current_out_packet = self._out_packet.popleft()
-                        else:
-                            self._current_out_packet = None
-            else:
+            if write_length <= 0:
                 break
 
+            # Hand the written bytes out over the packets of the batch, in
+            # order, completing every packet that was fully written.
+            while write_length > 0:
+                packet = self._current_out_packet
+                sent = min(write_length, packet['to_process'])
+                write_length -= sent
+                packet['to_process'] -= sent
+                packet['pos'] += sent
+
+                if packet['to_process'] > 0:
+                    break
+
+                if (packet['command'] & 0xF0) == PUBLISH and packet['qos'] == 0:
+                    with self._callback_mutex:
+                        if self.on_publish:
+                            with self._in_callback_mutex:
+                                try:
+                                    self.on_publish(self, self._userdata, packet['mid'])
+                                except Exception as err:
+                                    self._easy_log(MQTT_LOG_ERR, 'Caught exception in on_publish: %s', err)
+
+                    packet['info']._set_as_published()
+
+                if (packet['command'] & 0xF0) == DISCONNECT:
+                    self._current_out_packet_mutex.release()
+
+                    with self._msgtime_mutex:
+                        self._last_msg_out = time_func()
+
+                    with self._callback_mutex:
+                        if self.on_disconnect:
+                            with self._in_callback_mutex:
+                                try:
+                                    self.on_disconnect(self, self._userdata, 0)
+                                except Exception as err:
+                                    self._easy_log(MQTT_LOG_ERR, 'Caught exception in on_disconnect: %s', err)
+
+                    self._sock_close()
+                    return MQTT_ERR_SUCCESS
+
+                with self._out_packet_mutex:
+                    if len(self._out_packet) > 0:
+                        self._current_out_packet = self._out_packet.popleft()
+                    else:
+                        self._current_out_packet = None
+
         self._current_out_packet_mutex.release()
 
         with self._msgtime_mutex:
@@ -2152,6 +2271,36 @@ class Client(object):
 
         return MQTT_ERR_SUCCESS
 
+    def _packet_write_batch(self):
+        # The current packet plus as many queued packets as fit in one write.
+        # Nothing is sent after a DISCONNECT, so it always ends a batch.
+        # Must be called with _current_out_packet_mutex held, which keeps
+        # anyone else from popping _out_packet.
+        batch = [self._current_out_packet]
+        size = self._current_out_packet['to_process']
+        with self._out_packet_mutex:
+            for packet in self._out_packet:
+                if (len(batch) >= _OUT_BATCH_PACKETS
+                        or size >= _OUT_BATCH_BYTES
+                        or (batch[-1]['command'] & 0xF0) == DISCONNECT):
+                    break
+                batch.append(packet)
+                size += packet['to_process']
+        return batch
+
+    def _sock_send_packets(self, packets):
+        first = packets[0]
+        if len(packets) == 1:
+            return self._sock_send(memoryview(first['packet'])[first['pos']:])
+
+        buffers = [memoryview(first['packet'])[first['pos']:]]
+        buffers.extend(memoryview(packet['packet']) for packet in packets[1:])
+        if self._sock_sendmsg_ok:
+            return self._sock_sendmsg(buffers)
+        # SSL and WebSocket transports can't scatter/gather, one write of the
+        # joined packets still saves syscalls and TLS records/frames.
+        return self._sock_send(b"".join(buffers))
+
     def _easy_log(self, level, fmt, *args):
         if self.on_log is not None:
             buf = fmt % args
@@ -2444,23 +2593,101 @@ class Client(object):
             now = time_func()
             for m in messages.values():
                 if m.timestamp + self._message_retry < now:
-                    if m.state == mqtt_ms_wait_for_puback or m.state == mqtt_ms_wait_for_pubrec:
-                        m.timestamp = now
-                        m.dup = True
-                        self._send_publish(
-                            m.mid,
-                            m.topic.encode('utf-8'),
-                            m.payload,
-                            m.qos,
-                            m.retain,
-                            m.dup
-                        )
-                    elif m.state == mqtt_ms_wait_for_pubrel:
-                        m.timestamp = now
-                        self._send_pubrec(m.mid)
-                    elif m.state == mqtt_ms_wait_for_pubcomp:
-                        m.timestamp = now
-                        self._send_pubrel(m.mid)
+                    self._message_retry_one(m, now)
+
+    def _message_retry_one(self, m, now):
+        """Resend the packet message m waits an answer to, returns False if it doesn't wait for one"""
+        if m.state == mqtt_ms_wait_for_puback or m.state == mqtt_ms_wait_for_pubrec:
+            m.timestamp = now
+            m.dup = True
+            self._send_publish(
+                m.mid,
+                m.topic.encode('utf-8'),
+                m.payload,
+                m.qos,
+                m.retain,
+                m.dup
+            )
+        elif m.state == mqtt_ms_wait_for_pubrel:
+            m.timestamp = now
+            self._send_pubrec(m.mid)
+        elif m.state == mqtt_ms_wait_for_pubcomp:
+            m.timestamp = now
+            self._send_pubrel(m.mid)
+        else:
+            return False
+        return True
+
+    def _timers_set(self, timers):
+        """Have keepalive and message retries run from timers, a TimerHeap shared with
+        other clients, instead of loop_misc(). None goes back to loop_misc()."""
+        if self._keepalive_timer is not None:
+            self._keepalive_timer.cancel()
+            self._keepalive_timer = None
+        for timer in self._retry_timers.values():
+            timer.cancel()
+        self._retry_timers = {}
+        self._timers = timers
+        if timers is None:
+            return
+        self._schedule_keepalive()
+        with self._out_message_mutex:
+            for m in self._out_messages.values():
+                self._schedule_retry(m, True)
+        with self._in_message_mutex:
+            for m in self._in_messages.values():
+                self._schedule_retry(m, False)
+
+    def _schedule_keepalive(self):
+        timers = self._timers
+        if timers is None or self._keepalive == 0 or self._sock is None:
+            return
+        if self._keepalive_timer is not None:
+            self._keepalive_timer.cancel()
+        with self._msgtime_mutex:
+            deadline = min(self._last_msg_out, self._last_msg_in) + self._keepalive
+        if self._ping_t > 0:
+            deadline = min(deadline, self._ping_t + self._keepalive)
+        self._keepalive_timer = timers.schedule(deadline, self._keepalive_due)
+
+    def _keepalive_due(self):
+        # Traffic moves the deadline without rescheduling, the checks find out if it really passed
+        self._keepalive_timer = None
+        if self._sock is None:
+            return
+        self._check_keepalive()
+        if self._sock is not None:
+            self._check_pingresp(time_func())
+        self._schedule_keepalive()
+
+    def _schedule_retry(self, m, outgoing):
+        """Check message m for a retry once the retry timeout after m.timestamp passed"""
+        if self._timers is None or m.state not in _retry_states:
+            return
+        key = (outgoing, m.mid)
+        timer = self._retry_timers.get(key)
+        if timer is not None and timer.args[0] is m and not timer.cancelled:
+            # its timer is still coming, it looks at the current timestamp
+            return
+        self._retry_timers[key] = self._timers.schedule(m.timestamp + self._message_retry, self._retry_due, m, outgoing)
+
+    def _retry_due(self, m, outgoing):
+        if outgoing:
+            messages, mutex = self._out_messages, self._out_message_mutex
+        else:
+            messages, mutex = self._in_messages, self._in_message_mutex
+        with mutex:
+            key = (outgoing, m.mid)
+            timer = self._retry_timers.get(key)
+            if timer is not None and timer.args[0] is m:
+                del self._retry_timers[key]
+            if messages.get(m.mid) is not m or self._sock is None:
+                # answered, or reset for the next connection
+                return
+            now = time_func()
+            if m.timestamp + self._message_retry <= now and not self._message_retry_one(m, now):
+                return
+            self._schedule_retry(m, outgoing)
 
     def _message_retry_check(self):
         self._message_retry_check_actual(self._out_messages, self._out_message_mutex)
@@ -2469,6 +2696,7 @@ class Client(object):
     def _messages_reconnect_reset_out(self):
         with self._out_message_mutex:
             self._inflight_messages = 0
+            self._out_queued.clear()
             for m in self._out_messages.values():
                 m.timestamp = 0
                 if self._max_inflight_messages == 0 or self._inflight_messages < self._max_inflight_messages:
@@ -2494,6 +2722,7 @@ class Client(object):
                                 m.state = mqtt_ms_publish
                 else:
                     m.state = mqtt_ms_queued
+                    self._out_queued.append(m)
 
     def _messages_reconnect_reset_in(self):
         with self._in_message_mutex:
@@ -2528,14 +2757,18 @@ class Client(object):
                 if self._current_out_packet is None and len(self._out_packet) > 0:
                     self._current_out_packet = self._out_packet.popleft()
                 self._current_out_packet_mutex.release()
+            wake = self._loop_waiting
+            self._loop_waiting = False
 
         # Write a single byte to sockpairW (connected to sockpairR) to break
-        # out of select() if in threaded mode.
-        try:
-            self._sockpairW.send(sockpair_data)
-        except socket.error as err:
-            if err.errno != EAGAIN:
-                raise
+        # out of select() if in threaded mode and loop() is waiting for
+        # network traffic without watching the socket for writing.
+        if wake and self._sockpairW is not None:
+            try:
+                self._sockpairW.send(sockpair_data)
+            except socket.error as err:
+                if err.errno != EAGAIN:
+                    raise
 
         if self._thread is None:
             if self._in_callback_mutex.acquire(False):
@@ -2616,6 +2849,8 @@ class Client(object):
         if result == 0:
             self._state = mqtt_cs_connected
             self._reconnect_delay = None
+            if self._tls_sock is not None:
+                self._tls_sessions.put(self._host, self._port, getattr(self._tls_sock, 'session', None))
 
         self._easy_log(MQTT_LOG_DEBUG, "Received CONNACK (%s, %s)", flags, result)
 
@@ -2632,7 +2867,9 @@ class Client(object):
         if result == 0:
             rc = 0
             with self._out_message_mutex:
-                for m in self._out_messages.values():
+                # loop_write() below can call on_publish, which may publish
+                # more messages. These are sent by publish() itself.
+                for m in list(self._out_messages.values()):
                     m.timestamp = time_func()
                     if m.state == mqtt_ms_queued:
                         self.loop_write()  # Process outgoing messages that have just been queued up
@@ -2687,6 +2924,7 @@ class Client(object):
                                 rc = self._send_pubrel(m.mid)
                             if rc != 0:
                                 return rc
+                    self._schedule_retry(m, True)
                     self.loop_write()  # Process outgoing messages that have just been queued up
 
             return rc
@@ -2722,13 +2960,14 @@ class Client(object):
         message.qos = (header & 0x06) >> 1
         message.retain = (header & 0x01)
 
-        pack_format = "!H" + str(len(self._in_packet['packet']) - 2) + 's'
-        (slen, packet) = struct.unpack(pack_format, self._in_packet['packet'])
-        pack_format = '!' + str(slen) + 's' + str(len(packet) - slen) + 's'
-        (topic, packet) = struct.unpack(pack_format, packet)
-
-        if len(topic) == 0:
+        packet = self._in_packet['packet']
+        if len(packet) < 2:
             return MQTT_ERR_PROTOCOL
+        slen, = struct.unpack_from("!H", packet)
+        pos = 2 + slen
+        if slen == 0 or len(packet) < pos:
+            return MQTT_ERR_PROTOCOL
+        topic = bytes(packet[2:pos])
 
         # Handle topics with invalid UTF-8
         # This replaces an invalid topic with a message and the hex
@@ -2742,10 +2981,12 @@ class Client(object):
         message.topic = topic
 
         if message.qos > 0:
-            pack_format = "!H" + str(len(packet) - 2) + 's'
-            (message.mid, packet) = struct.unpack(pack_format, packet)
+            if len(packet) < pos + 2:
+                return MQTT_ERR_PROTOCOL
+            message.mid, = struct.unpack_from("!H", packet, pos)
+            pos += 2
 
-        message.payload = packet
+        message.payload = bytes(packet[pos:])
 
         self._easy_log(
             MQTT_LOG_DEBUG,
@@ -2767,6 +3008,7 @@ class Client(object):
             message.state = mqtt_ms_wait_for_pubrel
             with self._in_message_mutex:
                 self._in_messages[message.mid] = message
+                self._schedule_retry(message, False)
             return rc
         else:
             return MQTT_ERR_PROTOCOL
@@ -2801,26 +3043,28 @@ class Client(object):
 
     def _update_inflight(self):
         # Dont lock message_mutex here
-        for m in self._out_messages.values():
-            if self._inflight_messages < self._max_inflight_messages:
-                if m.qos > 0 and m.state == mqtt_ms_queued:
-                    self._inflight_messages += 1
-                    if m.qos == 1:
-                        m.state = mqtt_ms_wait_for_puback
-                    elif m.qos == 2:
-                        m.state = mqtt_ms_wait_for_pubrec
-                    rc = self._send_publish(
-                        m.mid,
-                        m.topic.encode('utf-8'),
-                        m.payload,
-                        m.qos,
-                        m.retain,
-                        m.dup,
-                    )
-                    if rc != 0:
-                        return rc
-            else:
-                return MQTT_ERR_SUCCESS
+        queued = self._out_queued
+        while queued and self._inflight_messages < self._max_inflight_messages:
+            m = queued.popleft()
+            if m.state != mqtt_ms_queued or self._out_messages.get(m.mid) is not m:
+                continue
+            self._inflight_messages += 1
+            if m.qos == 1:
+                m.state = mqtt_ms_wait_for_puback
+            elif m.qos == 2:
+                m.state = mqtt_ms_wait_for_pubrec
+            m.timestamp = time_func()
+            rc = self._send_publish(
+                m.mid,
+                m.topic.encode('utf-8'),
+                m.payload,
+                m.qos,
+                m.retain,
+                m.dup,
+            )
+            if rc != 0:
+                return rc
+            self._schedule_retry(m, True)
         return MQTT_ERR_SUCCESS
 
     def _handle_pubrec(self):
@@ -2941,6 +3185,29 @@ class Mosquitto(Client):
         super(Mosquitto, self).__init__(client_id, clean_session, userdata)
 
 
+def _websocket_mask(mask_key, data, offset=0):
+    """XOR data with the 4 byte mask_key repeated, starting at byte offset of
+    the mask. Done on big integers of _WS_MASK_CHUNK bytes instead of per byte,
+    converting a large payload as one integer is slower again."""
+    length = len(data)
+    if not length:
+        return b""
+    offset %= 4
+    chunk = min(length, _WS_MASK_CHUNK)
+    mask_bytes = ((bytes(mask_key[offset:]) + bytes(mask_key[:offset])) * (chunk // 4 + 1))[:chunk]
+    mask = int.from_bytes(mask_bytes, "big")
+    data = memoryview(data)
+    result = bytearray(length)
+    for start in range(0, length, chunk):
+        size = min(chunk, length - start)
+        if size < chunk:
+            # chunks start at a multiple of 4, the last one uses the start of the mask
+            mask = int.from_bytes(mask_bytes[:size], "big")
+        value = int.from_bytes(data[start:start + size], "big") ^ mask
+        result[start:start + size] = value.to_bytes(size, "big")
+    return result
+
+
 class WebsocketWrapper(object):
     OPCODE_CONTINUATION = 0x0
     OPCODE_TEXT = 0x1
@@ -2959,18 +3226,31 @@ class WebsocketWrapper(object):
         self._socket = socket
         self._path = path
 
-        self._sendbuffer = bytearray()
+        # the frame being sent and how much of it went out
+        self._sendbuffer = b""
+        self._sendbuffer_pos = 0
         self._readbuffer = bytearray()
 
         self._requested_size = 0
-        self._payload_head = 0
-        self._readbuffer_head = 0
 
         self._do_handshake(extra_headers)
 
+        # frames received but not yet returned are in _readbuffer[_read_start:_read_end]
+        self._readbuffer = bytearray(_WS_READ_SIZE)
+        self._readview = memoryview(self._readbuffer)
+        self._read_start = 0
+        self._read_end = 0
+        # the data frame being returned: payload bytes still to come, its mask
+        # and where in the mask they start, and whether the payload is wanted
+        self._frame_remaining = 0
+        self._frame_mask = None
+        self._frame_mask_offset = 0
+        self._frame_wanted = False
+
     def __del__(self):
 
         self._sendbuffer = None
+        self._readview = None
         self._readbuffer = None
 
     def _do_handshake(self, extra_headers):
@@ -3056,164 +3336,197 @@ class WebsocketWrapper(object):
 
     def _create_frame(self, opcode, data, do_masking=1):
 
-        header = bytearray()
         length = len(data)
-
-        mask_key = bytearray(os.urandom(4))
         mask_flag = do_masking
 
         # 1 << 7 is the final flag, we don't send continuated data
-        header.append(1 << 7 | opcode)
-
         if length < 126:
-            header.append(mask_flag << 7 | length)
+            header = struct.pack("!BB", 1 << 7 | opcode, mask_flag << 7 | length)
 
         elif length < 65536:
-            header.append(mask_flag << 7 | 126)
-            header += struct.pack("!H", length)
+            header = struct.pack("!BBH", 1 << 7 | opcode, mask_flag << 7 | 126, length)
 
         elif length < 0x8000000000000001:
-            header.append(mask_flag << 7 | 127)
-            header += struct.pack("!Q", length)
+            header = struct.pack("!BBQ", 1 << 7 | opcode, mask_flag << 7 | 127, length)
 
         else:
             raise ValueError("Maximum payload size is 2^63")
 
         if mask_flag == 1:
-            for index in range(length):
-                data[index] ^= mask_key[index % 4]
-            data = mask_key + data
-
-        return header + data
-
-    def _buffered_read(self, length):
-
-        # try to recv and strore needed bytes
-        wanted_bytes = length - (len(self._readbuffer) - self._readbuffer_head)
-        if wanted_bytes > 0:
-
-            data = self._socket.recv(wanted_bytes)
-
-            if not data:
-                raise socket.error(errno.ECONNABORTED, 0)
+            mask_key = os.urandom(4)
+            return b"".join((header, mask_key, _websocket_mask(mask_key, data)))
+
+        return b"".join((header, data))
+
+    def _fill(self, wanted):
+        """One recv_into() appending to the read buffer, with room for at least
+        wanted bytes and a frame header. Returns the number of bytes received"""
+        kept = self._read_end - self._read_start
+        if not kept:
+            self._read_start = self._read_end = 0
+            if len(self._readbuffer) > _IN_BUFFER_MAX_IDLE:
+                # Don't hold on to the memory of an occasional large frame
+                self._readbuffer = bytearray(_WS_READ_SIZE)
+                self._readview = memoryview(self._readbuffer)
+        needed = wanted + 14
+        if len(self._readbuffer) - self._read_end < needed:
+            if kept + needed > len(self._readbuffer):
+                readbuffer = bytearray(kept + needed)
             else:
-                self._readbuffer.extend(data)
-
-            if len(data) < wanted_bytes:
-                raise socket.error(EAGAIN, 0)
+                readbuffer = self._readbuffer
+            readbuffer[:kept] = self._readview[self._read_start:self._read_end]
+            if readbuffer is not self._readbuffer:
+                self._readbuffer = readbuffer
+                self._readview = memoryview(readbuffer)
+            self._read_start, self._read_end = 0, kept
+        length = self._socket.recv_into(self._readview[self._read_end:])
+        if not length:
+            raise socket.error(errno.ECONNABORTED, 0)
+        self._read_end += length
+        return length
+
+    def _parse_header(self):
+        """Decode the frame header at the start of the read buffer.
+
+        Returns (opcode, mask key, payload length, header length), or None when
+        the header did not fully arrive yet. A control frame is only complete
+        with its payload, None until that arrived too."""
+        buffer = self._readbuffer
+        start = self._read_start
+        available = self._read_end - start
+        if available < 2:
+            return None
+        opcode = buffer[start] & 0x0f
+        maskbit = buffer[start + 1] & 0x80
+        payload_length = buffer[start + 1] & 0x7f
+        header_length = 2
+        if payload_length == 0x7e:
+            header_length = 4
+        elif payload_length == 0x7f:
+            header_length = 10
+        if maskbit:
+            header_length += 4
+        if available < header_length:
+            return None
+        if payload_length == 0x7e:
+            payload_length, = struct.unpack_from("!H", buffer, start + 2)
+        elif payload_length == 0x7f:
+            payload_length, = struct.unpack_from("!Q", buffer, start + 2)
+        mask_key = bytes(buffer[start + header_length - 4:start + header_length]) if maskbit else None
+        if opcode & 0x08 and available < header_length + payload_length:
+            return None
+        return opcode, mask_key, payload_length, header_length
+
+    def _next_frame(self):
+        """Start on the frame in the read buffer, returns False when it did not arrive yet.
+
+        Close and ping frames are answered here, data frames are returned by recv_into()."""
+        header = self._parse_header()
+        if header is None:
+            return False
+        opcode, mask_key, payload_length, header_length = header
+        self._read_start += header_length
+
+        if opcode & 0x08:
+            payload = self._readview[self._read_start:self._read_start + payload_length]
+            self._read_start += payload_length
+            # respond to non-binary opcodes, their arrival is not guaranteed beacause of non-blocking sockets
+            if mask_key is not None:
+                payload = _websocket_mask(mask_key, payload)
+            if opcode == WebsocketWrapper.OPCODE_CONNCLOSE:
+                frame = self._create_frame(WebsocketWrapper.OPCODE_CONNCLOSE, payload, 0)
+                self._socket.send(frame)
+            elif opcode == WebsocketWrapper.OPCODE_PING:
+                frame = self._create_frame(WebsocketWrapper.OPCODE_PONG, payload, 0)
+                self._socket.send(frame)
+            return True
 
-        self._readbuffer_head += length
-        return self._readbuffer[self._readbuffer_head - length:self._readbuffer_head]
+        if opcode != WebsocketWrapper.OPCODE_CONTINUATION:
+            # a continuation frame belongs to the message of the frame before it
+            self._frame_wanted = opcode == WebsocketWrapper.OPCODE_BINARY
+        self._frame_remaining = payload_length
+        self._frame_mask = mask_key
+        self._frame_mask_offset = 0
+        return True
 
-    def _recv_impl(self, length):
+    def recv_into(self, buffer, nbytes=0):
+        """Put the payload of the binary frames received into buffer, returns the number of bytes.
 
-        # try to decode websocket payload part from data
+        The socket is read at most once, with recv_into() into the read buffer,
+        which grows to take what fits in buffer. Bytes left in the read buffer
+        are reported by pending(), select() does not know of them."""
+        view = memoryview(buffer)
+        nbytes = nbytes or len(view)
+        written = 0
+        received = False
         try:
-
-            self._readbuffer_head = 0
-
-            result = None
-
-            chunk_startindex = self._payload_head
-            chunk_endindex = self._payload_head + length
-
-            header1 = self._buffered_read(1)
-            header2 = self._buffered_read(1)
-
-            opcode = (header1[0] & 0x0f)
-            maskbit = (header2[0] & 0x80) == 0x80
-            lengthbits = (header2[0] & 0x7f)
-            payload_length = lengthbits
-            mask_key = None
-
-            # read length
-            if lengthbits == 0x7e:
-
-                value = self._buffered_read(2)
-                payload_length, = struct.unpack("!H", value)
-
-            elif lengthbits == 0x7f:
-
-                value = self._buffered_read(8)
-                payload_length, = struct.unpack("!Q", value)
-
-            # read mask
-            if maskbit:
-                mask_key = self._buffered_read(4)
-
-            # if frame payload is shorter than the requested data, read only the possible part
-            readindex = chunk_endindex
-            if payload_length < readindex:
-                readindex = payload_length
-
-            if readindex > 0:
-                # get payload chunk
-                payload = self._buffered_read(readindex)
-
-                # unmask only the needed part
-                if maskbit:
-                    for index in range(chunk_startindex, readindex):
-                        payload[index] ^= mask_key[index % 4]
-
-                result = payload[chunk_startindex:readindex]
-                self._payload_head = readindex
-            else:
-                payload = bytearray()
-
-            # check if full frame arrived and reset readbuffer and payloadhead if needed
-            if readindex == payload_length:
-                self._readbuffer = bytearray()
-                self._payload_head = 0
-
-                # respond to non-binary opcodes, their arrival is not guaranteed beacause of non-blocking sockets
-                if opcode == WebsocketWrapper.OPCODE_CONNCLOSE:
-                    frame = self._create_frame(WebsocketWrapper.OPCODE_CONNCLOSE, payload, 0)
-                    self._socket.send(frame)
-
-                if opcode == WebsocketWrapper.OPCODE_PING:
-                    frame = self._create_frame(WebsocketWrapper.OPCODE_PONG, payload, 0)
-                    self._socket.send(frame)
-
-            if opcode == WebsocketWrapper.OPCODE_BINARY and payload_length > 0:
-                return result
-            else:
-                raise socket.error(EAGAIN, 0)
-
+            while written < nbytes:
+                available = self._read_end - self._read_start
+                if not self._frame_remaining:
+                    if self._next_frame():
+                        continue
+                elif available:
+                    length = min(available, self._frame_remaining, nbytes - written)
+                    if self._frame_wanted:
+                        payload = self._readview[self._read_start:self._read_start + length]
+                        if self._frame_mask is not None:
+                            payload = _websocket_mask(self._frame_mask, payload, self._frame_mask_offset)
+                        view[written:written + length] = payload
+                        written += length
+                    self._read_start += length
+                    self._frame_remaining -= length
+                    self._frame_mask_offset += length
+                    continue
+
+                if received or (written and not self._frame_remaining):
+                    # whole frames returned, the next ones are read when select() reports them
+                    break
+                self._fill(nbytes - written)
+                received = True
         except socket.error as err:
-
             if err.errno == errno.ECONNABORTED:
                 self.connected = False
-                return b''
-            else:
+                return written
+            if not written:
                 # no more data
                 raise
 
+        if not written:
+            raise socket.error(EAGAIN, 0)
+        return written
+
     def _send_impl(self, data):
 
         # if previous frame was sent successfully
-        if len(self._sendbuffer) == 0:
+        if not self._sendbuffer:
             # create websocket frame
-            frame = self._create_frame(WebsocketWrapper.OPCODE_BINARY, bytearray(data))
-            self._sendbuffer.extend(frame)
+            self._sendbuffer = self._create_frame(WebsocketWrapper.OPCODE_BINARY, data)
+            self._sendbuffer_pos = 0
             self._requested_size = len(data)
 
-        # try to write out as much as possible
-        length = self._socket.send(self._sendbuffer)
+        # try to write out as much as possible, from where the last send stopped
+        if self._sendbuffer_pos:
+            length = self._socket.send(memoryview(self._sendbuffer)[self._sendbuffer_pos:])
+        else:
+            length = self._socket.send(self._sendbuffer)
 
-        self._sendbuffer = self._sendbuffer[length:]
+        self._sendbuffer_pos += length
 
-        if len(self._sendbuffer) == 0:
+        if self._sendbuffer_pos == len(self._sendbuffer):
             # buffer sent out completely, return with payload's size
+            self._sendbuffer = b""
+            self._sendbuffer_pos = 0
             return self._requested_size
         else:
             # couldn't send whole data, request the same data again with 0 as sent length
             return 0
 
     def recv(self, length):
-        return self._recv_impl(length)
+        buffer = bytearray(length)
+        return bytes(buffer[:self.recv_into(buffer)])
 
     def read(self, length):
-        return self._recv_impl(length)
+        return self.recv(length)
 
     def send(self, data):
         return self._send_impl(data)
@@ -3228,13 +3541,17 @@ class WebsocketWrapper(object):
         return self._socket.fileno()
 
     def pending(self):
+        # Frames already in the read buffer, select() is not aware of them.
+        # Only counted when they can be returned, an incomplete header waits
+        # for select() like the rest of the frame does.
+        buffered = self._read_end - self._read_start
+        if buffered and not self._frame_remaining and self._parse_header() is None:
+            buffered = 0
         # Fix for bug #131: a SSL socket may still have data available
         # for reading without select() being aware of it.
         if self._ssl:
-            return self._socket.pending()
-        else:
-            # normal socket rely only on select()
-            return 0
+            return buffered + self._socket.pending()
+        return buffered
 
     def setblocking(self, flag):
         self._socket.setblocking(flag)
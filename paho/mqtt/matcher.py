@@ -1,10 +1,18 @@
+import collections
+
+
 class MQTTMatcher(object):
     """Intended to manage topic filters including wildcards.
 
     Internally, MQTTMatcher use a prefix tree (trie) to store 
     values associated with filters, and has an iter_match() 
     method to iterate efficiently over all filters that match 
-    some topic name."""
+    some topic name.
+
+    Filters without wildcards are also kept in a dict, so topics are
+    matched with a single lookup while no wildcard filter is registered.
+    Otherwise the matches of the last cache_size topics are remembered,
+    until a filter is added or removed."""
 
     class Node(object):
         __slots__ = '_children', '_content'
@@ -13,16 +21,27 @@ class MQTTMatcher(object):
             self._children = {}
             self._content = None
 
-    def __init__(self):
+    def __init__(self, cache_size=256):
         self._root = self.Node()
+        self._exact = {}
+        self._wildcards = 0
+        self._cache = collections.OrderedDict()
+        self._cache_size = cache_size
 
     def __setitem__(self, key, value):
         """Add a topic filter :key to the prefix tree
         and associate it to :value"""
+        syms = key.split('/')
         node = self._root
-        for sym in key.split('/'):
+        for sym in syms:
             node = node._children.setdefault(sym, self.Node())
+        if '+' in syms or '#' in syms:
+            if node._content is None:
+                self._wildcards += 1
+        else:
+            self._exact[key] = value
         node._content = value
+        self._cache.clear()
 
     def __getitem__(self, key):
         """Retrieve the value associated with some topic filter :key"""
@@ -44,11 +63,17 @@ class MQTTMatcher(object):
             for k in key.split('/'):
                  parent, node = node, node._children[k]
                  lst.append((parent, k, node))
-            # TODO
+            if node._content is None:
+                raise KeyError(key)
             node._content = None
         except KeyError:
             raise KeyError(key)
         else:  # cleanup
+            if key in self._exact:
+                del self._exact[key]
+            else:
+                self._wildcards -= 1
+            self._cache.clear()
             for parent, k, node in reversed(lst):
                 if node._children or node._content is not None:
                      break
@@ -57,6 +82,23 @@ class MQTTMatcher(object):
     def iter_match(self, topic):
         """Return an iterator on all values associated with filters 
         that match the :topic"""
+        if not self._wildcards:
+            content = self._exact.get(topic)
+            return iter(() if content is None else (content,))
+
+        cache = self._cache
+        try:
+            matches = cache[topic]
+        except KeyError:
+            matches = tuple(self._match(topic))
+            if len(cache) >= self._cache_size:
+                cache.popitem(last=False)
+            cache[topic] = matches
+        else:
+            cache.move_to_end(topic)
+        return iter(matches)
+
+    def _match(self, topic):
         lst = topic.split('/')
         normal = not topic.startswith('$')
         def rec(node, i=0):
@@ -0,0 +1,249 @@
+"""
+This module provides a way to run the network traffic of many Client
+instances from a single thread. Instead of each client running its own
+select() loop in its own thread (loop_start()), all client sockets are
+registered with one selector (epoll on Linux, kqueue on BSD) and the client's
+loop_read() and loop_write() functions are called as events arrive. Keepalive
+checks and message retries of all clients are deadlines in one TimerHeap, run
+as they fall due.
+"""
+from __future__ import absolute_import
+
+import collections
+import selectors
+import socket
+import threading
+
+from . import client as paho
+from .timers import TimerHeap
+
+_OP_OPEN = 0
+_OP_CLOSE = 1
+_OP_WRITE = 2
+_OP_NO_WRITE = 3
+
+
+class Multiplexer(object):
+    """Drives any number of Client instances from one selector.
+
+    General usage flow:
+
+    * Create the client and call connect()/connect_async() as usual
+    * Call register() to hand the client's network traffic to the multiplexer
+    * Call loop() repeatedly, or loop_forever()/loop_start() to run it for you
+
+    Do not call loop(), loop_forever() or loop_start() on a registered client.
+    register() takes over the client's on_socket_open, on_socket_close,
+    on_socket_register_write and on_socket_unregister_write callbacks.
+    """
+
+    def __init__(self, selector=None, misc_interval=1.0):
+        """selector: a selectors.BaseSelector, defaults to selectors.DefaultSelector().
+
+        misc_interval: longest wait in seconds for network events before the
+        timers are looked at, timers scheduled from other threads are run at
+        most this late."""
+        self._selector = selector if selector is not None else selectors.DefaultSelector()
+        self._misc_interval = misc_interval
+        self.timers = TimerHeap()
+        self._clients = set()
+        self._ops = collections.deque()
+        self._ops_mutex = threading.Lock()
+        self._wake_r, self._wake_w = _socketpair()
+        self._wake_pending = False
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self._thread = None
+        self._thread_terminate = False
+
+    def __len__(self):
+        return len(self._clients)
+
+    def register(self, client):
+        """Start handling the network traffic of client."""
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+        with self._ops_mutex:
+            self._clients.add(client)
+        client._timers_set(self.timers)
+        self._push(_OP_OPEN, client, None)
+
+    def unregister(self, client):
+        """Stop handling the network traffic of client. The client is not
+        disconnected."""
+        with self._ops_mutex:
+            self._clients.discard(client)
+        client.on_socket_open = None
+        client.on_socket_close = None
+        client.on_socket_register_write = None
+        client.on_socket_unregister_write = None
+        client._timers_set(None)
+        self._push(_OP_CLOSE, client, None)
+
+    def clients(self):
+        """Return a list of the registered clients."""
+        with self._ops_mutex:
+            return list(self._clients)
+
+    def loop(self, timeout=1.0):
+        """Wait up to timeout seconds for network events and process them for
+        all registered clients. Returns the number of events handled."""
+        self._apply_ops()
+
+        pending = [key for key in self._selector.get_map().values()
+                   if key.data is not None and _pending_bytes(key.fileobj) > 0]
+        if pending:
+            timeout = 0.0
+        else:
+            timeout = min(timeout, self._misc_interval)
+            deadline = self.timers.next_deadline()
+            if deadline is not None:
+                timeout = max(min(timeout, deadline - paho.time_func()), 0.0)
+
+        events = self._selector.select(timeout)
+        count = len(events)
+        for key, mask in events:
+            client = key.data
+            if client is None:
+                self._drain_wake()
+                continue
+            if mask & selectors.EVENT_READ:
+                client.loop_read()
+            if mask & selectors.EVENT_WRITE and client.socket() is key.fileobj:
+                client.loop_write()
+        for key in pending:
+            key.data.loop_read()
+
+        self.timers.run_due(paho.time_func())
+        self._apply_ops()
+        return count
+
+    def loop_forever(self, timeout=1.0):
+        """Call loop() until loop_stop() is called."""
+        while not self._thread_terminate:
+            self.loop(timeout)
+
+    def loop_start(self):
+        """Run loop_forever() in a new thread."""
+        if self._thread is not None:
+            return paho.MQTT_ERR_INVAL
+
+        self._thread_terminate = False
+        self._thread = threading.Thread(target=self.loop_forever, name='paho-multiplexer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def loop_stop(self):
+        """Stop the thread previously started with loop_start()."""
+        if self._thread is None:
+            return paho.MQTT_ERR_INVAL
+
+        self._thread_terminate = True
+        self.wake()
+        if threading.current_thread() != self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def wake(self):
+        """Interrupt a loop() waiting for network events."""
+        with self._ops_mutex:
+            if self._wake_pending:
+                return
+            self._wake_pending = True
+        try:
+            self._wake_w.send(paho.sockpair_data)
+        except socket.error:
+            pass
+
+    def close(self):
+        """Release the selector. Clients are not disconnected."""
+        self.loop_stop()
+        self._selector.close()
+        self._wake_r.close()
+        self._wake_w.close()
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._push(_OP_OPEN, client, sock)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._push(_OP_CLOSE, client, sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._push(_OP_WRITE, client, sock)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._push(_OP_NO_WRITE, client, sock)
+
+    def _push(self, op, client, sock):
+        # Socket callbacks can come from any thread publishing through the
+        # client, but the selector is only touched from the loop thread.
+        with self._ops_mutex:
+            self._ops.append((op, client, sock))
+        if self._thread is not None and threading.current_thread() != self._thread:
+            self.wake()
+
+    def _apply_ops(self):
+        with self._ops_mutex:
+            ops = self._ops
+            if not ops:
+                return
+            self._ops = collections.deque()
+
+        for op, client, sock in ops:
+            if op == _OP_OPEN:
+                sock = client.socket()
+                if sock is None or client not in self._clients:
+                    continue
+                events = selectors.EVENT_READ
+                if client.want_write():
+                    events |= selectors.EVENT_WRITE
+                self._modify(sock, events, client)
+            elif op == _OP_CLOSE:
+                for key in list(self._selector.get_map().values()):
+                    if key.data is client and (sock is None or key.fileobj is sock):
+                        self._selector.unregister(key.fileobj)
+            else:
+                if sock is None or sock is not client.socket() or client not in self._clients:
+                    continue
+                events = selectors.EVENT_READ
+                if op == _OP_WRITE:
+                    events |= selectors.EVENT_WRITE
+                self._modify(sock, events, client)
+
+    def _modify(self, sock, events, client):
+        try:
+            key = self._selector.get_key(sock)
+        except KeyError:
+            self._selector.register(sock, events, client)
+        else:
+            if key.events != events or key.data is not client:
+                self._selector.modify(sock, events, client)
+
+    def _drain_wake(self):
+        # Clear the flag only once the socket is empty, under the mutex wake()
+        # takes, so a wake() in between can't have its byte swallowed while
+        # the flag stays set.
+        with self._ops_mutex:
+            try:
+                self._wake_r.recv(4096)
+            except socket.error:
+                pass
+            self._wake_pending = False
+
+
+def _pending_bytes(sock):
+    # SSL sockets may hold decrypted data the selector does not know about.
+    try:
+        return sock.pending()
+    except AttributeError:
+        return 0
+
+
+def _socketpair():
+    if hasattr(socket, 'socketpair'):
+        sock1, sock2 = socket.socketpair()
+        sock1.setblocking(0)
+        sock2.setblocking(0)
+        return (sock1, sock2)
+    return paho._socketpair_compat()
@@ -22,29 +22,76 @@ from __future__ import absolute_import
 
 import collections
 
+try:
+    from collections.abc import Iterable
+except ImportError:
+    from collections import Iterable
+
 from . import client as paho
 from .. import mqtt
 
-def _do_publish(client):
-    """Internal function"""
 
-    message = client._userdata.popleft()
+class _Messages(object):
+    """Internal class: the messages still to publish and the MQTTMessageInfo,
+    by mid, of the ones handed to the client and not completed yet, at most
+    window of them."""
+
+    def __init__(self, msgs, window):
+        self.queued = collections.deque(msgs)
+        self.window = window
+        self.inflight = {}
+        # mids that completed before publish() returned their MQTTMessageInfo
+        self.completed = set()
+        self.publishing = False
+        self.disconnecting = False
+
+    def __len__(self):
+        return len(self.queued) + len(self.inflight)
+
+
+def _do_publish(client, message):
+    """Internal function"""
 
     if isinstance(message, dict):
-        client.publish(**message)
+        return client.publish(**message)
     elif isinstance(message, (tuple, list)):
-        client.publish(*message)
+        return client.publish(*message)
     else:
         raise TypeError('message must be a dict, tuple, or list')
 
 
+def _fill_window(client, userdata):
+    """Internal function
+
+    Publishes until window messages are in flight or none are left.
+    Disconnects when all messages completed."""
+
+    # QoS 0 messages complete while being published, the outer call does the work
+    if userdata.publishing:
+        return
+    userdata.publishing = True
+    try:
+        inflight = userdata.inflight
+        while userdata.queued and len(inflight) < userdata.window:
+            info = _do_publish(client, userdata.queued.popleft())
+            if info.mid in userdata.completed:
+                userdata.completed.discard(info.mid)
+            else:
+                inflight[info.mid] = info
+    finally:
+        userdata.publishing = False
+
+    if not userdata and not userdata.disconnecting:
+        userdata.disconnecting = True
+        client.disconnect()
+
+
 def _on_connect(client, userdata, flags, rc):
     """Internal callback"""
     #pylint: disable=invalid-name, unused-argument
 
     if rc == 0:
-        if len(userdata) > 0:
-            _do_publish(client)
+        _fill_window(client, userdata)
     else:
         raise mqtt.MQTTException(paho.connack_string(rc))
 
@@ -53,15 +100,15 @@ def _on_publish(client, userdata, mid):
     """Internal callback"""
     #pylint: disable=unused-argument
 
-    if len(userdata) == 0:
-        client.disconnect()
-    else:
-        _do_publish(client)
+    # Called before the MQTTMessageInfo is marked as published
+    if userdata.inflight.pop(mid, None) is None:
+        userdata.completed.add(mid)
+    _fill_window(client, userdata)
 
 
 def multiple(msgs, hostname="localhost", port=1883, client_id="", keepalive=60,
              will=None, auth=None, tls=None, protocol=paho.MQTTv311,
-             transport="tcp"):
+             transport="tcp", window=1):
     """Publish multiple messages to a broker, then disconnect cleanly.
 
     This function creates an MQTT client, connects to a broker and publishes a
@@ -121,13 +168,24 @@ def multiple(msgs, hostname="localhost", port=1883, client_id="", keepalive=60,
 
     transport : set to "tcp" to use the default setting of transport which is
           raw TCP. Set to "websockets" to use WebSockets as the transport.
+
+    window : the number of messages published before waiting for the first
+          of them to complete. Defaults to 1, every message waits for the
+          previous one. With a larger window, QoS 1 and 2 messages are
+          pipelined: publishing N of them costs about one round trip to the
+          broker plus the time to send them, instead of N round trips. The
+          messages still leave in order.
     """
 
-    if not isinstance(msgs, collections.Iterable):
+    if not isinstance(msgs, Iterable):
         raise TypeError('msgs must be an iterable')
 
-    client = paho.Client(client_id=client_id, userdata=collections.deque(msgs),
+    if window < 1:
+        raise ValueError('window must be at least 1')
+
+    client = paho.Client(client_id=client_id, userdata=_Messages(msgs, window),
                          protocol=protocol, transport=transport)
+    client.max_inflight_messages_set(max(window, 20))
 
     client.on_publish = _on_publish
     client.on_connect = _on_connect
@@ -0,0 +1,73 @@
+"""
+This module provides a heap of deadlines that many Client instances can share,
+so keepalive checks and message retries cost work when they are due instead of
+a scan over every client and message at a fixed interval. The Multiplexer
+runs one for all the clients it drives.
+"""
+from __future__ import absolute_import
+
+import heapq
+import itertools
+import threading
+
+
+class Timer(object):
+    """A scheduled call, returned by TimerHeap.schedule()."""
+
+    __slots__ = 'deadline', 'callback', 'args', 'cancelled'
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """Do not make the call. The entry is dropped when it reaches the top of the heap."""
+        self.cancelled = True
+
+
+class TimerHeap(object):
+    """Calls callbacks once their deadline has passed.
+
+    Deadlines are values of client.time_func. schedule() and cancel() may be
+    called from any thread, the callbacks run in the thread calling run_due().
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._sequence = itertools.count()
+        self._mutex = threading.Lock()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, deadline, callback, *args):
+        """Call callback(*args) from run_due() once deadline has passed."""
+        timer = Timer(deadline, callback, args)
+        with self._mutex:
+            heapq.heappush(self._heap, (deadline, next(self._sequence), timer))
+        return timer
+
+    def next_deadline(self):
+        """The earliest deadline of the timers not cancelled, None if there are none."""
+        with self._mutex:
+            heap = self._heap
+            while heap and heap[0][2].cancelled:
+                heapq.heappop(heap)
+            return heap[0][0] if heap else None
+
+    def run_due(self, now):
+        """Make the calls whose deadline is at or before now, returns their number.
+        Timers scheduled by these calls wait for the next run_due(), even if already due."""
+        due = []
+        with self._mutex:
+            heap = self._heap
+            while heap and heap[0][0] <= now:
+                timer = heapq.heappop(heap)[2]
+                if not timer.cancelled:
+                    due.append(timer)
+        for timer in due:
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+        return len(due)
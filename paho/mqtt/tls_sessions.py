@@ -0,0 +1,141 @@
+"""
+This module lets clients that reconnect to the same broker resume their TLS
+session instead of doing a full handshake every time, and lets clients share
+one SSLContext. Sessions are kept per SSLContext, as a session can only be
+resumed with the context that created it, and per host and port. Clients
+that use the same context share its sessions, also when they were set up
+separately. Every cache counts the handshakes that resumed a session and the
+ones that were done in full.
+
+    context = registry.context(ca_certs="ca.crt")   # the same object for the same settings
+    client.tls_set_context(context)
+    registry.statistics()                           # {'full': 1, 'resumed': 41}
+"""
+from __future__ import absolute_import
+
+import threading
+import time
+import weakref
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+
+def create_context(ca_certs=None, certfile=None, keyfile=None, cert_reqs=None, tls_version=None, ciphers=None):
+    """A new SSLContext configured as described for Client.tls_set()."""
+    if tls_version is None:
+        tls_version = ssl.PROTOCOL_TLSv1
+        # If the python version supports it, use highest TLS version automatically
+        if hasattr(ssl, "PROTOCOL_TLS"):
+            tls_version = ssl.PROTOCOL_TLS
+    context = ssl.SSLContext(tls_version)
+
+    # Configure context
+    if certfile is not None:
+        context.load_cert_chain(certfile, keyfile)
+
+    if cert_reqs == ssl.CERT_NONE and hasattr(context, 'check_hostname'):
+        context.check_hostname = False
+
+    context.verify_mode = ssl.CERT_REQUIRED if cert_reqs is None else cert_reqs
+
+    if ca_certs is not None:
+        context.load_verify_locations(ca_certs)
+    else:
+        context.load_default_certs()
+
+    if ciphers is not None:
+        context.set_ciphers(ciphers)
+
+    return context
+
+
+class SessionCache(object):
+    """The last TLS session per (host, port) made with one SSLContext, and the handshake counters."""
+
+    def __init__(self):
+        self._sessions = {}
+        self._mutex = threading.Lock()
+        self.full = 0
+        self.resumed = 0
+
+    def get(self, host, port):
+        """The session to offer when connecting to host:port, None if there is none or it expired."""
+        with self._mutex:
+            session = self._sessions.get((host, port))
+            if session is not None and session.time + session.timeout < time.time():
+                del self._sessions[(host, port)]
+                session = None
+            return session
+
+    def put(self, host, port, session):
+        if session is None:
+            return
+        with self._mutex:
+            self._sessions[(host, port)] = session
+
+    def forget(self, host, port):
+        with self._mutex:
+            self._sessions.pop((host, port), None)
+
+    def handshake_done(self, sock):
+        """Count the handshake just done on sock as resumed or full."""
+        with self._mutex:
+            if getattr(sock, 'session_reused', False):
+                self.resumed += 1
+            else:
+                self.full += 1
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class ContextRegistry(object):
+    """Shared SSLContexts, one per set of settings, and the SessionCache of every context in use."""
+
+    def __init__(self):
+        self._contexts = {}
+        self._caches = weakref.WeakKeyDictionary()
+        self._mutex = threading.Lock()
+
+    def context(self, ca_certs=None, certfile=None, keyfile=None, cert_reqs=None, tls_version=None, ciphers=None):
+        """The SSLContext for these settings, see Client.tls_set(), created on first use.
+
+        Changes made to it, e.g. by Client.tls_insecure_set(), apply to every
+        client using it."""
+        key = (ca_certs, certfile, keyfile, cert_reqs, tls_version, ciphers)
+        with self._mutex:
+            context = self._contexts.get(key)
+            if context is None:
+                context = create_context(*key)
+                self._contexts[key] = context
+            return context
+
+    def sessions(self, context):
+        """The SessionCache of context, created on first use. It goes when the context does."""
+        with self._mutex:
+            cache = self._caches.get(context)
+            if cache is None:
+                cache = SessionCache()
+                self._caches[context] = cache
+            return cache
+
+    def statistics(self):
+        """The number of full and resumed handshakes of all contexts."""
+        with self._mutex:
+            caches = list(self._caches.values())
+        return {
+            'full': sum(cache.full for cache in caches),
+            'resumed': sum(cache.resumed for cache in caches),
+        }
+
+    def clear(self):
+        """Drop the shared contexts and all sessions, e.g. after certificates were replaced."""
+        with self._mutex:
+            self._contexts.clear()
+            self._caches = weakref.WeakKeyDictionary()
+
+
+registry = ContextRegistry()
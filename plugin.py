@@ -22,11 +22,19 @@
         </param>
 		<param field="Mode2" label="Dyson Serial No." default="NN2-EU-JEA3830A" required="true"/>
 		<param field="Password" label="Dyson Password (see machine)" required="true" password="true"/>
-		<param field="Mode5" label="Update count (10 sec)" default="3" required="true"/>
+		<param field="Mode3" label="Update mode">
+            <options>
+                <option label="Push (device reports changes)" value="Push" default="true"/>
+                <option label="Poll" value="Poll"/>
+            </options>
+        </param>
+		<param field="Mode6" label="More devices: serial,ip,password[,type[,port]];..." width="400px" default=""/>
+		<param field="Mode5" label="Update count (10 sec), fallback poll in push mode" default="3" required="true"/>
 		<param field="Mode4" label="Debug" width="75px">
             <options>
                 <option label="True" value="Debug" default="true"/>
                 <option label="False" value="Normal"/>
+                <option label="Profile" value="Profile"/>
             </options>
         </param>
     </params>
@@ -34,20 +42,46 @@
 """
 
 import Domoticz
-import base64, json, hashlib, os, time
+import plugin_log as log
+import base64, json, hashlib, os, time, threading, functools
 import paho.mqtt.client as mqtt
 from run_plugin import DysonWrapper
+from device_loop import DeviceLoop
+from instrumentation import profiler, STAGE_UPDATE_DEVICE
+from sensor_history import HistoryStore
 from queue import Queue, Empty
 
 from value_types import CONNECTION_STATE, DISCONNECTION_STATE, FanMode, StandbyMonitoring, ConnectionError, DisconnectionError, SensorsData, StateData
 #from dyson_pure_link_device import DysonPureLinkDevice
 
+class FleetMember:
+    """One Dyson device of the plugin and the block of Domoticz units it owns"""
+
+    def __init__(self, index, password, serial_number, device_type, ip_address, port_number, deviceLoop):
+        self.index = index
+        self.baseUnit = index * DysonPureLink.unitsPerDevice
+        self.serial_number = serial_number
+        self.myWrapper = DysonWrapper(password, serial_number, device_type, ip_address, port_number, deviceLoop)
+        self.IThinkIAmConnected = False
+        self.sensor_data = None
+        self.state_data = None
+        self.shownSensorData = None
+        self.shownStateData = None
+        # newest records pushed by the device, applied to the units on the next heartbeat
+        self.pushedStateData = None
+        self.pushedSensorData = None
+        # commands the device confirmed, logged and shown on the next heartbeat
+        self.confirmedCommands = []
+        self.runCounter = 0
+
+    def unit(self, unit):
+        """Domoticz unit number of this member's unit"""
+        return self.baseUnit + unit
+
 class DysonPureLink:
     #define class variables
     enabled = False
-    IThinkIAmConnected = False
-    myWrapper = None
-    #unit numbers for devices to create
+    #unit numbers for devices to create, per fleet member offset by index * unitsPerDevice
     #for Pure Cool models
     fanModeUnit = 1
     fanStateUnit = 12
@@ -61,189 +95,403 @@ class DysonPureLink:
     volatileUnit = 9
     particlesUnit = 10
     sleepTimeUnit = 11
-    runCounter = 0
+    #text device with the timing profile, only with Debug set to Profile
+    profileUnit = 13
+    #ticks (tickSeconds) between profile updates
+    profileInterval = 6
+    #seconds between connection checks and polls, Mode5 counts these
+    tickSeconds = 10
+    #heartbeat interval in Push mode, pushed records show up within this many seconds
+    pushHeartbeat = 1
+    unitsPerDevice = 16
+    #Domoticz allows units 1-255
+    maxDevices = 255 // unitsPerDevice
+    pushMode = True
 
     def __init__(self):
-        self.password = None
-        self.serial_number = None
-        self.device_type = None
-        self.ip_address = None
-        self.port_number = None
-        self.sensor_data = None
-        self.state_data = None
+        self.fleet = []
+        self.deviceLoop = None
+        self.updateLock = threading.Lock()
+        self.profileCounter = self.profileInterval
+        self.heartbeatsPerTick = 1
+        self.heartbeatCounter = 0
+        self.history = None
 
     def onStart(self):
-        Domoticz.Log("onStart called")
-        if Parameters['Mode4'] == 'Debug':
-            Domoticz.Debugging(1)
+        log.log("onStart called")
+        log.set_debugging(Parameters['Mode4'] == 'Debug')
+        log.limiter.reset()
+        if log.debugging:
             DumpConfigToLog()
+        if Parameters['Mode4'] == 'Profile':
+            profiler.reset()
+            profiler.enable()
+            if self.profileUnit not in Devices:
+                Domoticz.Device(Name='Profile', Unit=self.profileUnit, TypeName="Text").Create()
         
-        #PureLink needs polling, get from config
-        self.runCounter = int(Parameters["Mode5"])
-        Domoticz.Heartbeat(10)
+        shadowValues.clear()
+
+        #sensor readings are kept on disk, with minute and hour rollups
+        try:
+            self.history = HistoryStore(os.path.join(Parameters.get('HomeFolder', ''), 'history'))
+        except (IOError, OSError) as e:
+            log.error("Sensor history not available: %s", e)
+            self.history = None
+
+        #PureLink pushes changes, poll only when nothing arrived for Mode5 times tickSeconds
+        self.pushMode = Parameters.get("Mode3", "Push") != "Poll"
+        #pushed records are shown every heartbeat, the rest of the work is done every tickSeconds
+        heartbeat = self.pushHeartbeat if self.pushMode else self.tickSeconds
+        self.heartbeatsPerTick = self.tickSeconds // heartbeat
+        self.heartbeatCounter = 0
+        Domoticz.Heartbeat(heartbeat)
+
+        #read out parameters, the first device comes from the regular fields, more from Mode6
+        port_number = int(Parameters["Port"].replace(" ", ""))
+        devices = [(Parameters['Password'], Parameters['Mode2'], Parameters['Mode1'], Parameters["Address"].replace(" ", ""), port_number)]
+        devices.extend(parseFleet(Parameters.get('Mode6', ''), Parameters['Mode1'], port_number))
+        if len(devices) > self.maxDevices:
+            log.error("Too many devices configured, only the first %d are used", self.maxDevices)
+            del devices[self.maxDevices:]
+
+        #all devices share one network thread
+        self.deviceLoop = DeviceLoop()
+        self.deviceLoop.start()
+        for index, (password, serial_number, device_type, ip_address, port_number) in enumerate(devices):
+            self.fleet.append(FleetMember(index, password, serial_number, device_type, ip_address, port_number, self.deviceLoop))
+
+        #all units first, a device that does not answer must not keep the others from showing up
+        for member in self.fleet:
+            member.runCounter = int(Parameters["Mode5"])
+            self.createDevices(member)
+
+            if self.pushMode:
+                member.myWrapper.setUpdateCallback(functools.partial(self.onDeviceUpdate, member))
+
+        for member in self.fleet:
+            # Connect device and print result, onHeartbeat keeps reconnecting devices that are not reachable
+            member.IThinkIAmConnected = member.myWrapper.getConnected()
+            log.log('onStart: %s connected: %s', member.serial_number, member.IThinkIAmConnected)
+            if not member.IThinkIAmConnected:
+                continue
+            
+            (member.state_data, member.sensor_data) = member.myWrapper.getUpdate(member.IThinkIAmConnected)
+            log.debug("onStart: %s", member.state_data)
+            log.debug("onStart: %s", member.sensor_data)
+            
+            with self.updateLock:
+                self.updateAllDevices(member)
         
-        #check, per device, if it is created. If not,create it
+        #close connection again
+        #self.IThinkIAmConnected = self.myWrapper.getDisConnected(self.IThinkIAmConnected)
+        #Domoticz.Log('onStart: disConnected: ' + str(self.IThinkIAmConnected))
+
+    def createDevices(self, member):
+        """check, per device, if it is created. If not,create it"""
+        prefix = '' if member.index == 0 else member.serial_number + ' '
         Options = {"LevelActions" : "|||",
                    "LevelNames" : "|OFF|ON|AUTO",
                    "LevelOffHidden" : "true",
                    "SelectorStyle" : "1"}
-        if self.fanModeUnit not in Devices:
-            Domoticz.Device(Name='Fan mode', Unit=self.fanModeUnit, TypeName="Selector Switch", Image=7, Options=Options).Create()
+        if member.unit(self.fanModeUnit) not in Devices:
+            Domoticz.Device(Name=prefix + 'Fan mode', Unit=member.unit(self.fanModeUnit), TypeName="Selector Switch", Image=7, Options=Options).Create()
         Options = {"LevelActions" : "||",
                    "LevelNames" : "|OFF|ON",
                    "LevelOffHidden" : "true",
                    "SelectorStyle" : "1"}
-        if self.fanStateUnit not in Devices:
-            Domoticz.Device(Name='Fan state', Unit=self.fanStateUnit, TypeName="Selector Switch", Image=7, Options=Options).Create()
-        if self.nightModeUnit not in Devices:
-            Domoticz.Device(Name='Night mode', Unit=self.nightModeUnit, Type=244, Subtype=62,  Switchtype=0, Image=9).Create()
+        if member.unit(self.fanStateUnit) not in Devices:
+            Domoticz.Device(Name=prefix + 'Fan state', Unit=member.unit(self.fanStateUnit), TypeName="Selector Switch", Image=7, Options=Options).Create()
+        if member.unit(self.nightModeUnit) not in Devices:
+            Domoticz.Device(Name=prefix + 'Night mode', Unit=member.unit(self.nightModeUnit), Type=244, Subtype=62,  Switchtype=0, Image=9).Create()
             
         Options = {"LevelActions" : "|||||||||||",
                    "LevelNames" : "|1|2|3|4|5|6|7|8|9|10|Auto",
                    "LevelOffHidden" : "false",
                    "SelectorStyle" : "1"}
-        if self.fanSpeedUnit not in Devices:
-            Domoticz.Device(Name='Fan speed', Unit=self.fanSpeedUnit, TypeName="Selector Switch", Image=7, Options=Options).Create()
-
-        if self.fanOscillationUnit not in Devices:
-            Domoticz.Device(Name='Oscilation mode', Unit=self.fanOscillationUnit, Type=244, Subtype=62, Image=7, Switchtype=0).Create()
-        if self.standbyMonitoringUnit not in Devices:
-            Domoticz.Device(Name='Standby monitor', Unit=self.standbyMonitoringUnit, Type=244, Subtype=62,Image=7, Switchtype=0).Create()
-        if self.filterLifeUnit not in Devices:
-            Domoticz.Device(Name='Remaining filter life', Unit=self.filterLifeUnit, TypeName="Custom").Create()
-        if self.qualityTargetUnit not in Devices:
-            Domoticz.Device(Name='Air quality setpoint', Unit=self.qualityTargetUnit, TypeName="Custom").Create()
-        if self.tempHumUnit not in Devices:
-            Domoticz.Device(Name='Temperature and Humidity', Unit=self.tempHumUnit, TypeName="Temp+Hum").Create()
-        if self.volatileUnit not in Devices:
-            Domoticz.Device(Name='Volatile organic', Unit=self.volatileUnit, TypeName="Air Quality").Create()
-        if self.particlesUnit not in Devices:
-            Domoticz.Device(Name='Dust', Unit=self.particlesUnit, TypeName="Air Quality").Create()
-
-        #read out parameters
-        self.ip_address = Parameters["Address"].replace(" ", "")
-        self.port_number = int(Parameters["Port"].replace(" ", ""))
-        self.serial_number = Parameters['Mode2']
-        self.device_type = Parameters['Mode1']
-        self.password = Parameters['Password']
-
-        #create the wrapper
-        self.myWrapper = DysonWrapper(self.password,self.serial_number,self.device_type,self.ip_address, self.port_number)
-        
-        # Connect device and print result
-        #Domoticz.Log('Connected: ' + str(self.connect_device()))
-        self.IThinkIAmConnected = self.myWrapper.getConnected()
-        Domoticz.Log('onStart: Connected: ' + str(self.IThinkIAmConnected))
-        
-        (self.state_data, self.sensor_data) = self.myWrapper.getUpdate(self.IThinkIAmConnected)
-        Domoticz.Debug("onStart: " + str(self.state_data))
-        Domoticz.Debug("onStart: " + str(self.sensor_data))
-        
-        self.updateAllDevices()
-        
-        #close connection again
-        #self.IThinkIAmConnected = self.myWrapper.getDisConnected(self.IThinkIAmConnected)
-        #Domoticz.Log('onStart: disConnected: ' + str(self.IThinkIAmConnected))
+        if member.unit(self.fanSpeedUnit) not in Devices:
+            Domoticz.Device(Name=prefix + 'Fan speed', Unit=member.unit(self.fanSpeedUnit), TypeName="Selector Switch", Image=7, Options=Options).Create()
+
+        if member.unit(self.fanOscillationUnit) not in Devices:
+            Domoticz.Device(Name=prefix + 'Oscilation mode', Unit=member.unit(self.fanOscillationUnit), Type=244, Subtype=62, Image=7, Switchtype=0).Create()
+        if member.unit(self.standbyMonitoringUnit) not in Devices:
+            Domoticz.Device(Name=prefix + 'Standby monitor', Unit=member.unit(self.standbyMonitoringUnit), Type=244, Subtype=62,Image=7, Switchtype=0).Create()
+        if member.unit(self.filterLifeUnit) not in Devices:
+            Domoticz.Device(Name=prefix + 'Remaining filter life', Unit=member.unit(self.filterLifeUnit), TypeName="Custom").Create()
+        if member.unit(self.qualityTargetUnit) not in Devices:
+            Domoticz.Device(Name=prefix + 'Air quality setpoint', Unit=member.unit(self.qualityTargetUnit), TypeName="Custom").Create()
+        if member.unit(self.tempHumUnit) not in Devices:
+            Domoticz.Device(Name=prefix + 'Temperature and Humidity', Unit=member.unit(self.tempHumUnit), TypeName="Temp+Hum").Create()
+        if member.unit(self.volatileUnit) not in Devices:
+            Domoticz.Device(Name=prefix + 'Volatile organic', Unit=member.unit(self.volatileUnit), TypeName="Air Quality").Create()
+        if member.unit(self.particlesUnit) not in Devices:
+            Domoticz.Device(Name=prefix + 'Dust', Unit=member.unit(self.particlesUnit), TypeName="Air Quality").Create()
 
-        
     def onStop(self):
-        Domoticz.Log("DysonPureLink plugin: onStop called")
-        self.IThinkIAmConnected = self.myWrapper.getDisConnected(self.IThinkIAmConnected)
-        Domoticz.Log('onStart: disConnected: ' + str(self.IThinkIAmConnected))
+        log.log("DysonPureLink plugin: onStop called")
+        for member in self.fleet:
+            member.IThinkIAmConnected = member.myWrapper.getDisConnected(member.IThinkIAmConnected)
+            log.log('onStop: %s disConnected: %s', member.serial_number, member.IThinkIAmConnected)
+        if self.deviceLoop is not None:
+            self.deviceLoop.stop()
+        if profiler.enabled:
+            self.reportProfile()
+            profiler.enable(False)
+        if self.history is not None:
+            with self.updateLock:
+                self.history.close()
+                self.history = None
 
     def onConnect(self, Connection, Status, Description):
         """Static callback to handle on_connect event"""
-        Domoticz.Log("DysonPureLink plugin: onConnect called")
+        log.log("DysonPureLink plugin: onConnect called")
 
     def onMessage(self, Connection, Data):
         """Static callback to handle incoming messages"""
-        Domoticz.Log("DysonPureLink plugin: onMessage called")
+        log.log("DysonPureLink plugin: onMessage called")
 
     def onCommand(self, Unit, Command, Level, Hue):
-        Domoticz.Log("DysonPureLink plugin: onCommand called for Unit " + str(Unit) + ": Parameter '" + str(Command) + "', Level: " + str(Level))
+        log.log("DysonPureLink plugin: onCommand called for Unit %s: Parameter '%s', Level: %s", Unit, Command, Level)
+        index = (Unit - 1) // self.unitsPerDevice
+        if index >= len(self.fleet):
+            return
+        member = self.fleet[index]
+        # Domoticz may show the requested level now, compare the device's answer against Devices again;
+        # forgetting the shown state makes the next diff include the unit even when the device
+        # echoes the value shown before, shadowValues still skips the units that did not change
+        shadowValues.pop(Unit, None)
+        member.shownStateData = None
+        Unit = Unit - member.baseUnit
+        # commands are only queued, the device confirms them with a STATE-CHANGE (see onCommandAck);
+        # the commands of a scene arrive together and go to the device as one
+        onAck = functools.partial(self.onCommandAck, member)
         if Unit == self.fanSpeedUnit and Level<=100:
             arg="0000"+str(Level//10)
-            self.myWrapper.setSpeed(self.IThinkIAmConnected,arg[-4:]) #use last 4 characters as speed level or AUTO
+            member.myWrapper.queueCommand(member.IThinkIAmConnected, {'fnsp': arg[-4:]}, onAck, self.onCommandTimeout) #use last 4 characters as speed level or AUTO
         if Unit == self.fanModeUnit or (Unit == self.fanSpeedUnit and Level>100):
             if Level == 10: arg="OFF"
             if Level == 20: arg="ON"
             if Level >=30: arg="AUTO"
-            self.myWrapper.setFan(self.IThinkIAmConnected,arg) 
+            member.myWrapper.queueCommand(member.IThinkIAmConnected, {'fmod': arg}, onAck, self.onCommandTimeout)
+
+    def onCommandAck(self, member, command):
+        """Called from the shared network thread when the device confirmed a command,
+        kept for applyPushed as Domoticz may only be called from the plugin thread"""
+        with self.updateLock:
+            member.confirmedCommands.append(command)
+
+    def onCommandTimeout(self, command):
+        """Called from onHeartbeat when the device did not confirm a command in time"""
+        log.error("DysonPureLink plugin: command %s not confirmed by device", command.data)
 
     def onNotification(self, Name, Subject, Text, Status, Priority, Sound, ImageFile):
-        Domoticz.Log("DysonPureLink plugin: onNotification: " + Name + "," + Subject + "," + Text + "," + Status + "," + str(Priority) + "," + Sound + "," + ImageFile)
+        log.log("DysonPureLink plugin: onNotification: %s,%s,%s,%s,%s,%s,%s", Name, Subject, Text, Status, Priority, Sound, ImageFile)
 
     def onDisconnect(self, Connection):
         """Static callback to handle on_disconnect event"""
-        Domoticz.Debug(" plugin: onDisconnect" )
+        log.debug(" plugin: onDisconnect" )
 
     def onHeartbeat(self):
-        Domoticz.Log("DysonPureLink plugin: onHeartbeat called, version: " + Parameters["Version"])
-        self.runCounter = self.runCounter - 1
-        if self.runCounter <= 0:
-            Domoticz.Debug("Poll unit")
-            self.runCounter = int(Parameters["Mode5"])
-            if not self.IThinkIAmConnected:
-                Domoticz.Debug("DysonPureLink: onHeartbeat, try to reconnect")
-                #self.connect_device()
-            #return True
+        for member in self.fleet:
+            self.applyPushed(member)
+        self.heartbeatCounter = self.heartbeatCounter - 1
+        if self.heartbeatCounter > 0:
+            return
+        self.heartbeatCounter = self.heartbeatsPerTick
+        # once an hour is enough to see the plugin is alive
+        log.limited(log.log, 'onHeartbeat', "DysonPureLink plugin: onHeartbeat called, version: %s", Parameters["Version"], interval=3600)
+        for member in self.fleet:
+            self.heartbeatMember(member)
+        if profiler.enabled:
+            self.profileCounter = self.profileCounter - 1
+            if self.profileCounter <= 0:
+                self.profileCounter = self.profileInterval
+                self.reportProfile()
+
+    def reportProfile(self):
+        """Show the timing profile in the Profile text device and write it, with the last spans, to a file"""
+        UpdateDevice(self.profileUnit, 0, '; '.join(profiler.summary()) or 'nothing measured yet')
+        path = os.path.join(Parameters.get('HomeFolder', ''), 'DysonPureLink-profile.txt')
+        try:
+            profiler.dump(path)
+        except (IOError, OSError) as e:
+            log.error("Writing profile to %s failed: %s", path, e)
+
+    def heartbeatMember(self, member):
+        """The periodic work for a fleet member, every tickSeconds"""
+        member.myWrapper.checkCommands()
+        self.checkConnection(member)
+        member.runCounter = member.runCounter - 1
+        if member.runCounter <= 0:
+            log.debug("Poll unit %s", member.serial_number)
+            member.runCounter = int(Parameters["Mode5"])
+            if self.pushMode and member.IThinkIAmConnected:
+                # nothing pushed for a while, ask for it; the answer arrives in onDeviceUpdate, shown next heartbeat
+                log.debug("no device messages received, request state")
+                member.myWrapper.requestUpdate(member.IThinkIAmConnected)
             # Get and print state and sensors data
-            if self.IThinkIAmConnected:
-                Domoticz.Debug("unit is connected, lets show some  data")
+            elif member.IThinkIAmConnected:
+                log.debug("unit is connected, lets show some  data")
                 
-                (self.state_data,self.sensor_data) = self.myWrapper.getUpdate(self.IThinkIAmConnected)
-                Domoticz.Debug("onHeartbeat state_data: [" + str(self.state_data) + "] sensor_data: [" + str(self.sensor_data) + "]")
+                (member.state_data, member.sensor_data) = member.myWrapper.getUpdate(member.IThinkIAmConnected)
+                log.debug("onHeartbeat state_data: [%s] sensor_data: [%s]", member.state_data, member.sensor_data)
                 
-                self.updateAllDevices()
+                self.updateAllDevices(member)
                 
                 # for entry in self.myWrapper.getUpdate(self.IThinkIAmConnected):
-                    # Domoticz.Debug("onHeartbeat data:" + str(entry))
+                    # log.debug("onHeartbeat data: %s", entry)
                 #self.disconnect_device()
             else:
-                Domoticz.Debug("unit not connected")
+                log.limited(log.debug, ('not connected', member.serial_number), "unit %s not connected", member.serial_number, interval=60)
+
+    def checkConnection(self, member):
+        """Follow the connection state of a fleet member, a dropped connection is re-established
+        by the network thread with growing delays so the heartbeat never waits for it"""
+        connected = member.myWrapper.isConnected()
+        if connected and not member.IThinkIAmConnected:
+            log.log("%s reconnected, %s", member.serial_number, member.myWrapper.connectionStatistics())
+            member.IThinkIAmConnected = True
+            if self.pushMode:
+                member.myWrapper.requestUpdate(member.IThinkIAmConnected)
+            else:
+                # poll right away
+                member.runCounter = 1
+        elif not connected:
+            if member.IThinkIAmConnected:
+                log.log("%s connection lost, reconnecting", member.serial_number)
+            member.IThinkIAmConnected = False
+            member.myWrapper.reconnect()
 
     def onDeviceRemoved(self):
-        Domoticz.Log("DysonPureLink plugin: onDeviceRemoved called")
+        log.log("DysonPureLink plugin: onDeviceRemoved called")
+
+    def onDeviceUpdate(self, member, state_data, sensor_data):
+        """Called from the shared network thread for every state or sensor message a device pushes.
+        Domoticz may only be called from the plugin thread, so the records are kept for applyPushed"""
+        with self.updateLock:
+            if state_data is not None:
+                member.pushedStateData = state_data
+            if sensor_data is not None:
+                member.pushedSensorData = sensor_data
+
+    def applyPushed(self, member):
+        """Show the records the device pushed and the commands it confirmed since the last heartbeat,
+        only the newest state of each kind"""
+        with self.updateLock:
+            confirmed, member.confirmedCommands = member.confirmedCommands, []
+            state_data, member.pushedStateData = member.pushedStateData, None
+            sensor_data, member.pushedSensorData = member.pushedSensorData, None
+            for command in confirmed:
+                log.debug("DysonPureLink plugin: command %s confirmed after %d ms", command.data, round(command.latency * 1000))
+            if state_data is not None or sensor_data is not None:
+                # fresh data arrived, postpone the fallback poll
+                member.runCounter = int(Parameters["Mode5"])
+            elif confirmed and confirmed[-1].state is not None:
+                # the confirming message carries the new state, in Poll mode nothing else shows it before the next poll
+                state_data = confirmed[-1].state
+            else:
+                return
+            if state_data is not None:
+                member.state_data = state_data
+            if sensor_data is not None:
+                member.sensor_data = sensor_data
+            self.updateAllDevices(member)
     
-    def updateAllDevices(self):
-        """Update the defined devices from incoming mesage info"""
+    def updateAllDevices(self, member):
+        """Update the defined devices of a fleet member from incoming mesage info,
+        only devices whose fields changed since the last update are touched"""
         #update the devices
-        tempNum = int(self.sensor_data.temperature)
-        humNum = int(self.sensor_data.humidity)
-        UpdateDevice(self.fanOscillationUnit, self.state_data.oscillation.state, str(self.state_data.oscillation))
-        UpdateDevice(self.nightModeUnit, self.state_data.night_mode.state, str(self.state_data.night_mode))
-        UpdateDevice(self.tempHumUnit, 1, str(self.sensor_data.temperature)[:4] +';'+ str(self.sensor_data.humidity) + ";1")
-        UpdateDevice(self.volatileUnit, self.sensor_data.volatile_compounds, str(self.sensor_data.volatile_compounds))
-        UpdateDevice(self.particlesUnit, self.sensor_data.particles, str(self.sensor_data.particles))
+        sensor_data = member.sensor_data
+        state_data = member.state_data
+        if sensor_data is not None and sensor_data is not member.shownSensorData:
+            if self.history is not None:
+                self.recordHistory(member, sensor_data)
+            changed = sensor_data.changed_fields(member.shownSensorData)
+            if 'temperature' in changed or 'humidity' in changed:
+                UpdateDevice(member.unit(self.tempHumUnit), 1, str(sensor_data.temperature)[:4] +';'+ str(sensor_data.humidity) + ";1")
+            if 'volatile_compounds' in changed:
+                UpdateDevice(member.unit(self.volatileUnit), sensor_data.volatile_compounds, str(sensor_data.volatile_compounds))
+            if 'particles' in changed:
+                UpdateDevice(member.unit(self.particlesUnit), sensor_data.particles, str(sensor_data.particles))
+            member.shownSensorData = sensor_data
+
+        if state_data is None or state_data is member.shownStateData:
+            return
+        changed = state_data.changed_fields(member.shownStateData)
+        member.shownStateData = state_data
+        if 'oscillation' in changed:
+            UpdateDevice(member.unit(self.fanOscillationUnit), state_data.oscillation.state, str(state_data.oscillation))
+        if 'night_mode' in changed:
+            UpdateDevice(member.unit(self.nightModeUnit), state_data.night_mode.state, str(state_data.night_mode))
 
         # Fan speed  
-        f_rate = self.state_data.fan_speed
-        if (f_rate == "AUTO"):
-            sValueNew = "110" # Auto
-        else:
-            sValueNew = str(int(f_rate) * 10)
-
-        UpdateDevice(self.fanSpeedUnit, 1, sValueNew)
-        UpdateDevice(self.fanModeUnit, self.state_data.fan_mode.state, str((self.state_data.fan_mode.state+1)*10))
-        UpdateDevice(self.fanStateUnit, self.state_data.fan_state.state, str((self.state_data.fan_state.state+1)*10))
-        UpdateDevice(self.filterLifeUnit, self.state_data.filter_life, str(self.state_data.filter_life))
+        if 'fan_speed' in changed:
+            f_rate = state_data.fan_speed
+            if (f_rate == "AUTO"):
+                sValueNew = "110" # Auto
+            else:
+                sValueNew = str(int(f_rate) * 10)
+            UpdateDevice(member.unit(self.fanSpeedUnit), 1, sValueNew)
+
+        if 'fan_mode' in changed:
+            UpdateDevice(member.unit(self.fanModeUnit), state_data.fan_mode.state, str((state_data.fan_mode.state+1)*10))
+        if 'fan_state' in changed:
+            UpdateDevice(member.unit(self.fanStateUnit), state_data.fan_state.state, str((state_data.fan_state.state+1)*10))
+        if 'filter_life' in changed:
+            UpdateDevice(member.unit(self.filterLifeUnit), state_data.filter_life, str(state_data.filter_life))
+
+    def recordHistory(self, member, sensor_data):
+        """Append the readings to the sensor history of the member"""
+        try:
+            self.history.add(member.serial_number, sensor_data)
+        except (IOError, OSError, ValueError) as e:
+            log.limited(log.error, ('history', member.serial_number), "Storing sensor history of %s failed: %s", member.serial_number, e)
+
+def parseFleet(text, defaultType, defaultPort):
+    """Parse additional devices: entries 'serial,ip,password[,type[,port]]' separated by ';'"""
+    devices = []
+    for entry in text.replace('\n', ';').split(';'):
+        fields = [field.strip() for field in entry.split(',')]
+        if len(fields) < 3 or not fields[0]:
+            if entry.strip():
+                log.error("Ignoring device entry '%s', expected serial,ip,password[,type[,port]]", entry.strip())
+            continue
+        device_type = fields[3] if len(fields) > 3 and fields[3] else defaultType
+        port_number = int(fields[4]) if len(fields) > 4 and fields[4] else defaultPort
+        devices.append((fields[2], fields[0], device_type, fields[1], port_number))
+    return devices
             
 
+# Last (nValue, sValue, BatteryLevel) known to be in Devices per unit, saves reading them back through Domoticz
+shadowValues = {}
+
 def UpdateDevice(Unit, nValue, sValue, BatteryLevel=255, AlwaysUpdate=False):
+    if profiler.enabled:
+        start = time.monotonic()
+        updateDevice(Unit, nValue, sValue, BatteryLevel, AlwaysUpdate)
+        profiler.record(STAGE_UPDATE_DEVICE, start, time.monotonic())
+    else:
+        updateDevice(Unit, nValue, sValue, BatteryLevel, AlwaysUpdate)
+
+def updateDevice(Unit, nValue, sValue, BatteryLevel, AlwaysUpdate):
+    sValue = str(sValue)
+    values = (nValue, sValue, BatteryLevel)
+    if not AlwaysUpdate and shadowValues.get(Unit) == values: return
     if Unit not in Devices: return
-    if Devices[Unit].nValue != nValue\
-        or Devices[Unit].sValue != sValue\
-        or Devices[Unit].BatteryLevel != BatteryLevel\
+    device = Devices[Unit]
+    shadowValues[Unit] = values
+    if device.nValue != nValue\
+        or device.sValue != sValue\
+        or device.BatteryLevel != BatteryLevel\
         or AlwaysUpdate == True:
 
-        Devices[Unit].Update(nValue, str(sValue), BatteryLevel=BatteryLevel)
+        device.Update(nValue, sValue, BatteryLevel=BatteryLevel)
 
-        Domoticz.Debug("Update %s: nValue %s - sValue %s - BatteryLevel %s" % (
-            Devices[Unit].Name,
+        log.debug("Update %s: nValue %s - sValue %s - BatteryLevel %s",
+            device.Name,
             nValue,
             sValue,
             BatteryLevel
-        ))
+        )
 
         
 global _plugin
@@ -259,12 +507,12 @@ def onStop():
 
 def onConnect(Connection, Status, Description):
     global _plugin
-    Domoticz.Debug("base plugin onConnect")
+    log.debug("base plugin onConnect")
     _plugin.onConnect(Connection, Status, Description)
 
 def onMessage(Connection, Data):
     global _plugin
-    Domoticz.Debug("base plugin onMessage")
+    log.debug("base plugin onMessage")
     _plugin.onMessage(Connection, Data)
 
 def onCommand(Unit, Command, Level, Hue):
@@ -278,7 +526,7 @@ def onNotification(Name, Subject, Text, Status, Priority, Sound, ImageFile):
 def onDisconnect(Connection):
     global _plugin
     _plugin.onDisconnect(Connection)
-    Domoticz.Debug("base plugin onDisconnect")
+    log.debug("base plugin onDisconnect")
 
 def onHeartbeat():
     global _plugin
@@ -292,13 +540,13 @@ def onDeviceRemoved():
 def DumpConfigToLog():
     for x in Parameters:
         if Parameters[x] != "":
-            Domoticz.Debug( "'" + x + "':'" + str(Parameters[x]) + "'")
-    Domoticz.Debug("Device count: " + str(len(Devices)))
+            log.debug("'%s':'%s'", x, Parameters[x])
+    log.debug("Device count: %d", len(Devices))
     for x in Devices:
-        Domoticz.Debug("Device:           " + str(x) + " - " + str(Devices[x]))
-        Domoticz.Debug("Device ID:       '" + str(Devices[x].ID) + "'")
-        Domoticz.Debug("Device Name:     '" + Devices[x].Name + "'")
-        Domoticz.Debug("Device nValue:    " + str(Devices[x].nValue))
-        Domoticz.Debug("Device sValue:   '" + Devices[x].sValue + "'")
-        Domoticz.Debug("Device LastLevel: " + str(Devices[x].LastLevel))
+        log.debug("Device:           %s - %s", x, Devices[x])
+        log.debug("Device ID:       '%s'", Devices[x].ID)
+        log.debug("Device Name:     '%s'", Devices[x].Name)
+        log.debug("Device nValue:    %s", Devices[x].nValue)
+        log.debug("Device sValue:   '%s'", Devices[x].sValue)
+        log.debug("Device LastLevel: %s", Devices[x].LastLevel)
     return
\ No newline at end of file
@@ -0,0 +1,83 @@
+"""Logging to Domoticz with level checks and deferred formatting
+
+The message is only formatted, with the % operator, when it is going to be
+written, so arguments can be passed as they are:
+
+    log.debug("onHeartbeat state_data: [%s]", member.state_data)
+
+costs a check of log.debugging while debugging is off, where
+Domoticz.Debug("..." + str(member.state_data)) builds the string and calls
+into Domoticz on every call. Messages that would repeat on every heartbeat
+or reconnection attempt go through limited(), which writes them at most once
+per interval and tells how many were held back.
+"""
+
+import threading, time
+import Domoticz
+
+debugging = False
+
+def set_debugging(enabled):
+    """Switch Domoticz debug logging for this plugin on or off"""
+    global debugging
+    debugging = bool(enabled)
+    Domoticz.Debugging(1 if debugging else 0)
+
+def _format(message, args):
+    return message % args if args else message
+
+def debug(message, *args):
+    if debugging:
+        Domoticz.Debug(_format(message, args))
+
+def log(message, *args):
+    Domoticz.Log(_format(message, args))
+
+def status(message, *args):
+    Domoticz.Status(_format(message, args))
+
+def error(message, *args):
+    Domoticz.Error(_format(message, args))
+
+class RateLimiter(object):
+    """Lets a message key through once per interval seconds, counting the ones held back"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._next = {}
+        self._suppressed = {}
+        self._lock = threading.Lock()
+
+    def allow(self, key, interval=None):
+        """Number of messages held back since the last one with key was let through, None to hold this one back"""
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next.get(key, now):
+                self._suppressed[key] = self._suppressed.get(key, 0) + 1
+                return None
+            self._next[key] = now + (self.interval if interval is None else interval)
+            return self._suppressed.pop(key, 0)
+
+    def reset(self):
+        with self._lock:
+            self._next.clear()
+            self._suppressed.clear()
+
+# Seconds before a message with the same key is written again
+LIMIT_INTERVAL = 300
+
+limiter = RateLimiter(LIMIT_INTERVAL)
+
+def limited(write, key, message, *args, **kwargs):
+    """write(message, *args) unless a message with key was written less than interval
+    (keyword, default LIMIT_INTERVAL) seconds ago, e.g. limited(log.error, serial, "%s unreachable", serial)"""
+    if write is debug and not debugging:
+        return False
+    suppressed = limiter.allow(key, kwargs.get('interval'))
+    if suppressed is None:
+        return False
+    if suppressed:
+        write("%s (%d similar messages suppressed)", _format(message, args), suppressed)
+    else:
+        write(message, *args)
+    return True
@@ -1,14 +1,16 @@
 #!/usr/bin/python
 
-import Domoticz
-import base64, os
+import plugin_log as log
+import base64, os, time
+
+from instrumentation import profiler, STAGE_GET_UPDATE
 
 from dyson_pure_link_device import DysonPureLinkDevice
 from value_types import FanMode, StandbyMonitoring
 
 
 class DysonWrapper(object):
-    def __init__(self, password, serialNumber, deviceType, ipAdress, portNum):
+    def __init__(self, password, serialNumber, deviceType, ipAdress, portNum, deviceLoop=None):
         #nothing to do yet
         boolie = True
         #self.config = None
@@ -17,93 +19,134 @@ class DysonWrapper(object):
         self.device_type = deviceType
         self.ip_address = ipAdress
         self.port_number = int(portNum)
-        self.dyson_pure_link = DysonPureLinkDevice(self.password, self.serial_number, self.device_type, self.ip_address, self.port_number)
+        self.dyson_pure_link = DysonPureLinkDevice(self.password, self.serial_number, self.device_type, self.ip_address, self.port_number, deviceLoop)
         
     def getConnected(self):
         # Start new instance of Dyson Pure Link Device
 
         # Connect device and print result
-        Domoticz.Debug("DysonWrapper: getConnected called")
+        log.debug("DysonWrapper: getConnected called")
 
         IAmConnected = self.dyson_pure_link.connect_device()
-        Domoticz.Debug('Connected: ' + str(IAmConnected))
+        log.debug('Connected: %s', IAmConnected)
         if IAmConnected:
             # Get and print state and sensors data
             for entry in self.dyson_pure_link.get_data():
-                Domoticz.Debug(str(entry))
+                log.debug('%s', entry)
         
         return IAmConnected
 
     def getDisConnected(self, IAmConnected):
-        Domoticz.Debug("DysonWrapper: getDisConnected called")
+        log.debug("DysonWrapper: getDisConnected called")
         if IAmConnected:
             # Disconnect device (IMPORTANT) and print result
             connected = self.dyson_pure_link.disconnect_device()
-            Domoticz.Debug('Disconnected: ' + str(connected))
+            log.debug('Disconnected: %s', connected)
             return connected
 
+    def isConnected(self):
+        """True while the device connection is up, it is re-established in the background after it dropped"""
+        return self.dyson_pure_link.is_connected()
+
+    def reconnect(self):
+        """Start reconnecting the device in the background, does not wait for the result"""
+        log.debug("DysonWrapper: reconnect called")
+        self.dyson_pure_link.start_reconnect()
+
+    def connectionStatistics(self):
+        return self.dyson_pure_link.connection_statistics
+
     def getUpdate(self, IAmConnected):
-        Domoticz.Debug("DysonWrapper: getUpdate called")
+        log.debug("DysonWrapper: getUpdate called")
         if IAmConnected:
             # Get and print state and sensors data
+            start = time.monotonic() if profiler.enabled else 0.0
             (stateData, sensorData) = self.dyson_pure_link.get_data()
+            if start:
+                profiler.record(STAGE_GET_UPDATE, start, time.monotonic())
             # for entry in (sensorData,stateData):
-            #Domoticz.Debug("DysonWrapper: getUpdate, stateData: "+str(stateData))
+            #log.debug("DysonWrapper: getUpdate, stateData: %s", stateData)
                 
             return (stateData, sensorData)
 
-    def setFan(self, IAmConnected, argsFan):
-        # Start new instance of Dyson Pure Link Device
+    def setUpdateCallback(self, callback):
+        """Have every state or sensor message pushed by the device passed to callback(stateData, sensorData)"""
+        log.debug("DysonWrapper: setUpdateCallback called")
+        self.dyson_pure_link.set_update_callback(callback)
 
-        # Connect device and print result
-        # IAmConnected = dyson_pure_link.connect_device()
-        Domoticz.Debug("DysonWrapper: setFan called")
-        Domoticz.Debug('Connected: ' + str(IAmConnected))
+    def requestUpdate(self, IAmConnected):
+        """Ask the device for its state without waiting for the answer"""
+        log.debug("DysonWrapper: requestUpdate called")
         if IAmConnected:
-            Domoticz.Debug('Testing fan mode')
-            self.dyson_pure_link.set_fan_mode(argsFan)
-            for entry in self.dyson_pure_link.get_data():
-                Domoticz.Debug(str(entry))
+            self.dyson_pure_link.poll_state()
 
-    def setStandby(self, IAmConnected, argsStandby):
-        # Start new instance of Dyson Pure Link Device
+    def sendCommand(self, IAmConnected, data, onAck=None, onTimeout=None):
+        """Queue a state change (e.g. {'fnsp': '0004'}) without waiting for the device to confirm it.
+        onAck/onTimeout receive the command once confirmed or expired, see checkCommands"""
+        log.debug("DysonWrapper: sendCommand called: %s", data)
+        if IAmConnected:
+            return self.dyson_pure_link.send_command(data, onAck, onTimeout)
 
-        Domoticz.Debug("DysonWrapper: setStandby called")
-        Domoticz.Debug('Connected: ' + str(IAmConnected))
+    def queueCommand(self, IAmConnected, data, onAck=None, onTimeout=None):
+        """Like sendCommand, but changes queued within a short window, e.g. by a scene,
+        go to the device as one command, confirmed once"""
+        log.debug("DysonWrapper: queueCommand called: %s", data)
         if IAmConnected:
-            Domoticz.Debug('Testing standby mode')
-            self.dyson_pure_link.set_standby_monitoring(argsStandby)
-            for entry in self.dyson_pure_link.get_data():
-                Domoticz.Debug(str(entry))
-    def setNightMode(self, IAmConnected, argsNight):
-        # Start new instance of Dyson Pure Link Device
+            return self.dyson_pure_link.queue_command(data, onAck, onTimeout)
+
+    def transaction(self):
+        """Collect changes to send as one command: transaction().fan_mode('ON').fan_speed('0004').send()"""
+        return self.dyson_pure_link.transaction()
 
-        print('Connected: ', IAmConnected)
+    def checkCommands(self):
+        """Expire commands the device did not confirm in time"""
+        self.dyson_pure_link.check_command_timeouts()
+
+    def changeState(self, IAmConnected, data):
+        """Set the values in data (e.g. {'fnsp': '0004'}) and wait for the device to confirm them.
+        Returns (stateData, sensorData): the confirmed state and the last sensor reading, one round trip
+        to the device. None when not connected or not confirmed in time"""
+        log.debug("DysonWrapper: changeState called: %s", data)
         if IAmConnected:
-            print('Testing night mode')
-            self.dyson_pure_link.set_night_mode(argsNight)
-            for entry in self.dyson_pure_link.get_data():
-                print(entry)
+            return self._confirmed(self.dyson_pure_link._change_state(data))
 
-    def setSpeed(self, IAmConnected, argsSpeed):
-        # Start new instance of Dyson Pure Link Device
+    def _confirmed(self, update):
+        if update is None:
+            log.debug('Not confirmed by device')
+        else:
+            for entry in update:
+                log.debug('%s', entry)
+        return update
 
-        Domoticz.Debug('Connected: ' + str(IAmConnected))
+    def setFan(self, IAmConnected, argsFan):
+        log.debug("DysonWrapper: setFan called")
+        log.debug('Connected: %s', IAmConnected)
         if IAmConnected:
-            Domoticz.Debug('Testing setSpeed, argument: ' + argsSpeed)
-            self.dyson_pure_link.set_fan_speed(argsSpeed)
-            for entry in self.dyson_pure_link.get_data():
-                Domoticz.Debug(str(entry))
+            return self._confirmed(self.dyson_pure_link.set_fan_mode(argsFan))
 
-    def setOscilation(self, IAmConnected, argsOsc):
-        # Start new instance of Dyson Pure Link Device
+    def setStandby(self, IAmConnected, argsStandby):
+        log.debug("DysonWrapper: setStandby called")
+        log.debug('Connected: %s', IAmConnected)
+        if IAmConnected:
+            return self._confirmed(self.dyson_pure_link.set_standby_monitoring(argsStandby))
 
-        print('Connected: ', IAmConnected)
+    def setNightMode(self, IAmConnected, argsNight):
+        log.debug('Connected: %s', IAmConnected)
         if IAmConnected:
-            print('Testing oscilation mode')
-            self.dyson_pure_link.set_oscilation(argsOsc)
-            for entry in self.dyson_pure_link.get_data():
-                print(entry)
+            log.debug('Testing night mode')
+            return self._confirmed(self.dyson_pure_link.set_night_mode(argsNight))
+
+    def setSpeed(self, IAmConnected, argsSpeed):
+        log.debug('Connected: %s', IAmConnected)
+        if IAmConnected:
+            log.debug('Testing setSpeed, argument: %s', argsSpeed)
+            return self._confirmed(self.dyson_pure_link.set_fan_speed(argsSpeed))
+
+    def setOscilation(self, IAmConnected, argsOsc):
+        log.debug('Connected: %s', IAmConnected)
+        if IAmConnected:
+            log.debug('Testing oscilation mode')
+            return self._confirmed(self.dyson_pure_link.set_oscilation(argsOsc))
            
 # if __name__ == '__main__':
     # args_parser = argparse.ArgumentParser()
@@ -0,0 +1,288 @@
+"""Append-only history of the sensor readings, on disk
+
+Every device gets a directory with three series: the readings as received
+(raw) and rollups per minute and per hour with the mean, minimum and maximum
+of every field. A series is a list of segment files, each holding a fixed
+number of records as columns: a column of times (seconds since the epoch,
+doubles) followed by a column of floats per field. Segments are memory-mapped,
+only the segment being written stays open, so the history costs the page cache
+rather than memory of the plugin, also with months of data. Missing values
+are stored as NaN.
+
+    history = HistoryStore(os.path.join(Parameters['HomeFolder'], 'history'))
+    history.add(serial_number, sensor_data)
+    times, columns = history.device(serial_number).query(start, end, 'minute')
+    columns['temperature_mean'][0]
+
+Readings of a minute or hour that was not complete when the plugin stopped
+are not rolled up.
+"""
+
+import bisect, mmap, os, struct, threading, time
+from array import array
+
+FIELDS = ('temperature', 'humidity', 'volatile_compounds', 'particles')
+ROLLUP_COLUMNS = tuple(field + suffix for field in FIELDS for suffix in ('_mean', '_min', '_max'))
+
+RAW = 'raw'
+MINUTE = 'minute'
+HOUR = 'hour'
+
+# records per segment file: a week of 10 second readings, 45 days of minutes, a year of hours
+SEGMENT_SIZE = {RAW: 65536, MINUTE: 65536, HOUR: 8784}
+# seconds segments of a series are kept, None keeps them all
+RETENTION = {RAW: 90 * 86400, MINUTE: 400 * 86400, HOUR: None}
+# seconds per rollup record
+ROLLUP_PERIOD = {MINUTE: 60, HOUR: 3600}
+
+_MAGIC = b'DPLH'
+_HEADER = struct.Struct('<4sHHII')  # magic, version, number of float columns, capacity, count
+_COUNT_OFFSET = 12
+_VERSION = 1
+
+NAN = float('nan')
+
+class Segment(object):
+    """One memory-mapped segment file of a series, see the module documentation"""
+
+    def __init__(self, path, columns, capacity=None):
+        self.path = path
+        exists = os.path.exists(path)
+        with open(path, 'r+b' if exists else 'w+b') as segment:
+            if not exists:
+                segment.truncate(_HEADER.size + capacity * (8 + 4 * columns))
+                segment.write(_HEADER.pack(_MAGIC, _VERSION, columns, capacity, 0))
+                segment.flush()
+            self._map = mmap.mmap(segment.fileno(), 0)
+        magic, version, stored_columns, capacity, count = _HEADER.unpack_from(self._map)
+        if magic != _MAGIC or version != _VERSION or stored_columns != columns:
+            self._map.close()
+            raise ValueError(path + ' is not a history segment of ' + str(columns) + ' columns')
+        self.capacity = capacity
+        self.count = count
+        view = memoryview(self._map)
+        offset = _HEADER.size
+        self.times = view[offset:offset + 8 * capacity].cast('d')
+        offset += 8 * capacity
+        self.columns = []
+        for _ in range(columns):
+            self.columns.append(view[offset:offset + 4 * capacity].cast('f'))
+            offset += 4 * capacity
+        view.release()
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+    @property
+    def last_time(self):
+        return self.times[self.count - 1] if self.count else None
+
+    def append(self, timestamp, values):
+        index = self.count
+        self.times[index] = timestamp
+        for column, value in zip(self.columns, values):
+            column[index] = NAN if value is None else value
+        # the count last, a reader never sees a half written record
+        self.count = index + 1
+        struct.pack_into('<I', self._map, _COUNT_OFFSET, self.count)
+
+    def range(self, start, end):
+        """Times and columns, as arrays, of the records with start <= time < end"""
+        times = self.times[:self.count]
+        first = bisect.bisect_left(times, start)
+        last = bisect.bisect_left(times, end, first)
+        times.release()
+        return (array('d', self.times[first:last]),
+                [array('f', column[first:last]) for column in self.columns])
+
+    def close(self):
+        self.times.release()
+        for column in self.columns:
+            column.release()
+        self.columns = []
+        self._map.close()
+
+class Series(object):
+    """Records of one resolution of a device, in segment files named after the time of their first record"""
+
+    def __init__(self, directory, name, columns, segment_size, retention=None):
+        self.directory = directory
+        self.name = name
+        self.column_names = columns
+        self.segment_size = segment_size
+        self.retention = retention
+        self._tail = None
+        # start time and path of every segment, oldest first
+        self._segments = []
+        prefix = name + '-'
+        for filename in os.listdir(directory):
+            if filename.startswith(prefix) and filename.endswith('.seg'):
+                self._segments.append((int(filename[len(prefix):-4]), os.path.join(directory, filename)))
+        self._segments.sort()
+
+    def _open(self, path):
+        return Segment(path, len(self.column_names), self.segment_size)
+
+    def append(self, timestamp, values):
+        if self._tail is None and self._segments:
+            self._tail = self._open(self._segments[-1][1])
+        if self._tail is not None and timestamp < self._tail.last_time:
+            # the clock went back, keep the times in order
+            timestamp = self._tail.last_time
+        if self._tail is None or self._tail.full:
+            self._new_segment(timestamp)
+        self._tail.append(timestamp, values)
+
+    def _new_segment(self, timestamp):
+        if self._tail is not None:
+            self._tail.close()
+        start = int(timestamp)
+        if self._segments and start <= self._segments[-1][0]:
+            start = self._segments[-1][0] + 1
+        path = os.path.join(self.directory, '{0}-{1}.seg'.format(self.name, start))
+        self._segments.append((start, path))
+        self._tail = self._open(path)
+        self._expire(timestamp)
+
+    def _expire(self, now):
+        """Remove the segments whose records are all older than the retention"""
+        if self.retention is None:
+            return
+        # a segment ends where the next one starts
+        while len(self._segments) > 1 and self._segments[1][0] < now - self.retention:
+            start, path = self._segments.pop(0)
+            os.remove(path)
+
+    def query(self, start, end):
+        """(times, {column name: values}) of the records with start <= time < end, as arrays"""
+        times = array('d')
+        columns = [array('f') for _ in self.column_names]
+        starts = [segment_start for segment_start, path in self._segments]
+        # the segment holding start, up to the one starting before end
+        first = max(bisect.bisect_right(starts, start) - 1, 0)
+        last = bisect.bisect_left(starts, end)
+        for segment_start, path in self._segments[first:last]:
+            if self._tail is not None and path == self._tail.path:
+                segment_times, segment_columns = self._tail.range(start, end)
+            else:
+                segment = self._open(path)
+                try:
+                    segment_times, segment_columns = segment.range(start, end)
+                finally:
+                    segment.close()
+            times.extend(segment_times)
+            for column, values in zip(columns, segment_columns):
+                column.extend(values)
+        return times, dict(zip(self.column_names, columns))
+
+    def close(self):
+        if self._tail is not None:
+            self._tail.close()
+            self._tail = None
+
+class _Rollup(object):
+    """Mean, minimum and maximum of every field over the current period"""
+
+    __slots__ = 'series', 'period', 'bucket', 'counts', 'sums', 'minimums', 'maximums'
+
+    def __init__(self, series, period):
+        self.series = series
+        self.period = period
+        self.bucket = None
+        self._clear()
+
+    def _clear(self):
+        self.counts = [0] * len(FIELDS)
+        self.sums = [0.0] * len(FIELDS)
+        self.minimums = [None] * len(FIELDS)
+        self.maximums = [None] * len(FIELDS)
+
+    def add(self, timestamp, values):
+        bucket = int(timestamp // self.period)
+        if bucket != self.bucket:
+            if self.bucket is not None and bucket > self.bucket:
+                self._flush()
+            self.bucket = bucket
+            self._clear()
+        for index, value in enumerate(values):
+            if value is None:
+                continue
+            self.counts[index] += 1
+            self.sums[index] += value
+            if self.minimums[index] is None or value < self.minimums[index]:
+                self.minimums[index] = value
+            if self.maximums[index] is None or value > self.maximums[index]:
+                self.maximums[index] = value
+
+    def _flush(self):
+        if not any(self.counts):
+            return
+        values = []
+        for count, total, minimum, maximum in zip(self.counts, self.sums, self.minimums, self.maximums):
+            values.extend((total / count if count else None, minimum, maximum))
+        self.series.append(self.bucket * self.period, values)
+
+class SensorHistory(object):
+    """History of the sensor readings of one device, see the module documentation"""
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.series = {
+            RAW: Series(directory, RAW, FIELDS, SEGMENT_SIZE[RAW], RETENTION[RAW]),
+            MINUTE: Series(directory, MINUTE, ROLLUP_COLUMNS, SEGMENT_SIZE[MINUTE], RETENTION[MINUTE]),
+            HOUR: Series(directory, HOUR, ROLLUP_COLUMNS, SEGMENT_SIZE[HOUR], RETENTION[HOUR]),
+        }
+        self._rollups = [_Rollup(self.series[name], period) for name, period in sorted(ROLLUP_PERIOD.items())]
+        self._lock = threading.Lock()
+
+    def add(self, sensor_data, timestamp=None):
+        """Append the readings of a SensorsData, received at timestamp (default now)"""
+        if not sensor_data.has_data:
+            return
+        timestamp = time.time() if timestamp is None else timestamp
+        values = [getattr(sensor_data, field) for field in FIELDS]
+        with self._lock:
+            self.series[RAW].append(timestamp, values)
+            for rollup in self._rollups:
+                rollup.add(timestamp, values)
+
+    def query(self, start, end, resolution=RAW):
+        """(times, {column name: values}) between start and end (seconds since the epoch) at resolution
+        RAW (columns FIELDS), MINUTE or HOUR (columns ROLLUP_COLUMNS: <field>_mean, _min and _max)"""
+        with self._lock:
+            return self.series[resolution].query(start, end)
+
+    def close(self):
+        with self._lock:
+            for series in self.series.values():
+                series.close()
+
+class HistoryStore(object):
+    """The SensorHistory of every device, in a directory per serial number below folder"""
+
+    def __init__(self, folder):
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.folder = folder
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def device(self, serial_number):
+        with self._lock:
+            history = self._devices.get(serial_number)
+            if history is None:
+                history = SensorHistory(os.path.join(self.folder, serial_number))
+                self._devices[serial_number] = history
+            return history
+
+    def add(self, serial_number, sensor_data, timestamp=None):
+        self.device(serial_number).add(sensor_data, timestamp)
+
+    def close(self):
+        with self._lock:
+            for history in self._devices.values():
+                history.close()
+            self._devices = {}
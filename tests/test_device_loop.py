@@ -0,0 +1,106 @@
+"""DeviceLoop keeps serving its devices while another one can't be reached"""
+
+import socket, threading, time, unittest
+
+import paho.mqtt.client as mqtt
+
+from benchmarks import fake_domoticz
+fake_domoticz.install()
+from benchmarks.simulator import DysonSimulator, hashed_password
+from device_loop import DeviceLoop
+from dyson_pure_link_device import DysonPureLinkDevice
+
+SERIAL = 'SIM-00000'
+
+def black_hole():
+    """A listening socket whose backlog is full, connecting to it hangs like to a switched off device"""
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(0)
+    filler = socket.create_connection(listener.getsockname())
+    return listener, filler
+
+class UnreachableDeviceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = DysonSimulator(push_interval=0.05)
+        self.simulator.add_device(SERIAL, 'password')
+        self.simulator.start()
+        self.listener, self.filler = black_hole()
+        self.loop = DeviceLoop()
+        self.loop.start()
+
+    def tearDown(self):
+        self.loop.stop()
+        self.simulator.stop()
+        self.filler.close()
+        self.listener.close()
+
+    def test_healthy_device_is_served_while_a_reconnect_hangs(self):
+        received = []
+        healthy = mqtt.Client()
+        healthy.username_pw_set(SERIAL, hashed_password('password'))
+        healthy.on_connect = lambda client, userdata, flags, rc: client.subscribe('475/' + SERIAL + '/status/current')
+        healthy.on_message = lambda client, userdata, message: received.append(time.monotonic())
+        healthy.connect(*self.simulator.address)
+        self.loop.add(healthy)
+
+        dead = mqtt.Client()
+        dead.connect_timeout_set(3)
+        dead.connect_async(*self.listener.getsockname())
+        self.loop.add(dead)
+
+        # the reconnect attempt is under way and hanging in connect()
+        deadline = time.monotonic() + 2
+        while not self.loop._reconnect[dead].connecting and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(self.loop._reconnect[dead].connecting)
+
+        start = time.monotonic()
+        time.sleep(1.5)
+        self.assertTrue(self.loop._reconnect[dead].connecting, 'the attempt should still hang')
+        during = [stamp for stamp in received if stamp >= start]
+        self.assertGreaterEqual(len(during), 10)
+        self.assertLess(max(b - a for a, b in zip([start] + during, during + [time.monotonic()])), 0.5)
+
+        self.loop.remove(dead)
+        self.loop.remove(healthy)
+        healthy.disconnect()
+
+class CommandBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = DysonSimulator()
+        self.simulator.add_device(SERIAL, 'password')
+        self.simulator.start()
+        self.loop = DeviceLoop()
+        self.loop.start()
+
+    def tearDown(self):
+        self.loop.stop()
+        self.simulator.stop()
+
+    def test_batch_is_sent_by_the_loop_thread(self):
+        device = DysonPureLinkDevice('password', SERIAL, '475', *self.simulator.address, loop=self.loop)
+        client = device._get_client()
+        client.connect_async(*self.simulator.address)
+        self.loop.add(client)
+        deadline = time.monotonic() + 2
+        while not device.is_connected() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(device.is_connected())
+
+        threads = threading.active_count()
+        confirmed = threading.Event()
+        first = device.queue_command({'fnsp': '0004'})
+        second = device.queue_command({'fmod': 'FAN'}, on_ack=lambda command: confirmed.set())
+        self.assertIs(first, second)
+        self.assertEqual(threading.active_count(), threads, 'no timer thread for the batch')
+        self.assertTrue(confirmed.wait(2))
+        self.assertEqual(first.data, {'fnsp': '0004', 'fmod': 'FAN'})
+
+        self.loop.remove(client)
+        client.disconnect()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+"""WebsocketWrapper returns the payload of the frames it reads, however they arrive"""
+
+import os, socket, unittest
+
+import paho.mqtt.client as mqtt
+
+from benchmarks.suite import websocket_client
+
+class WebsocketReadTest(unittest.TestCase):
+
+    def setUp(self):
+        # the client closes the wrapper when it goes
+        self.client, self.counting, self.peer = websocket_client()
+        self.wrapper = self.client._sock
+        self.peer.setblocking(True)
+        # not the handshake
+        self.counting.syscalls = 0
+
+    def tearDown(self):
+        self.peer.close()
+        self.wrapper.close()
+
+    def frame(self, data, opcode=mqtt.WebsocketWrapper.OPCODE_BINARY, masked=0):
+        return self.wrapper._create_frame(opcode, data, masked)
+
+    def read_all(self, length):
+        """Everything the wrapper returns, at most length bytes per call"""
+        result = bytearray()
+        while True:
+            try:
+                result += self.wrapper.recv(length)
+            except socket.error:
+                return bytes(result)
+
+    def test_many_frames_are_read_with_one_system_call(self):
+        payloads = [os.urandom(size) for size in (1, 125, 126, 3000, 70000)]
+        self.peer.sendall(b''.join(self.frame(payload, masked=n % 2) for n, payload in enumerate(payloads)))
+        buffer = bytearray(200000)
+        self.assertEqual(self.wrapper.recv_into(buffer), sum(map(len, payloads)))
+        self.assertEqual(bytes(buffer[:sum(map(len, payloads))]), b''.join(payloads))
+        self.assertEqual(self.counting.syscalls, 1)
+        self.assertEqual(self.wrapper.pending(), 0)
+
+    def test_small_reads_report_the_rest_as_pending(self):
+        payload = os.urandom(5000)
+        self.peer.sendall(self.frame(payload, masked=1) * 2)
+        self.assertEqual(self.wrapper.recv(3000), payload[:3000])
+        self.assertGreater(self.wrapper.pending(), 7000)
+        self.assertEqual(self.read_all(3000), payload[3000:] + payload)
+        self.assertEqual(self.counting.syscalls, 2)
+
+    def test_frame_arriving_in_pieces(self):
+        payload = os.urandom(1000)
+        data = self.frame(payload, masked=1)
+        received = bytearray()
+        for start in range(0, len(data), 3):
+            self.peer.sendall(data[start:start + 3])
+            received += self.read_all(len(payload))
+            if start < 5:
+                # an incomplete header is not pending, select() tells when the rest arrives
+                self.assertEqual(self.wrapper.pending(), 0)
+        self.assertEqual(bytes(received), payload)
+
+    def test_ping_is_answered_and_text_skipped(self):
+        self.peer.sendall(self.frame(b'ping', mqtt.WebsocketWrapper.OPCODE_PING, masked=1)
+                          + self.frame(b'text', mqtt.WebsocketWrapper.OPCODE_TEXT)
+                          + self.frame(b'binary'))
+        self.assertEqual(self.read_all(100), b'binary')
+        self.assertEqual(self.peer.recv(100), self.frame(b'ping', mqtt.WebsocketWrapper.OPCODE_PONG))
+
+    def test_closed_connection(self):
+        self.peer.sendall(self.frame(b'last'))
+        self.peer.shutdown(socket.SHUT_WR)
+        self.assertEqual(self.wrapper.recv(100), b'last')
+        self.assertEqual(self.wrapper.recv(100), b'')
+        self.assertFalse(self.wrapper.connected)
+
+class WebsocketMaskTest(unittest.TestCase):
+
+    def test_mask_matches_per_byte_xor(self):
+        key = b'\x01\x80\x7f\xff'
+        for size in (1, 3, 4096, 4097, 70001):
+            data = os.urandom(size)
+            for offset in range(4):
+                expected = bytes(byte ^ key[(n + offset) % 4] for n, byte in enumerate(data))
+                self.assertEqual(bytes(mqtt._websocket_mask(key, data, offset)), expected)
+
+if __name__ == '__main__':
+    unittest.main()
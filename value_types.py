@@ -17,32 +17,37 @@ DISCONNECTION_STATE = {
     99: 'Disconnection error: timeout'
 }
 
-class FanMode():
-    """Enum for fan mode"""
+class FanMode(object):
+    """Enum for fan mode
+
+    The message decoder shares instances between messages, don't change them."""
 
     OFF = 'OFF'
     ON = 'ON'
     AUTO = 'AUTO'
-    _state = None
-    
+    __slots__ = '_state', 'state'
+    _STATES = {'OFF': 0, 'ON': 1, 'AUTO': 2}
+
     def __init__(self, state):
         """go from string to state object"""
-        #print("FanMode:init:state",state)
-        if state.upper() == 'OFF': self._state = self.OFF
-        if state.upper() == 'FAN': self._state = self.ON
-        if state.upper() == 'ON': self._state = self.ON
-        if state.upper() == 'AUTO': self._state = self.AUTO
-        #print("FanMode:init:_state",self._state)
-    
+        state = state.upper()
+        if state == 'FAN':
+            state = self.ON
+        self._state = state if state in self._STATES else None
+        self.state = self._STATES.get(self._state)
+
     def __repr__(self):
         return self._state
-        
-    @property
-    def state(self):
-        if self._state == self.OFF: return 0
-        if self._state == self.ON: return 1
-        if self._state == self.AUTO: return 2
-    
+
+    def __eq__(self, other):
+        return isinstance(other, FanMode) and self._state == other._state
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._state)
+
 class StandbyMonitoring(object):
     """Enum for monitor air quality when on standby"""
 
@@ -65,21 +70,90 @@ class DisconnectionError(Exception):
         super(DisconnectionError, self).__init__(*args)
         self.message = DISCONNECTION_STATE[return_code] if return_code in DISCONNECTION_STATE else DISCONNECTION_STATE[50]
 
+def _get_field_value(field):
+    """Get field value, STATE-CHANGE messages report [old, new] pairs"""
+    return field[-1] if isinstance(field, list) else field
+
+def _kelvin_to_celsius(kelvin_value):
+    return kelvin_value - 272.15
+
+def _temperature(value):
+    return None if value == 'OFF' else _kelvin_to_celsius(float(value) / 10)
+
+def _humidity(value):
+    return None if value == 'OFF' else int(value)
+
+def _volatile_compounds(value):
+    return 0 if value == 'INIT' else int(value)
+
+def _sleep_timer(value):
+    return 0 if value == 'OFF' else int(value)
+
+def _same(value):
+    return value
+
+# Attribute, Dyson field code and converter of the decoded message records
+SENSOR_FIELDS = (
+    ('particles', 'pact', int),
+    ('humidity', 'hact', _humidity),
+    ('temperature', 'tact', _temperature),
+    ('volatile_compounds', 'vact', _volatile_compounds),
+    ('sleep_timer', 'sltm', _sleep_timer),
+)
+
+STATE_FIELDS = (
+    ('fan_mode', 'fmod', FanMode),          # ON, OFF, AUTO, (FAN?)
+    ('fan_state', 'fnst', FanMode),         # ON , OFF, (FAN?)
+    ('night_mode', 'nmod', FanMode),        # ON , OFF
+    ('fan_speed', 'fnsp', _same),           # 0001 - 0010, AUTO
+    ('oscillation', 'oson', FanMode),       # ON , OFF
+    ('filter_life', 'filf', int),           # 0000 - 4300
+    ('quality_target', 'qtar', _same),      # 0001 , 0003...
+    ('standby_monitoring', 'rhtm', FanMode), # ON, OFF
+    ('error_code', 'ercd', _same),          # I think this is an errorcode: NONE when filter needs replacement
+    ('warning_code', 'wacd', _same),        # I think this is Warning: FLTR when filter needs replacement
+)
+
+# Devices report the same few values over and over, so every field keeps the
+# values it converted before (at most _MAX_VALUES of them) and converts each
+# distinct value once.
+_MAX_VALUES = 64
+
+def _decoder(fields):
+    return tuple((attribute, key, convert, {}) for attribute, key, convert in fields)
+
+def _decode(record, data, decoder):
+    for attribute, key, convert, values in decoder:
+        value = data[key]
+        if value.__class__ is list:
+            value = value[-1]
+        try:
+            converted = values[value]
+        except KeyError:
+            converted = convert(value)
+            if len(values) < _MAX_VALUES:
+                values[value] = converted
+        setattr(record, attribute, converted)
+
+def _changed_fields(record, previous):
+    if previous is None:
+        return frozenset(record.__slots__)
+    return frozenset(attribute for attribute in record.__slots__
+                     if getattr(record, attribute) != getattr(previous, attribute))
+
+_SENSOR_DECODER = _decoder(SENSOR_FIELDS)
+_STATE_DECODER = _decoder(STATE_FIELDS)
+
+SENSOR_MESSAGES = frozenset(['ENVIRONMENTAL-CURRENT-SENSOR-DATA'])
+STATE_MESSAGES = frozenset(['CURRENT-STATE', 'STATE-CHANGE'])
+
 class SensorsData(object):
     """Value type for sensors data"""
 
+    __slots__ = tuple(attribute for attribute, key, convert in SENSOR_FIELDS)
+
     def __init__(self, message):
-        data = message['data']
-        humidity = data['hact']
-        temperature = data['tact']
-        volatile_compounds = data['vact']
-        sleep_timer = data['sltm']
-
-        self.particles = int(data['pact'])
-        self.humidity = None if humidity == 'OFF' else int(humidity)
-        self.temperature = None if temperature == 'OFF' else self.kelvin_to_celsius(float(temperature) / 10)
-        self.volatile_compounds = 0 if volatile_compounds == 'INIT' else int(volatile_compounds)
-        self.sleep_timer = 0 if sleep_timer == 'OFF' else int(sleep_timer)
+        _decode(self, message['data'], _SENSOR_DECODER)
 
     def __repr__(self):
         """Return a String representation"""
@@ -90,46 +164,27 @@ class SensorsData(object):
     def has_data(self):
         return self.temperature is not None or self.humidity is not None
 
+    def changed_fields(self, previous):
+        """Names of the fields that differ from previous, all of them when previous is None"""
+        return _changed_fields(self, previous)
+
     @staticmethod
     def is_sensors_data(message):
-        return message['msg'] in ['ENVIRONMENTAL-CURRENT-SENSOR-DATA']
+        return message['msg'] in SENSOR_MESSAGES
 
     @staticmethod
     def kelvin_to_fahrenheit (kelvin_value):
         return kelvin_value * 9 / 5 - 459.67
 
-    @staticmethod
-    def kelvin_to_celsius (kelvin_value):
-        return kelvin_value - 272.15
+    kelvin_to_celsius = staticmethod(_kelvin_to_celsius)
 
 class StateData(object):
     """Value type for state data"""
-    fan_mode = None
-    fan_modeC = None
-    fan_state = None
-    night_mode = None
-    oscillation = None
-    standby_monitoring = None
-    fan_speed = None
+
+    __slots__ = tuple(attribute for attribute, key, convert in STATE_FIELDS)
 
     def __init__(self, message):
-        data = message['product-state']
-        
-        #print("StateData.init: incoming data: ", data)
-        #print("StateData.init: incoming message: ", message)
-
-        self.fan_mode = FanMode(self._get_field_value(data['fmod'])) #  ON, OFF, AUTO, (FAN?)
-        self.fan_state = FanMode(self._get_field_value(data['fnst'])) # ON , OFF, (FAN?)
-        self.night_mode = FanMode(self._get_field_value(data['nmod'])) # ON , OFF
-        self.fan_speed = self._get_field_value(data['fnsp']) # 0001 - 0010, AUTO
-        self.oscillation = FanMode(self._get_field_value(data['oson'])) #ON , OFF
-        self.filter_life = int(self._get_field_value(data['filf'])) #0000 - 4300
-        self.quality_target = self._get_field_value(data['qtar']) #0001 , 0003...
-        self.standby_monitoring = FanMode(self._get_field_value(data['rhtm'])) # ON, OFF
-        self.error_code = self._get_field_value(data['ercd']) #I think this is an errorcode: NONE when filter needs replacement
-        self.warning_code = self._get_field_value(data['wacd']) #I think this is Warning: FLTR when filter needs replacement
-        #print("StateData.init: all message fields parsed.")
-        
+        _decode(self, message['product-state'], _STATE_DECODER)
 
     def __repr__(self):
         """Return a String representation"""
@@ -140,11 +195,21 @@ class StateData(object):
     def has_data(self):
         return self.fan_speed is not None or self.fan_mode is not None
 
-    @staticmethod
-    def _get_field_value(field):
-        """Get field value"""
-        return field[-1] if isinstance(field, list) else field
+    def changed_fields(self, previous):
+        """Names of the fields that differ from previous, all of them when previous is None"""
+        return _changed_fields(self, previous)
+
+    _get_field_value = staticmethod(_get_field_value)
 
     @staticmethod
     def is_state_data(message):
-        return message['msg'] in ['CURRENT-STATE', 'STATE-CHANGE']
+        return message['msg'] in STATE_MESSAGES
+
+def decode_message(message):
+    """Decode a parsed Dyson message into StateData or SensorsData, None for other messages"""
+    msg = message.get('msg')
+    if msg in STATE_MESSAGES:
+        return StateData(message)
+    if msg in SENSOR_MESSAGES:
+        return SensorsData(message)
+    return None